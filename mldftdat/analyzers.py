@@ -3,8 +3,10 @@ from pyscf.dft.numint import eval_ao, eval_rho, eval_rho2
 from pyscf.dft.gen_grid import Grids
 from pyscf.pbc.tools.pyscf_ase import atoms_from_ase
 from mldftdat.pyscf_utils import *
+from mldftdat.density import get_ha_energy_density_df, get_fx_energy_density_ri
+from mldftdat.memory_plan import plan_analyzer_memory
 # import numpy as np
-import jax.numpy as np
+from mldftdat.backend import np
 from abc import ABC, abstractmethod, abstractproperty
 from io import BytesIO
 import psutil
@@ -29,8 +31,10 @@ class ElectronAnalyzer(ABC):
     calc_type = None
 
     def __init__(self, calc, require_converged=True, max_mem=None, grid_level = 3, grid=None,
-                 coor=None, weight=None):
-        # max_mem in MB
+                 coor=None, weight=None, direct=False, ri=False):
+        # max_mem in MB, safe_mem_cap_mb() if None (see plan_memory)
+        # direct: integral-direct ha/fx energy densities, without vele_mat
+        # ri: RI (density-fitted) fx energy density, without mo_vele_mat
         if not isinstance(calc, self.calc_class):
             raise ValueError('Calculation must be instance of {}.'.format(self.calc_class))
         if calc.e_tot is None:
@@ -44,6 +48,8 @@ class ElectronAnalyzer(ABC):
         self.conv_tol = self.calc.conv_tol
         self.converged = calc.converged
         self.max_mem = max_mem
+        self.direct = direct
+        self.ri = ri
         self.grid_level = grid_level
         self.grid = grid
         if coor is not None:
@@ -90,37 +96,39 @@ class ElectronAnalyzer(ABC):
         lib.chkfile.dump(fname, 'analyzer', h5dict)
 
     @classmethod
-    def from_dict(cls, analyzer_dict, max_mem = None):
+    def from_dict(cls, analyzer_dict, max_mem = None, direct = False,
+                  ri = False):
         if analyzer_dict['calc_type'] != cls.calc_type:
             raise ValueError('Dict is from wrong type of calc, {} vs {}!'.format(
                                 analyzer_dict['calc_type'], cls.calc_type))
         mol = mol_from_dict(analyzer_dict['mol'])
         calc = get_scf(analyzer_dict['calc_type'], mol, analyzer_dict['calc'])
-        analyzer = cls(calc, require_converged = False, max_mem = max_mem)
-        analyzer_dict['data'].pop('coords')
-        analyzer_dict['data'].pop('weights')
+        # reuse the grid the stored data was computed on
+        grid = QuickGrid(analyzer_dict['data'].pop('coords'),
+                         analyzer_dict['data'].pop('weights'))
+        analyzer = cls(calc, require_converged = False, max_mem = max_mem,
+                       direct = direct, ri = ri, grid = grid)
         analyzer.__dict__.update(analyzer_dict['data'])
         return analyzer
 
     @classmethod
-    def load(cls, fname, max_mem = None):
+    def load(cls, fname, max_mem = None, direct = False, ri = False):
         analyzer_dict = lib.chkfile.load(fname, 'analyzer')
-        return cls.from_dict(analyzer_dict, max_mem)
-
-    def assign_num_chunks(self, ao_vals_shape, ao_vals_dtype):
-        if self.max_mem == None:
-            self.num_chunks = 1
-            return self.num_chunks
-
-        if ao_vals_dtype == np.float32:
-            nbytes = 4
-        elif ao_vals_dtype == np.float64:
-            nbytes = 8
-        else:
-            raise ValueError('Wrong dtype for ao_vals')
-        num_mbytes = nbytes * ao_vals_shape[0] * ao_vals_shape[1]**2 // 1000000
-        self.num_chunks = int(num_mbytes // self.max_mem) + 1
-        return self.num_chunks
+        return cls.from_dict(analyzer_dict, max_mem, direct, ri)
+
+    def plan_memory(self):
+        # see memory_plan; max_mem None means safe_mem_cap_mb()
+        nocc = [c.shape[1] for c in self.occ_coeff] \
+            if isinstance(self.occ_coeff, list) else [self.occ_coeff.shape[1]]
+        self.mem_plan = plan_analyzer_memory(
+            self.ao_vals.shape[1], self.ao_vals.shape[0], nocc,
+            max_mem=self.max_mem, nspin=len(nocc),
+            itemsize=self.ao_vals.dtype.itemsize
+        )
+        self.num_chunks = self.mem_plan.num_chunks
+        if self.mem_plan.get_strategy('ee') == 'direct':
+            self.direct = True
+        return self.mem_plan
 
     def post_process(self):
         # The child post process function must set up the RDMs
@@ -138,14 +146,18 @@ class ElectronAnalyzer(ABC):
         self.e_tot = self.calc.e_tot
         self.mo_coeff = self.calc.mo_coeff
         self.mo_occ = self.calc.mo_occ
+        # only the occupied orbitals contribute to the exchange
+        self.occ_coeff, self.occ = get_occ_orbitals(self.mo_coeff, self.mo_occ)
         self.mo_energy = self.calc.mo_energy
         self.ao_vals = get_ao_vals(self.mol, COOR) if not self.iao else self.ao
-        self.mo_vals = get_mo_vals(self.ao_vals, self.mo_coeff)
+        self.mo_vals = get_mo_vals(self.ao_vals, self.occ_coeff)
 
-        self.assign_num_chunks(self.ao_vals.shape, self.ao_vals.dtype)
+        self.plan_memory()
         #print("NUMBER OF CHUNKS", self.calc_type, self.num_chunks, self.ao_vals.dtype, psutil.virtual_memory().available // 1e6)
 
-        if self.num_chunks > 1:
+        if self.direct:
+            self.ao_vele_mat = None
+        elif self.num_chunks > 1:
             self.ao_vele_mat = get_vele_mat_generator(self.mol, COOR,
                                                 self.num_chunks)
         else:
@@ -169,15 +181,71 @@ class ElectronAnalyzer(ABC):
         self.fx_energy_density = None
         self.xc_energy_density = None
         self.ee_energy_density = None
+        self.ha_energy_density_df = None
+        self.ha_df_error = None
+        self.fx_energy_density_ri = None
+        self.fx_ri_error = None
 
     def get_ao_rho_data(self):
         if self.rho_data is None or self.tau_data is None:
-            ao_data, self.rho_data = get_mgga_data(
-                                        self.mol, self.grid, self.rdm1)
-            self.tau_data = get_tau_and_grad(self.mol, self.grid,
-                                            self.rdm1, ao_data)
+            self.rho_data, _, self.tau_data = get_rho_tau_data(
+                self.mol, self.grid, self.rdm1, with_ddrho=False,
+                max_memory=self.mem_plan.get_max_memory('density'))
         return self.rho_data, self.tau_data
 
+    def get_coords(self):
+        return self.grid.coords if self.coor is None else self.coor
+
+    def get_weights(self):
+        return self.grid.weights if self.weight is None else self.weight
+
+    def get_ha_energy_density_df(self, auxbasis=None):
+        """
+        Density-fitted Hartree energy density (see
+        density.get_ha_energy_density_df), which does not need the
+        vele matrix. Also sets ha_df_error, a dict with the fitted and
+        exact Hartree energies and the Coulomb-norm fitting error, plus
+        the max and integrated absolute deviations from
+        ha_energy_density if that has already been computed.
+        """
+        if self.ha_energy_density_df is None:
+            self.ha_energy_density_df, self.ha_df_error = \
+                get_ha_energy_density_df(
+                    self.mol, self.rdm1, self.get_coords(), auxbasis=auxbasis,
+                    jmat=self.jmat, max_memory=self.mem_plan.get_max_memory('ee'),
+                    return_error=True
+                )
+            if self.ha_energy_density is not None:
+                diff = np.abs(self.ha_energy_density_df
+                              - self.ha_energy_density)
+                self.ha_df_error['max_abs_error'] = np.max(diff)
+                self.ha_df_error['int_abs_error'] = np.dot(diff, self.get_weights())
+        return self.ha_energy_density_df
+
+    def get_fx_energy_density_ri(self, auxbasis=None):
+        """
+        RI exchange energy density (see density.get_fx_energy_density_ri).
+        Also sets fx_ri_error, a dict with the exact exchange energy,
+        the integral of the RI exchange energy density and their
+        difference, plus the max and integrated absolute deviations from
+        the exact fx_energy_density if that has already been computed.
+        """
+        if self.fx_energy_density_ri is None:
+            fx_ri = sum(self._get_fx_energy_density_ri(auxbasis))
+            weights = self.get_weights()
+            self.fx_energy_density_ri = fx_ri
+            self.fx_ri_error = {
+                'fx_total': self.fx_total,
+                'fx_total_ri': np.dot(fx_ri, weights),
+            }
+            self.fx_ri_error['total_error'] = self.fx_ri_error['fx_total_ri']\
+                                              - self.fx_total
+            if self.fx_energy_density is not None and not self.ri:
+                diff = np.abs(fx_ri - self.fx_energy_density)
+                self.fx_ri_error['max_abs_error'] = np.max(diff)
+                self.fx_ri_error['int_abs_error'] = np.dot(diff, weights)
+        return self.fx_energy_density_ri
+
     def perform_full_analysis(self):
         self.get_ao_rho_data()
         self.get_ha_energy_density()
@@ -203,15 +271,38 @@ class RHFAnalyzer(ElectronAnalyzer):
         self.jmat, self.kmat = scf.hf.get_jk(self.mol, self.rdm1)
         self.ha_total, self.fx_total = get_hf_coul_ex_total2(self.rdm1,
                                                     self.jmat, self.kmat)
-        if self.num_chunks > 1:
+        if self.direct or self.ri:
+            self.mo_vele_mat = None
+        elif self.num_chunks > 1:
             self.mo_vele_mat = get_vele_mat_generator(self.mol, self.grid.coords,
-                                                self.num_chunks, self.mo_coeff)
+                                                self.num_chunks, self.occ_coeff)
         else:
-            self.mo_vele_mat = get_mo_vele_mat(self.ao_vele_mat, self.mo_coeff)
+            self.mo_vele_mat = get_mo_vele_mat(self.ao_vele_mat, self.occ_coeff)
             #print("MO VELE MAT", self.mo_vele_mat.nbytes, psutil.virtual_memory().available // 1e6)
 
+    def _get_ee_energy_density_direct(self):
+        # in ri mode the exchange is not needed from the direct integrals
+        fx_dms = None if self.ri else \
+            [scf.hf.make_rdm1(self.occ_coeff, self.occ)]
+        self.ha_energy_density, fx_energy_density = \
+            get_ee_energy_density_direct(
+                self.mol, self.get_coords(), self.rdm1, fx_dms,
+                max_memory=self.mem_plan.get_max_memory('ee')
+            )
+        if fx_energy_density is not None:
+            self.fx_energy_density = fx_energy_density[0]
+
+    def _get_fx_energy_density_ri(self, auxbasis=None):
+        return [get_fx_energy_density_ri(
+            self.mol, self.occ_coeff, self.occ, self.get_coords(),
+            auxbasis=auxbasis, mo_vals=self.mo_vals,
+            max_memory=self.mem_plan.get_max_memory('ee')
+        )]
+
     def get_ha_energy_density(self):
-        if self.ha_energy_density is None:
+        if self.ha_energy_density is None and self.direct:
+            self._get_ee_energy_density_direct()
+        elif self.ha_energy_density is None:
             self.ha_energy_density = get_ha_energy_density2(
                                     self.mol, self.rdm1,
                                     self.ao_vele_mat, self.ao_vals
@@ -219,9 +310,13 @@ class RHFAnalyzer(ElectronAnalyzer):
         return self.ha_energy_density
 
     def get_fx_energy_density(self):
-        if self.fx_energy_density is None:
+        if self.fx_energy_density is None and self.ri:
+            self.fx_energy_density = self._get_fx_energy_density_ri()[0]
+        elif self.fx_energy_density is None and self.direct:
+            self._get_ee_energy_density_direct()
+        elif self.fx_energy_density is None:
             self.fx_energy_density = get_fx_energy_density2(
-                                    self.mol, self.mo_occ,
+                                    self.mol, self.occ,
                                     self.mo_vele_mat, self.mo_vals
                                     )
         return self.fx_energy_density
@@ -260,16 +355,42 @@ class UHFAnalyzer(ElectronAnalyzer):
         self.jmat, self.kmat = scf.hf.get_jk(self.mol, self.rdm1)
         self.ha_total, self.fx_total = get_hf_coul_ex_total2(self.rdm1,
                                                     self.jmat, self.kmat)
-        if self.num_chunks > 1:
+        if self.direct or self.ri:
+            self.mo_vele_mat = None
+        elif self.num_chunks > 1:
             self.mo_vele_mat = [get_vele_mat_generator(self.mol, self.grid.coords,
-                                                self.num_chunks, self.mo_coeff[0]),\
+                                                self.num_chunks, self.occ_coeff[0]),\
                                 get_vele_mat_generator(self.mol, self.grid.coords,
-                                                self.num_chunks, self.mo_coeff[1])]
+                                                self.num_chunks, self.occ_coeff[1])]
         else:
-            self.mo_vele_mat = get_mo_vele_mat(self.ao_vele_mat, self.mo_coeff)
+            self.mo_vele_mat = get_mo_vele_mat(self.ao_vele_mat, self.occ_coeff)
+
+    def _get_ee_energy_density_direct(self):
+        # in ri mode the exchange is not needed from the direct integrals
+        fx_dms = None if self.ri else \
+            [scf.hf.make_rdm1(self.occ_coeff[s], 2 * self.occ[s])
+             for s in range(2)]
+        self.ha_energy_density, fx_energy_density = \
+            get_ee_energy_density_direct(
+                self.mol, self.get_coords(), np.sum(self.rdm1, axis=0),
+                fx_dms, max_memory=self.mem_plan.get_max_memory('ee')
+            )
+        if fx_energy_density is not None:
+            self.fx_energy_density_u = 0.5 * fx_energy_density[0]
+            self.fx_energy_density_d = 0.5 * fx_energy_density[1]
+            self.fx_energy_density = self.fx_energy_density_u + self.fx_energy_density_d
+
+    def _get_fx_energy_density_ri(self, auxbasis=None):
+        return [0.5 * get_fx_energy_density_ri(
+            self.mol, self.occ_coeff[s], 2 * self.occ[s], self.get_coords(),
+            auxbasis=auxbasis, mo_vals=self.mo_vals[s],
+            max_memory=self.mem_plan.get_max_memory('ee')
+        ) for s in range(2)]
 
     def get_ha_energy_density(self):
-        if self.ha_energy_density is None:
+        if self.ha_energy_density is None and self.direct:
+            self._get_ee_energy_density_direct()
+        elif self.ha_energy_density is None:
             self.ha_energy_density = get_ha_energy_density2(
                                     self.mol, np.sum(self.rdm1, axis=0),
                                     self.ao_vele_mat, self.ao_vals
@@ -277,13 +398,19 @@ class UHFAnalyzer(ElectronAnalyzer):
         return self.ha_energy_density
 
     def get_fx_energy_density(self):
-        if self.fx_energy_density is None:
+        if self.fx_energy_density is None and self.ri:
+            self.fx_energy_density_u, self.fx_energy_density_d = \
+                self._get_fx_energy_density_ri()
+            self.fx_energy_density = self.fx_energy_density_u + self.fx_energy_density_d
+        elif self.fx_energy_density is None and self.direct:
+            self._get_ee_energy_density_direct()
+        elif self.fx_energy_density is None:
             self.fx_energy_density_u = 0.5 * get_fx_energy_density2(
-                                        self.mol, 2 * self.mo_occ[0],
+                                        self.mol, 2 * self.occ[0],
                                         self.mo_vele_mat[0], self.mo_vals[0]
                                         )
             self.fx_energy_density_d = 0.5 * get_fx_energy_density2(
-                                        self.mol, 2 * self.mo_occ[1],
+                                        self.mol, 2 * self.occ[1],
                                         self.mo_vele_mat[1], self.mo_vals[1]
                                         )
             self.fx_energy_density = self.fx_energy_density_u + self.fx_energy_density_d
@@ -306,7 +433,7 @@ class RKSAnalyzer(RHFAnalyzer):
 
     def __init__(self, calc, idm = None, dm=None, iao = None, ao = None,
                  require_converged=True, max_mem=None, type_check=False, grid_subsample=100,
-                 coor=None, weight=None):
+                 coor=None, weight=None, direct=False, ri=False):
         if type_check:
             if type(calc) != dft.rks.RKS:
                 raise ValueError('Calculation must be RKS.')
@@ -340,13 +467,15 @@ class RKSAnalyzer(RHFAnalyzer):
             pass
         self.weight = weight
         super(RKSAnalyzer, self).__init__(hf, require_converged, max_mem, grid = self.grid,
-                                          coor=coor, weight=weight)
+                                          coor=coor, weight=weight, direct=direct,
+                                          ri=ri)
 
 
 class UKSAnalyzer(UHFAnalyzer):
 
     def __init__(self, calc, idm = None, dm=None,
-                 require_converged=True, max_mem=None, type_check=False, grid_subsample=100):
+                 require_converged=True, max_mem=None, type_check=False, grid_subsample=100,
+                 direct=False, ri=False):
         if type_check:
             if type(calc) != dft.uks.UKS:
                 raise ValueError('Calculation must be UKS.')
@@ -361,4 +490,5 @@ class UKSAnalyzer(UHFAnalyzer):
         self.grid_subsample = grid_subsample
         self.idm = idm
         self.dm = dm
-        super(UKSAnalyzer, self).__init__(hf, require_converged, max_mem, grid = self.grid)
+        super(UKSAnalyzer, self).__init__(hf, require_converged, max_mem, grid = self.grid,
+                                          direct=direct, ri=ri)
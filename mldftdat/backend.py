@@ -0,0 +1,93 @@
+"""
+Array backend used by the descriptor and analyzer modules.
+
+density, pyscf_utils, analyzers, data, dft.utils and dft.numint bind
+np to the backend module. The default is jax.numpy, which is needed
+to differentiate through the descriptors (e.g. in xcquinox).
+The numpy backend avoids host/device copies and copy-on-write .at[]
+updates, and is intended for production SCF runs and dataset
+compilation, where nothing is differentiated.
+
+The backend is read from the MLDFTDAT_BACKEND environment variable
+('jax' or 'numpy') when mldftdat is first imported, and can be changed
+afterwards with set_backend or temporarily with the use_backend
+context manager:
+
+    with use_backend('numpy'):
+        desc = get_exchange_descriptors2(analyzer, version='c')
+"""
+
+import os
+import sys
+import contextlib
+import numpy
+import jax.numpy as jnp
+
+
+BACKEND_ENV = 'MLDFTDAT_BACKEND'
+
+BACKENDS = {
+    'jax': jnp,
+    'numpy': numpy,
+}
+
+# Modules whose global np follows the backend.
+BACKEND_MODULES = [
+    'mldftdat.pyscf_utils',
+    'mldftdat.density',
+    'mldftdat.analyzers',
+    'mldftdat.data',
+    'mldftdat.dft.utils',
+    'mldftdat.dft.numint',
+]
+
+
+def _check_backend(name):
+    name = name.lower()
+    if name not in BACKENDS:
+        raise ValueError('Unknown backend {}, must be one of {}'.format(
+            name, list(BACKENDS.keys())))
+    return name
+
+
+_backend = _check_backend(os.environ.get(BACKEND_ENV, 'jax'))
+np = BACKENDS[_backend]
+
+
+def get_backend():
+    """
+    Name of the current array backend, 'jax' or 'numpy'.
+    """
+    return _backend
+
+
+def is_jax_backend():
+    return _backend == 'jax'
+
+
+def set_backend(name):
+    """
+    Switch the array backend of all mldftdat modules that support
+    both backends. Modules imported later pick up the new backend.
+    """
+    global _backend, np
+    _backend = _check_backend(name)
+    np = BACKENDS[_backend]
+    for modname in BACKEND_MODULES:
+        mod = sys.modules.get(modname)
+        if mod is not None:
+            mod.np = np
+
+
+@contextlib.contextmanager
+def use_backend(name):
+    """
+    Context manager that switches the array backend with set_backend
+    and restores the previous backend on exit.
+    """
+    old_backend = _backend
+    set_backend(name)
+    try:
+        yield np
+    finally:
+        set_backend(old_backend)
@@ -1,5 +1,5 @@
 # import numpy as np
-import jax.numpy as np
+from mldftdat.backend import np
 from mldftdat.workflow_utils import get_save_dir, SAVE_ROOT
 from mldftdat.density import get_exchange_descriptors2, LDA_FACTOR,\
                              get_ldax, get_ldax_dens
@@ -205,7 +205,8 @@ def predict_exchange(analyzer, model=None, restricted=True, return_desc=False):
                                           version=model.desc_version,
                                           a0=model.a0,
                                           fac_mul=model.fac_mul,
-                                          amin=model.amin)
+                                          amin=model.amin,
+                                          desc_order=getattr(model, 'desc_order', None))
         neps = model.predict(xdesc.transpose(), vec_eval=False)
         eps = neps / rho
         if return_desc:
@@ -227,7 +228,8 @@ def predict_exchange(analyzer, model=None, restricted=True, return_desc=False):
                                           version=model.desc_version,
                                           a0=model.a0,
                                           fac_mul=model.fac_mul,
-                                          amin=model.amin)
+                                          amin=model.amin,
+                                          desc_order=getattr(model, 'desc_order', None))
         gridsize = xdesc.shape[1]
         neps, std = np.zeros(gridsize), np.zeros(gridsize)
         blksize = 20000
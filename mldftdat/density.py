@@ -1,6 +1,14 @@
 # import numpy as np
-import jax.numpy as np
+from mldftdat.backend import np
+import numpy
+import functools
 from pyscfad import gto, df
+from pyscf.gto.mole import conc_env, fakemol_for_charges
+from pyscf.gto.mole import intor_cross as _np_intor_cross
+from pyscf.df.addons import make_auxmol, make_auxbasis
+from pyscf.gto.moleintor import getints, getints2c, make_cintopt, make_loc
+from pyscf.dft.gen_grid import BLKSIZE
+from pyscf import lib
 import scipy.linalg
 from scipy.linalg import cho_factor, cho_solve
 from mldftdat.pyscf_utils import *
@@ -11,6 +19,10 @@ GG_SMUL = 1.0
 GG_AMUL = 1.0
 GG_AMIN = 1.0 / 18
 
+# number of grid points per block for screened feature overlaps
+SCREEN_BLKSIZE = 128
+SCREEN_MIN_GAP = 8
+
 
 ######################
 # Exchange baselines #
@@ -61,17 +73,20 @@ def get_gaussian_grid(coords, rho, l=0, s=None, alpha=None):
     atm = auxmol._atm.copy()
     bas = auxmol._bas.copy()
     start = auxmol._env.shape[0] - 2
-    env = np.zeros(start + 2 * N)
-    # env[:start] = auxmol._env[:-2]
-    env = env.at[:start].set(auxmol._env[:-2])
-    # bas[:,5] = start + np.arange(N)
-    bas = bas.at[:,5].set(start + np.arange(N))
-    # bas[:,6] = start + N + np.arange(N)
-    bas = bas.at[:,6].set(start + N + np.arange(N))
+    # libcint buffers, so always numpy
+    env = numpy.zeros(start + 2 * N)
+    env[:start] = auxmol._env[:-2]
+    bas[:,5] = start + numpy.arange(N)
+    bas[:,6] = start + N + numpy.arange(N)
+    rho = numpy.asarray(rho)
+    if s is not None:
+        s = numpy.asarray(s)
+    if alpha is not None:
+        alpha = numpy.asarray(alpha)
 
-    a = np.pi * (rho / 2 + 1e-16)**(2.0 / 3)
+    a = numpy.pi * (rho / 2 + 1e-16)**(2.0 / 3)
     scale = 1
-    fac = (6 * np.pi**2)**(2.0/3) / (16 * np.pi)
+    fac = (6 * numpy.pi**2)**(2.0/3) / (16 * numpy.pi)
     if s is not None:
         scale += GG_SMUL * fac * s**2
     if alpha is not None:
@@ -79,16 +94,90 @@ def get_gaussian_grid(coords, rho, l=0, s=None, alpha=None):
     bas[:,1] = l
     ascale = a * scale
     cond = ascale < GG_AMIN
-    ascale[cond] = GG_AMIN * np.exp(ascale[cond] / GG_AMIN - 1)
+    ascale[cond] = GG_AMIN * numpy.exp(ascale[cond] / GG_AMIN - 1)
     env[bas[:,5]] = ascale
-    logging.debug('GAUSS GRID MIN EXPONENT {}'.format(np.sqrt(np.min(env[bas[:,5]]))))
     #env[bas[:,6]] = np.sqrt(4 * np.pi) * (4 * np.pi * rho / 3)**(l / 3.0) * np.sqrt(scale)**l
-    env[bas[:,6]] = np.sqrt(4 * np.pi**(1-l)) * (8 * np.pi / 3)**(l/3.0) * ascale**(l/2.0)
+    #env[bas[:,6]] = numpy.sqrt(4 * numpy.pi) * (4 * numpy.pi * rho / 3)**(l / 3.0) * numpy.sqrt(scale)**l
+    env[bas[:,6]] = numpy.sqrt(4 * numpy.pi**(1-l)) * (8 * numpy.pi / 3)**(l/3.0) * ascale**(l/2.0)
 
     return atm, bas, env
 
+class CiderGridTemplate():
+    """
+    Fixed atm/bas/env layout of the fake molecule holding the CIDER
+    feature Gaussians for one block of grid points. The layout only
+    depends on the coordinates, so it is built once per grid block
+    (and kept for the whole SCF run by NLNumInt); each feature channel
+    then only writes its angular momentum, exponents and normalization
+    coefficients into the preallocated env buffer with set_channel.
+    If auxmol is given, the environment is concatenated with auxmol
+    (auxmol shells first), so it can be passed to libcint directly.
+    """
+
+    def __init__(self, coords, nchan=1, auxmol=None):
+        """
+        Args:
+            coords (numpy.ndarray): ngrid x 3 coordinates of the
+                feature centers
+            nchan (int): Number of feature channels, each of which
+                has one shell per grid point
+            auxmol (pyscf.gto.Mole, None): Auxiliary molecule
+        """
+        self.coords = numpy.array(coords)
+        self.ngrid = self.coords.shape[0]
+        self.nchan = nchan
+        self.auxmol = auxmol
+        N = self.ngrid
+        fakemol = gto.fakemol_for_charges(self.coords)
+        start = fakemol._env.shape[0] - 2
+        atm = numpy.asarray(fakemol._atm)
+        bas = numpy.tile(numpy.asarray(fakemol._bas), (nchan, 1))
+        env = numpy.zeros(start + 2 * N * nchan)
+        env[:start] = numpy.asarray(fakemol._env)[:-2]
+        for i in range(nchan):
+            # bas[:,5] is the exponent pointer, bas[:,6] the coefficient
+            bas[i*N:(i+1)*N,5] = start + 2 * i * N + numpy.arange(N)
+            bas[i*N:(i+1)*N,6] = start + (2 * i + 1) * N + numpy.arange(N)
+        if auxmol is None:
+            self.nbas_aux = 0
+            self.atm, self.bas, self.env = atm, bas, env
+        else:
+            self.nbas_aux = auxmol.nbas
+            self.atm, self.bas, self.env = conc_env(
+                auxmol._atm, auxmol._bas, auxmol._env, atm, bas, env
+            )
+
+    def matches(self, coords, nchan=1, auxmol=None):
+        """
+        Check whether this template can be reused for the given inputs.
+        """
+        return nchan == self.nchan and auxmol is self.auxmol \
+            and numpy.array_equal(coords, self.coords)
+
+    def channel_slice(self, i):
+        """
+        Shells (in self.bas) of channel i.
+        """
+        sh0 = self.nbas_aux + i * self.ngrid
+        return slice(sh0, sh0 + self.ngrid)
+
+    def set_channel(self, i, l, exps, coeffs):
+        """
+        Write the angular momentum l, exponents and coefficients of
+        channel i into the template.
+        """
+        sl = self.channel_slice(i)
+        self.bas[sl,1] = l
+        self.env[self.bas[sl,5]] = exps
+        self.env[self.bas[sl,6]] = coeffs
+
+    def get_exps(self, i):
+        return self.env[self.bas[self.channel_slice(i),5]]
+
+
 def get_gaussian_grid_c(coords, rho, l=0, s=None, alpha=None,
-                        a0=8.0, fac_mul=0.25, amin=GG_AMIN):
+                        a0=8.0, fac_mul=0.25, amin=GG_AMIN,
+                        template=None):
     """
     Get the molecular environment corresponding to the CIDER feature
     basis.
@@ -101,43 +190,388 @@ def get_gaussian_grid_c(coords, rho, l=0, s=None, alpha=None,
         fac_mul (float): scaling factor for AO component of exponent
         amin (float): exponent below which length-scale is attenuated
             such that the lowest possible exponent is amin * exp(-1)
+        template (CiderGridTemplate, None): Single-channel template
+            for coords without auxmol. If given, the returned arrays
+            are the buffers of the template, which are overwritten by
+            the next call with the same template.
     """
-    N = coords.shape[0]
-    auxmol = gto.fakemol_for_charges(coords)
-    atm = auxmol._atm.copy()
-    bas = auxmol._bas.copy()
-    bas = np.array(bas)
-    start = auxmol._env.shape[0] - 2
-    env = np.zeros(start + 2 * N)
-    env = env.at[:start].set(auxmol._env[:-2])
-    # bas[:,5] = start + np.arange(N)
-    bas = bas.at[:,5].set(start + np.arange(N))
-    # bas[:,6] = start + N + np.arange(N)
-    bas = bas.at[:,6].set(start + N + np.arange(N))
-    ratio = alpha + 5./3 * s**2
+    if template is None:
+        template = CiderGridTemplate(coords)
+    ascale = get_cider_exponent(rho, s, alpha, a0=a0,
+                                fac_mul=fac_mul, amin=amin)
+    logging.debug('GAUSS GRID MIN EXPONENT {}'.format(numpy.sqrt(numpy.min(ascale))))
+    template.set_channel(0, l, ascale, get_cider_coeff(ascale, l, a0))
+    return template.atm, template.bas, template.env
+
+
+# Feature channels of each descriptor version as (l, mul, r2pow) tuples.
+# l is the angular momentum of the feature Gaussian, mul scales a0,
+# fac_mul and amin (and therefore the exponent), and r2pow is the power
+# of r^2 multiplying the feature Gaussian. Channels with r2pow=1 have
+# their coefficients multiplied by the exponent, as in the g0-r^2 feature.
+CIDER_CHANNELS = {
+    'a': ((0, 1.0, 0), (1, 1.0, 0), (2, 1.0, 0),
+          (0, 0.25**(2./3), 0), (0, 4.00**(2./3), 0)),
+    'c': ((0, 1.0, 0), (1, 1.0, 0), (2, 1.0, 0),
+          (0, 1.0, 1), (0, 2.0, 0)),
+}
+
+# Integrals for each power of r^2 (the exponent derivative of a
+# channel with r2pow=n uses the integral for n+1).
+CIDER_INTORS = ('int1e_ovlp', 'int1e_r2_origj', 'int1e_r4_origj')
+
+# Feature channels (indexes into CIDER_CHANNELS[version]) needed by
+# each contracted descriptor of contract_exchange_descriptors.
+DESC_CHANNELS = {
+    0: (), 1: (), 2: (),
+    3: (0,), 4: (1,), 5: (1,), 6: (2,), 7: (2,),
+    8: (1, 2), 9: (1, 2), 10: (3,), 11: (4,),
+}
+
+
+def get_desc_channels(desc_order=None, nchan=5):
+    """
+    Indexes of the feature channels needed to evaluate the contracted
+    descriptors listed in desc_order (e.g. the desc_order of an
+    MLFunctional or DFTGPR). All nchan channels if desc_order is None.
+    """
+    if desc_order is None:
+        return tuple(range(nchan))
+    return tuple(sorted(set(c for d in desc_order
+                            for c in DESC_CHANNELS[int(d)])))
+
 
+@bucket_jit
+def _get_cider_exponent_kernel(rho, s, alpha, a0, fac_mul, amin):
+    ratio = alpha + 5./3 * s**2
     fac = fac_mul * 1.2 * (6 * np.pi**2)**(2.0/3) / np.pi
     a = np.pi * (rho / 2 + 1e-16)**(2.0 / 3)
     scale = a0 + (ratio-1) * fac
-    # bas[:,1] = l
-    bas = bas.at[:, 1].set(l)
     ascale = a * scale
     cond = ascale < amin
-    try:
-        #numpy indexing works
-        ascale[cond] = amin * np.exp(ascale[cond] / amin - 1)
-    except:
-        #for use in jax, must index this way
-        ascale.at[cond].set(amin * np.exp(ascale[cond] / amin - 1))
-    # env[bas[:,5]] = ascale
-    env = env.at[bas[:, 5]].set(ascale)
-    logging.debug('GAUSS GRID MIN EXPONENT {}'.format(np.sqrt(np.min(env[bas[:,5]]))))
-    # env[bas[:,6]] = a0**1.5 * np.sqrt(4 * np.pi**(1-l)) \
-                    # * (8 * np.pi / 3)**(l/3.0) * ascale**(l/2.0)
-    env = env.at[bas[:,6]].set(a0**1.5 * np.sqrt(4 * np.pi**(1-l)) \
-                    * (8 * np.pi / 3)**(l/3.0) * ascale**(l/2.0))
+    # minimum avoids overflow where cond is False
+    return np.where(cond, amin * np.exp(np.minimum(ascale / amin, 1) - 1),
+                    ascale)
 
-    return atm, bas, env
+
+def get_cider_exponent(rho, s, alpha, a0=8.0, fac_mul=0.25, amin=GG_AMIN):
+    """
+    Get the exponents of the CIDER feature Gaussians
+    (see get_gaussian_grid_c for the arguments).
+    Evaluated by a compiled kernel; the result is a numpy array
+    because it is written into the libcint environment.
+    """
+    rho, s, alpha = numpy.broadcast_arrays(
+        *[numpy.asarray(x, dtype=numpy.float64) for x in (rho, s, alpha)]
+    )
+    ascale = _get_cider_exponent_kernel(rho.ravel(), s.ravel(), alpha.ravel(),
+                                        a0, fac_mul, amin)
+    return numpy.asarray(ascale).reshape(rho.shape)
+
+
+def get_cider_coeff(ascale, l, a0=8.0):
+    """
+    Get the normalization coefficients of the CIDER feature
+    Gaussians with exponents ascale and angular momentum l.
+    """
+    return a0**1.5 * numpy.sqrt(4 * numpy.pi**(1-l)) \
+           * (8 * numpy.pi / 3)**(l/3.0) * ascale**(l/2.0)
+
+
+def get_cider_gridmol(coords, rho, s, alpha, channels,
+                      a0=8.0, fac_mul=0.25, amin=GG_AMIN,
+                      template=None):
+    """
+    Get a single molecular environment holding the feature Gaussians
+    of all the given channels, so that every channel can be projected
+    onto the auxiliary basis from one libcint environment.
+    Shells are grouped by r2pow (and then by channel order) so that
+    channels sharing an integral operator are contiguous.
+    Args:
+        coords (numpy.ndarray): ngrid x 3 coordinates for feature centers
+        rho (numpy.ndarray): density
+        s (numpy.ndarray): reduced gradient
+        alpha (numpy.ndarray): iso-orbital indicator
+        channels: sequence of (l, mul, r2pow), see CIDER_CHANNELS
+        a0, fac_mul, amin: see get_gaussian_grid_c
+        template (CiderGridTemplate, None): template with
+            len(channels) channels to fill. Built from coords if None.
+    Returns:
+        template (CiderGridTemplate) and shl_offsets (list of int),
+        the first shell of each channel relative to the first feature
+        shell (the channel occupies ngrid consecutive shells).
+    """
+    N = numpy.asarray(coords).shape[0]
+    nchan = len(channels)
+    if template is None:
+        template = CiderGridTemplate(coords, nchan)
+    order = sorted(range(nchan), key=lambda i: channels[i][2])
+    shl_offsets = [0] * nchan
+    for pos, i in enumerate(order):
+        shl_offsets[i] = pos * N
+        l, mul, r2pow = channels[i]
+        ascale = get_cider_exponent(rho, s, alpha, a0=a0*mul,
+                                    fac_mul=fac_mul*mul, amin=amin*mul)
+        coeff = get_cider_coeff(ascale, l, a0*mul)
+        if r2pow > 0:
+            coeff *= ascale**r2pow
+        template.set_channel(pos, l, ascale, coeff)
+    return template, shl_offsets
+
+
+def get_cider_ovlps(auxmol, coords, rho, s, alpha, channels, deriv=False,
+                    a0=8.0, fac_mul=0.25, amin=GG_AMIN, screen_tol=None,
+                    template=None, return_deriv=False):
+    """
+    Evaluate the overlaps between the auxiliary basis and the
+    feature Gaussians of all channels. The combined environment
+    is concatenated with auxmol once, and libcint is called once for
+    each distinct integral operator (for example, once for version A
+    and twice for version C) over the contiguous block of shells
+    that share that operator.
+    Args:
+        auxmol (pyscf.gto.Mole): Auxiliary molecule
+        coords, rho, s, alpha, channels: see get_cider_gridmol
+        deriv (bool, False): If True, return the exponent derivative
+            integrals (one extra power of r^2) instead.
+        a0, fac_mul, amin: see get_gaussian_grid_c
+        screen_tol (float, None): If not None, skip pairs of grid blocks
+            and auxiliary shells whose estimated overlap is below
+            screen_tol (see get_screened_cider_ovlps) and return
+            BlockSparseMatrix overlaps instead of dense arrays.
+        template (CiderGridTemplate, None): template for coords with
+            len(channels) channels and auxmol. Built if None.
+        return_deriv (bool, False): If True, evaluate both the overlaps
+            and the exponent derivative integrals in one pass, sharing
+            the environment and evaluating channels that need the same
+            integral in the same call (deriv is then ignored).
+    Returns:
+        list of (ngrid * (2l+1), naux) overlap matrices, in channel order.
+        If return_deriv, a second list with the derivative integrals.
+    """
+    N = numpy.asarray(coords).shape[0]
+    if template is None:
+        template = CiderGridTemplate(coords, len(channels), auxmol)
+    template, shl_offsets = get_cider_gridmol(
+        coords, rho, s, alpha, channels, a0=a0, fac_mul=fac_mul, amin=amin,
+        template=template
+    )
+    if screen_tol is not None:
+        if return_deriv:
+            return [get_screened_cider_ovlps(auxmol, coords, channels,
+                                             template, shl_offsets, deriv=d,
+                                             screen_tol=screen_tol)
+                    for d in [False, True]]
+        return get_screened_cider_ovlps(auxmol, coords, channels,
+                                        template, shl_offsets, deriv=deriv,
+                                        screen_tol=screen_tol)
+    nbas = auxmol.nbas
+    derivs = [False, True] if return_deriv else [bool(deriv)]
+    groups = {}
+    for d in derivs:
+        for i, (l, mul, r2pow) in enumerate(channels):
+            groups.setdefault(r2pow + int(d), []).append((d, i))
+    ovlps = {d : [None] * len(channels) for d in derivs}
+    for r2pow, items in groups.items():
+        # Shells are ordered by r2pow, so the channels needing the same
+        # integral (r2pow for values, r2pow-1 for derivatives) are
+        # contiguous and can be evaluated in one call.
+        items = sorted(items, key=lambda item: shl_offsets[item[1]])
+        sh0 = shl_offsets[items[0][1]]
+        sh1 = shl_offsets[items[-1][1]] + N
+        shls_slice = (0, nbas, nbas + sh0, nbas + sh1)
+        # (naux, nfeat in group)
+        ovlp = getints(CIDER_INTORS[r2pow] + '_sph', template.atm,
+                       template.bas, template.env, shls_slice,
+                       comp=1, hermi=0)
+        p0 = 0
+        for d, i in items:
+            p1 = p0 + N * (2 * channels[i][0] + 1)
+            ovlps[d][i] = ovlp[:,p0:p1].T
+            p0 = p1
+    if return_deriv:
+        return ovlps[False], ovlps[True]
+    return ovlps[bool(deriv)]
+
+
+class BlockSparseMatrix():
+    """
+    Sparse matrix stored as a list of dense blocks, used for the
+    screened overlaps between CIDER feature functions and the DF basis.
+    Only supports the products needed for the descriptors and
+    their functional derivatives, i.e. mat.dot(vec) and mat.T.dot(vec),
+    so it can be used in place of a dense numpy array for these.
+    """
+
+    def __init__(self, shape, blocks, transpose=False):
+        """
+        Args:
+            shape (tuple): (nrow, ncol) of the full matrix
+            blocks (list): (r0, c0, block) tuples, where block is
+                the dense (r1 - r0, c1 - c0) matrix at [r0:r1, c0:c1]
+            transpose (bool): If True, the object represents the
+                transpose of the matrix described by shape and blocks.
+        """
+        self._shape = shape
+        self.blocks = blocks
+        self.transpose = transpose
+
+    @property
+    def shape(self):
+        if self.transpose:
+            return self._shape[::-1]
+        return self._shape
+
+    @property
+    def T(self):
+        return BlockSparseMatrix(self._shape, self.blocks,
+                                 transpose=not self.transpose)
+
+    @property
+    def nnz(self):
+        return sum([blk.size for r0, c0, blk in self.blocks])
+
+    def dot(self, vec):
+        vec = numpy.asarray(vec)
+        out = numpy.zeros((self.shape[0],) + vec.shape[1:],
+                          dtype=numpy.result_type(vec, numpy.float64))
+        for r0, c0, blk in self.blocks:
+            r1, c1 = r0 + blk.shape[0], c0 + blk.shape[1]
+            if self.transpose:
+                out[c0:c1] += blk.T.dot(vec[r0:r1])
+            else:
+                out[r0:r1] += blk.dot(vec[c0:c1])
+        return out
+
+    def toarray(self):
+        mat = numpy.zeros(self._shape)
+        for r0, c0, blk in self.blocks:
+            mat[r0:r0+blk.shape[0], c0:c0+blk.shape[1]] = blk
+        if self.transpose:
+            return mat.T
+        return mat
+
+
+def get_point_runs(mask):
+    """
+    (start, stop) pairs of the runs of consecutive True values
+    in the boolean array mask, shape (nrun, 2).
+    """
+    mask = numpy.asarray(mask, dtype=numpy.int8)
+    edges = numpy.flatnonzero(numpy.diff(numpy.concatenate(([0], mask, [0]))))
+    return edges.reshape(-1, 2)
+
+
+def scatter_ovlp_rows(ovlp, runs, nf, N):
+    """
+    Map an overlap matrix evaluated only for the grid points in runs
+    (see get_point_runs) back to all N grid points.
+    Args:
+        ovlp (array or BlockSparseMatrix): (nkept * nf, naux) overlaps,
+            rows ordered by point and then by the nf feature components
+        runs (array): (start, stop) pairs of the kept points
+        nf (int): Number of rows per grid point (2l+1)
+        N (int): Total number of grid points
+    Returns:
+        (N * nf, naux) BlockSparseMatrix with zero rows for the
+        pruned points. The blocks are views of the blocks of ovlp.
+    """
+    if isinstance(ovlp, BlockSparseMatrix):
+        blocks = ovlp.blocks
+    else:
+        blocks = [(0, 0, ovlp)]
+    # row offset of each run in the compact matrix
+    cstarts = numpy.append(0, numpy.cumsum((runs[:,1] - runs[:,0]) * nf))
+    new_blocks = []
+    for r0, c0, blk in blocks:
+        r1 = r0 + blk.shape[0]
+        i0 = numpy.searchsorted(cstarts, r0, side='right') - 1
+        i1 = numpy.searchsorted(cstarts, r1, side='left')
+        for i in range(i0, i1):
+            a, b = max(r0, cstarts[i]), min(r1, cstarts[i+1])
+            if b > a:
+                new_blocks.append((runs[i,0] * nf + a - cstarts[i], c0,
+                                   blk[a-r0:b-r0]))
+    return BlockSparseMatrix((N * nf, ovlp.shape[1]), new_blocks)
+
+
+def get_screened_cider_ovlps(auxmol, coords, channels, template, shl_offsets,
+                             deriv=False, screen_tol=1e-10,
+                             blksize=SCREEN_BLKSIZE, min_gap=SCREEN_MIN_GAP):
+    """
+    Block-sparse version of the overlaps from get_cider_ovlps.
+    The grid is split into blocks of blksize consecutive points
+    (grids from PySCF are ordered so that such blocks are compact in
+    space). For each block and auxiliary shell, the overlap is estimated
+    from the most diffuse feature exponent in the block, the most diffuse
+    primitive of the shell, and the shortest distance R between the
+    shell center and the block:
+        exp(-a b R^2 / (a + b)) * (1 + R^2)^((la + lb) / 2 + r2pow)
+    Integrals are only computed for contiguous runs of auxiliary
+    shells for which this estimate exceeds screen_tol, so the cost
+    of the overlaps and of their products with the density (or with
+    the potential in v_nonlocal) grows roughly linearly with system size.
+    Args:
+        auxmol (pyscf.gto.Mole): Auxiliary molecule
+        coords (numpy.ndarray): ngrid x 3 feature centers
+        channels: see get_cider_gridmol
+        template, shl_offsets: from get_cider_gridmol, the template
+            must include auxmol
+        deriv (bool): see get_cider_ovlps
+        screen_tol (float): screening threshold
+        blksize (int): number of grid points per block
+        min_gap (int): runs of significant shells separated by at most
+            this many shells are evaluated in one call
+    Returns:
+        list of BlockSparseMatrix with shape (ngrid * (2l+1), naux)
+    """
+    coords = numpy.asarray(coords)
+    N = coords.shape[0]
+    nbas = auxmol.nbas
+    naux = auxmol.nao_nr()
+    aux_loc = auxmol.ao_loc_nr()
+    aux_coords = numpy.array([auxmol.bas_coord(ib) for ib in range(nbas)])
+    aux_exps = numpy.array([numpy.min(auxmol.bas_exp(ib))
+                            for ib in range(nbas)])
+    aux_ls = numpy.array([auxmol.bas_angular(ib) for ib in range(nbas)])
+    atmc, basc, envc = template.atm, template.bas, template.env
+    ao_loc = make_loc(basc, 'sph')
+    log_tol = numpy.log(screen_tol)
+    ovlps = []
+    for i, (l, mul, r2pow) in enumerate(channels):
+        intor = CIDER_INTORS[r2pow + int(deriv)] + '_sph'
+        nf = 2 * l + 1
+        off = nbas + shl_offsets[i]
+        exps = envc[basc[off:off+N,5]]
+        # set up once per channel, since many small calls are made
+        cintopt = make_cintopt(atmc, basc, envc, intor)
+        blocks = []
+        for p0 in range(0, N, blksize):
+            p1 = min(p0 + blksize, N)
+            ablk = numpy.min(exps[p0:p1])
+            # (nbas, npts) squared distances, minimized over the block
+            r2 = numpy.min(numpy.sum((aux_coords[:,None,:] \
+                                      - coords[None,p0:p1,:])**2, axis=-1),
+                           axis=1)
+            mu = ablk * aux_exps / (ablk + aux_exps)
+            log_est = -mu * r2 + (0.5 * (l + aux_ls) + r2pow + int(deriv)) \
+                      * numpy.log1p(r2)
+            sig = numpy.append(numpy.append(False, log_est > log_tol), False)
+            starts = numpy.where(sig[1:] & ~sig[:-1])[0]
+            ends = numpy.where(~sig[1:] & sig[:-1])[0]
+            # each call has some overhead, so join runs with short gaps
+            keep = numpy.append(True, starts[1:] - ends[:-1] > min_gap)
+            starts = starts[keep]
+            ends = ends[numpy.append(keep[1:], True)]
+            for b0, b1 in zip(starts, ends):
+                # (naux in run, nfeat in block)
+                blk = getints2c(intor, atmc, basc, envc,
+                                (b0, b1, off + p0, off + p1), comp=1,
+                                hermi=0, ao_loc=ao_loc, cintopt=cintopt)
+                blocks.append((p0 * nf, aux_loc[b0],
+                               numpy.ascontiguousarray(blk.T)))
+        ovlps.append(BlockSparseMatrix((N * nf, naux), blocks))
+    return ovlps
 
 
 
@@ -149,7 +583,9 @@ def get_gaussian_grid_c(coords, rho, l=0, s=None, alpha=None,
 def get_x_helper_full_a(auxmol, rho_data, grid, density,
                         ao_to_aux, deriv=False,
                         return_ovlp=False,
-                        a0=8.0, fac_mul=0.25, amin=GG_AMIN):
+                        a0=8.0, fac_mul=0.25, amin=GG_AMIN,
+                        screen_tol=None, return_deriv=False,
+                        desc_order=None, rho_cutoff=None):
     """
     FOR EVALUATION IN SCF LOOP.
 
@@ -162,7 +598,8 @@ def get_x_helper_full_a(auxmol, rho_data, grid, density,
             gradient, laplacian, and kinetic energy density
         grid: contains coords and weights for real-space grid
         density (numpy.ndarray): Density in DF basis
-        ao_to_aux (numpy.ndarray): nao x nao x naux conversion matrix.
+        ao_to_aux (numpy.ndarray): packed (naux, nao*(nao+1)/2) conversion
+            matrix from get_packed_ao_to_aux.
             TODO Unused variable, can be removed.
         deriv (bool, False): If True, return derivative integrals
             of the descriptors with respect to the exponent. If False,
@@ -170,6 +607,21 @@ def get_x_helper_full_a(auxmol, rho_data, grid, density,
         return_ovlp (bool, False): If True, also return the overlap
             between the DF basis and feature orbitals.
         a0, fac_mul, amin: see get_gaussian_grid_c
+        screen_tol (float, None): If not None, screen negligible
+            feature/DF basis pairs and return sparse overlaps,
+            see get_screened_cider_ovlps.
+        return_deriv (bool, False): If True, return both the descriptors
+            and the derivative integrals (as with deriv=True) from one
+            pass over the feature environment, i.e. desc, desc_r2
+            (and ovlps if return_ovlp).
+        desc_order (list, None): If given, only the feature channels
+            needed for these contracted descriptors (see
+            get_desc_channels) are evaluated. The rows of the other
+            channels are zero and their ovlps are None.
+        rho_cutoff (float, None): If not None, the feature integrals
+            are only evaluated at points with rho >= rho_cutoff. The
+            features of the other points are zero, and their rows of
+            ovlps are zero (ovlps are then BlockSparseMatrix objects).
     """
     # desc[0:6]   = rho_data
     # desc[6:12]  = 0
@@ -180,49 +632,21 @@ def get_x_helper_full_a(auxmol, rho_data, grid, density,
     # desc[22] = g0-2
     # g1 order: x, y, z
     # g2 order: xy, yz, z^2, xz, x^2-y^2
-    lc = get_dft_input2(rho_data)[:3]
-    # size naux
-    integral_name = 'int1e_r2_origj' if deriv else 'int1e_ovlp'
-    desc = rho_data.copy()
-    N = grid.weights.shape[0]
-    if return_ovlp:
-        ovlps = []
-    for l in range(3):
-        atm, bas, env = get_gaussian_grid_c(grid.coords, rho_data[0],
-                                            l=l, s=lc[1], alpha=lc[2],
-                                            a0=a0, fac_mul=fac_mul,
-                                            amin=amin)
-        gridmol = gto.Mole(_atm=atm, _bas=bas, _env=env)
-        # (ngrid * (2l+1), naux)
-        ovlp = gto.mole.intor_cross(integral_name, auxmol, gridmol).T
-        proj = np.dot(ovlp, density).reshape(N, 2*l+1).transpose()
-        desc = np.append(desc, proj, axis=0)
-        if return_ovlp:
-            ovlps.append(ovlp)
-    l = 0
-    for mul in [0.25, 4.00]:
-        atm, bas, env = get_gaussian_grid_c(grid.coords, rho_data[0],
-                                           l=0, s=lc[1], alpha=lc[2],
-                                           a0=a0*mul**(2./3),
-                                           fac_mul=fac_mul*mul**(2./3),
-                                           amin=amin*mul**(2./3))
-        gridmol = gto.Mole(_atm=atm, _bas=bas, _env=env)
-        # (ngrid * (2l+1), naux)
-        ovlp = gto.mole.intor_cross(integral_name, auxmol, gridmol).T
-        proj = np.dot(ovlp, density).reshape(N, 2*l+1).transpose()
-        desc = np.append(desc, proj, axis=0)
-        if return_ovlp:
-            ovlps.append(ovlp)
-    if return_ovlp:
-        return desc, ovlps
-    else:
-        return desc
+    return _get_x_helper_full(auxmol, rho_data, grid, density,
+                              CIDER_CHANNELS['a'], deriv=deriv,
+                              return_ovlp=return_ovlp, a0=a0,
+                              fac_mul=fac_mul, amin=amin,
+                              screen_tol=screen_tol,
+                              return_deriv=return_deriv,
+                              desc_order=desc_order, rho_cutoff=rho_cutoff)
 
 
 def get_x_helper_full_c(auxmol, rho_data, grid, density,
                         ao_to_aux, deriv=False,
                         return_ovlp=False,
-                        a0=8.0, fac_mul=0.25, amin=GG_AMIN):
+                        a0=8.0, fac_mul=0.25, amin=GG_AMIN,
+                        screen_tol=None, return_deriv=False,
+                        desc_order=None, rho_cutoff=None):
     """
     FOR EVALUATION IN SCF LOOP.
 
@@ -238,67 +662,160 @@ def get_x_helper_full_c(auxmol, rho_data, grid, density,
     # desc[16] = g0-r^4
     # g1 order: x, y, z
     # g2 order: xy, yz, z^2, xz, x^2-y^2
+    return _get_x_helper_full(auxmol, rho_data, grid, density,
+                              CIDER_CHANNELS['c'], deriv=deriv,
+                              return_ovlp=return_ovlp, a0=a0,
+                              fac_mul=fac_mul, amin=amin,
+                              screen_tol=screen_tol,
+                              return_deriv=return_deriv,
+                              desc_order=desc_order, rho_cutoff=rho_cutoff)
+
+
+def _get_x_helper_full(auxmol, rho_data, grid, density, channels,
+                       deriv=False, return_ovlp=False,
+                       a0=8.0, fac_mul=0.25, amin=GG_AMIN, screen_tol=None,
+                       return_deriv=False, desc_order=None,
+                       rho_cutoff=None):
+    """
+    Evaluate the raw descriptors for the given feature channels
+    (see CIDER_CHANNELS) with one shared integral environment.
+    Arguments are as in get_x_helper_full_a.
+    """
+    if rho_cutoff is not None:
+        mask = numpy.asarray(rho_data[0]) >= rho_cutoff
+        if not mask.all():
+            return _get_pruned_x_helper_full(
+                auxmol, rho_data, grid, density, channels, mask,
+                deriv=deriv, return_ovlp=return_ovlp, a0=a0,
+                fac_mul=fac_mul, amin=amin, screen_tol=screen_tol,
+                return_deriv=return_deriv, desc_order=desc_order
+            )
     lc = get_dft_input2(rho_data)[:3]
-    # size naux
-    desc = rho_data.copy()
     N = grid.weights.shape[0]
-    integral_name = 'int1e_r2_origj' if deriv else 'int1e_ovlp'
+    chan_idx = get_desc_channels(desc_order, len(channels))
+    used_channels = [channels[i] for i in chan_idx]
+    if len(used_channels) == 0:
+        ovlps = ([], []) if return_deriv else []
+    else:
+        # reuse the feature environment of the grid block if possible
+        template = getattr(grid, 'cider_template', None)
+        if template is None \
+                or not template.matches(grid.coords, len(chan_idx), auxmol):
+            template = CiderGridTemplate(grid.coords, len(chan_idx), auxmol)
+            if isinstance(grid, QuickGrid):
+                grid.cider_template = template
+        # each (ngrid * (2l+1), naux)
+        ovlps = get_cider_ovlps(auxmol, grid.coords, rho_data[0], lc[1],
+                                lc[2], used_channels, deriv=deriv, a0=a0,
+                                fac_mul=fac_mul, amin=amin,
+                                screen_tol=screen_tol, template=template,
+                                return_deriv=return_deriv)
+    def expand(used_ovlps):
+        # None for the channels that are not needed
+        ovlps = [None] * len(channels)
+        for i, ovlp in zip(chan_idx, used_ovlps):
+            ovlps[i] = ovlp
+        return ovlps
+    # ovlp may be dense or a BlockSparseMatrix
+    density = numpy.asarray(density)
+    def project(ovlps):
+        desc = [rho_data]
+        for (l, mul, r2pow), ovlp in zip(channels, ovlps):
+            if ovlp is None:
+                desc.append(np.zeros((2*l+1, N)))
+            else:
+                desc.append(ovlp.dot(density).reshape(N, 2*l+1).transpose())
+        return np.concatenate(desc, axis=0)
+    if return_deriv:
+        ovlps, dovlps = expand(ovlps[0]), expand(ovlps[1])
+        result = (project(ovlps), project(dovlps))
+    else:
+        ovlps = expand(ovlps)
+        result = (project(ovlps),)
     if return_ovlp:
-        ovlps = []
-    for l in range(3):
-        atm, bas, env = get_gaussian_grid_c(grid.coords, rho_data[0],
-                                            l=l, s=lc[1], alpha=lc[2],
-                                            a0=a0, fac_mul=fac_mul,
-                                            amin=amin)
-        gridmol = gto.Mole(_atm=atm, _bas=bas, _env=env)
-        # (ngrid * (2l+1), naux)
-        ovlp = gto.mole.intor_cross(integral_name, auxmol, gridmol).T
-        proj = np.dot(ovlp, density).reshape(N, 2*l+1).transpose()
-        desc = np.append(desc, proj, axis=0)
-        if return_ovlp:
-            ovlps.append(ovlp)
+        return result + (ovlps,)
+    elif len(result) == 1:
+        return result[0]
+    else:
+        return result
 
-    l = 0
-    integral_name = 'int1e_r4_origj' if deriv else 'int1e_r2_origj'
-    atm, bas, env = get_gaussian_grid_c(grid.coords, rho_data[0],
-                                        l=0, s=lc[1], alpha=lc[2],
-                                        a0=a0, fac_mul=fac_mul,
-                                        amin=amin)
-    env[bas[:,6]] *= env[bas[:,5]]
-    gridmol = gto.Mole(_atm=atm, _bas=bas, _env=env)
-    # (ngrid * (2l+1), naux)
-    ovlp = gto.mole.intor_cross(integral_name, auxmol, gridmol).T
-    proj = np.dot(ovlp, density).reshape(N, 2*l+1).transpose()
-    desc = np.append(desc, proj, axis=0)
-    if return_ovlp:
-        ovlps.append(ovlp)
-    
-    integral_name = 'int1e_r2_origj' if deriv else 'int1e_ovlp'
-    atm, bas, env = get_gaussian_grid_c(grid.coords, rho_data[0],
-                                        l=0, s=lc[1], alpha=lc[2],
-                                        a0=a0*2, fac_mul=fac_mul*2,
-                                        amin=amin*2)
-    #env[bas[:,6]] *= env[bas[:,5]]**2
-    gridmol = gto.Mole(_atm=atm, _bas=bas, _env=env)
-    # (ngrid * (2l+1), naux)
-    ovlp = gto.mole.intor_cross(integral_name, auxmol, gridmol).T
-    proj = np.dot(ovlp, density).reshape(N, 2*l+1).transpose()
-    desc = np.append(desc, proj, axis=0)
-    if return_ovlp:
-        ovlps.append(ovlp)
 
+def _get_pruned_x_helper_full(auxmol, rho_data, grid, density, channels,
+                              mask, return_ovlp=False, return_deriv=False,
+                              **kwargs):
+    """
+    _get_x_helper_full evaluated only at the grid points where mask
+    is True, with the results scattered back to the full grid. The
+    raw features of the other points are zero and their overlap
+    rows are zero.
+    """
+    N = mask.size
+    runs = get_point_runs(mask)
+    # keep the pruned feature environment on the grid, so it can be
+    # reused as long as the mask does not change (e.g. in the SCF)
+    sub_grid = QuickGrid(grid.coords[mask], grid.weights[mask],
+                         cider_template=getattr(grid, 'cider_pruned_template',
+                                                None))
+    result = _get_x_helper_full(auxmol, rho_data[:,mask], sub_grid, density,
+                                channels, return_ovlp=True,
+                                return_deriv=return_deriv, **kwargs)
+    if isinstance(grid, QuickGrid):
+        grid.cider_pruned_template = sub_grid.cider_template
+    def scatter(desc):
+        full = numpy.zeros((desc.shape[0], N))
+        full[:6] = rho_data
+        full[6:,mask] = desc[6:]
+        return full
+    ovlps = []
+    for (l, mul, r2pow), ovlp in zip(channels, result[-1]):
+        if ovlp is not None:
+            ovlp = scatter_ovlp_rows(ovlp, runs, 2*l+1, N)
+        ovlps.append(ovlp)
+    result = tuple(scatter(desc) for desc in result[:-1])
     if return_ovlp:
-        return desc, ovlps
+        return result + (ovlps,)
+    elif len(result) == 1:
+        return result[0]
     else:
-        return desc
+        return result
+
+
+def _get_pruned_x_helper(_get_x_helper, rho_cutoff, auxmol, rho_data, ddrho,
+                         coords, rdm1, ao_to_aux, **kwargs):
+    """
+    Evaluate the contracted descriptors of _get_x_helper (_get_x_helper_a
+    or _get_x_helper_c) only at points with rho >= rho_cutoff. The
+    other points get the descriptors of zero feature integrals.
+    """
+    mask = numpy.asarray(rho_data[0]) >= rho_cutoff
+    if mask.all():
+        return _get_x_helper(auxmol, rho_data, ddrho, QuickGrid(coords, None),
+                             rdm1, ao_to_aux, **kwargs)
+    # 6 rho_data rows and 11 feature rows, as for both versions
+    raw = numpy.zeros((17, mask.size - mask.sum()))
+    raw[:6] = rho_data[:,~mask]
+    desc = numpy.zeros((12, mask.size))
+    desc[:,~mask] = contract_exchange_descriptors(raw)
+    if mask.any():
+        desc[:,mask] = _get_x_helper(auxmol, rho_data[:,mask], ddrho[:,mask],
+                                     QuickGrid(coords[mask], None), rdm1,
+                                     ao_to_aux, **kwargs)
+    return desc
 
 
 def _get_x_helper_a(auxmol, rho_data, ddrho, grid, rdm1, ao_to_aux,
-                    a0=8.0, fac_mul=0.25, amin=GG_AMIN, **kwargs):
+                    a0=8.0, fac_mul=0.25, amin=GG_AMIN, density=None,
+                    desc_order=None, rho_cutoff=None, **kwargs):
     """
     FOR EVALUATION IN TRAIN LOOP
 
-    Evaluate Version A descriptors.
+    Evaluate Version A descriptors. If density (the density in
+    the auxiliary basis) is given, it is not recomputed from
+    ao_to_aux and rdm1. If desc_order is given, only the feature
+    channels needed for these contracted descriptors are evaluated
+    and the other descriptors are zero (see get_desc_channels).
+    If rho_cutoff is given, the feature integrals are skipped at
+    points with rho < rho_cutoff, where the features are set to zero.
     """
     # desc[0:6]   = rho_data
     # desc[6:12]  = ddrho
@@ -309,28 +826,44 @@ def _get_x_helper_a(auxmol, rho_data, ddrho, grid, rdm1, ao_to_aux,
     # desc[22] = g0-2
     # g1 order: x, y, z
     # g2 order: xy, yz, z^2, xz, x^2-y^2
+    if density is None:
+        density = contract_ao_to_aux(ao_to_aux, rdm1)
+    if rho_cutoff is not None:
+        return _get_pruned_x_helper(_get_x_helper_a, rho_cutoff, auxmol,
+                                    rho_data, ddrho, grid.coords, rdm1,
+                                    ao_to_aux, a0=a0, fac_mul=fac_mul,
+                                    amin=amin, density=density,
+                                    desc_order=desc_order)
     lc = get_dft_input2(rho_data)[:3]
-    # size naux
-    density = np.einsum('npq,pq->n', ao_to_aux, rdm1)
     desc = rho_data.copy()
-    N = grid.weights.shape[0]
+    N = grid.coords.shape[0]
+    chan_idx = get_desc_channels(desc_order)
+    # feature environment shared by all channels
+    template = CiderGridTemplate(grid.coords)
     for l in range(3):
+        if l not in chan_idx:
+            desc = np.append(desc, np.zeros((2*l+1, N)), axis=0)
+            continue
         atm, bas, env = get_gaussian_grid_c(grid.coords, rho_data[0],
                                             l=l, s=lc[1], alpha=lc[2],
                                             a0=a0, fac_mul=fac_mul,
-                                            amin=amin)
+                                            amin=amin, template=template)
         gridmol = gto.Mole(_atm=atm, _bas=bas, _env=env)
         # (ngrid * (2l+1), naux)
         ovlp = gto.mole.intor_cross('int1e_ovlp', gridmol, auxmol)
         proj = np.dot(ovlp, density).reshape(N, 2*l+1).transpose()
         desc = np.append(desc, proj, axis=0)
     l = 0
-    for mul in [0.25, 4.00]:
+    for i, mul in zip([3, 4], [0.25, 4.00]):
+        if i not in chan_idx:
+            desc = np.append(desc, np.zeros((1, N)), axis=0)
+            continue
         atm, bas, env = get_gaussian_grid_c(grid.coords, rho_data[0],
                                            l=0, s=lc[1], alpha=lc[2],
                                            a0=a0*mul**(2./3),
                                            fac_mul=fac_mul*mul**(2./3),
-                                           amin=amin*mul**(2./3))
+                                           amin=amin*mul**(2./3),
+                                           template=template)
         gridmol = gto.Mole(_atm=atm, _bas=bas, _env=env)
         # (ngrid * (2l+1), naux)
         ovlp = gto.mole.intor_cross('int1e_ovlp', gridmol, auxmol)
@@ -340,11 +873,14 @@ def _get_x_helper_a(auxmol, rho_data, ddrho, grid, rdm1, ao_to_aux,
 
 
 def _get_x_helper_c(auxmol, rho_data, ddrho, grid, rdm1, ao_to_aux,
-                    a0=8.0, fac_mul=0.25, amin=GG_AMIN, coords=None, **kwargs):
+                    a0=8.0, fac_mul=0.25, amin=GG_AMIN, coords=None,
+                    density=None, desc_order=None, rho_cutoff=None,
+                    **kwargs):
     """
     FOR EVALUATION IN TRAIN LOOP
 
-    Evaluate Version C descriptors.
+    Evaluate Version C descriptors. See _get_x_helper_a for density,
+    desc_order and rho_cutoff.
     """
     # desc[0:6] = rho_data
     # desc[6] = g0
@@ -357,18 +893,31 @@ def _get_x_helper_c(auxmol, rho_data, ddrho, grid, rdm1, ao_to_aux,
         COOR = coords
     else:
         COOR = grid.coords
-    lc = get_dft_input2(rho_data)[:3]
     # size naux
-    density = np.einsum('npq,pq->n', ao_to_aux, rdm1)
+    if density is None:
+        density = contract_ao_to_aux(ao_to_aux, rdm1)
+    if rho_cutoff is not None:
+        return _get_pruned_x_helper(_get_x_helper_c, rho_cutoff, auxmol,
+                                    rho_data, ddrho, COOR, rdm1,
+                                    ao_to_aux, a0=a0, fac_mul=fac_mul,
+                                    amin=amin, density=density,
+                                    desc_order=desc_order)
+    lc = get_dft_input2(rho_data)[:3]
     desc = rho_data.copy()
     N = COOR.shape[0]
+    chan_idx = get_desc_channels(desc_order)
+    # feature environment shared by all channels
+    template = CiderGridTemplate(COOR)
     #print('_get_x_helper_c relevant shapes')
     #print(f'density shape = {density.shape}')
     for l in range(3):
+        if l not in chan_idx:
+            desc = np.append(desc, np.zeros((2*l+1, N)), axis=0)
+            continue
         atm, bas, env = get_gaussian_grid_c(COOR, rho_data[0],
                                             l=l, s=lc[1], alpha=lc[2],
                                             a0=a0, fac_mul=fac_mul,
-                                            amin=amin)
+                                            amin=amin, template=template)
         gridmol = gto.Mole(_atm = atm, _bas = bas, _env = env)
         # (ngrid * (2l+1), naux)
         ovlp = gto.mole.intor_cross('int1e_ovlp', gridmol, auxmol)
@@ -380,36 +929,41 @@ def _get_x_helper_c(auxmol, rho_data, ddrho, grid, rdm1, ao_to_aux,
         desc = np.append(desc, proj, axis=0)
     
     l = 0
-    atm, bas, env = get_gaussian_grid_c(COOR, rho_data[0],
-                                        l=0, s=lc[1], alpha=lc[2],
-                                        a0=a0, fac_mul=fac_mul,
-                                        amin=amin)
-    # env[bas[:,6]] *= env[bas[:,5]]
-    env = env.at[bas[:,6]].set(env[bas[:,6]]*env[bas[:,5]])
-    gridmol = gto.Mole(_atm=atm, _bas=bas, _env=env)
-    ovlp = gto.mole.intor_cross('int1e_r2_origj', auxmol, gridmol).T
-    #print('ovlp2 shape: ', ovlp.shape)
-    if ovlp.shape[-1] < rdm1.shape[0]:
-        #print('ovlp2 shape wrong due to padding. extending.')
-        ovlp = np.pad(ovlp, [(0,0), (0, rdm1.shape[0]-ovlp.shape[-1])])
+    if 3 in chan_idx:
+        atm, bas, env = get_gaussian_grid_c(COOR, rho_data[0],
+                                            l=0, s=lc[1], alpha=lc[2],
+                                            a0=a0, fac_mul=fac_mul,
+                                            amin=amin, template=template)
+        env[bas[:,6]] *= env[bas[:,5]]
+        gridmol = gto.Mole(_atm=atm, _bas=bas, _env=env)
+        ovlp = gto.mole.intor_cross('int1e_r2_origj', auxmol, gridmol).T
         #print('ovlp2 shape: ', ovlp.shape)
-    proj = np.dot(ovlp, density).reshape(N, 2*l+1).transpose()
-    desc = np.append(desc, proj, axis=0)
+        if ovlp.shape[-1] < rdm1.shape[0]:
+            #print('ovlp2 shape wrong due to padding. extending.')
+            ovlp = np.pad(ovlp, [(0,0), (0, rdm1.shape[0]-ovlp.shape[-1])])
+            #print('ovlp2 shape: ', ovlp.shape)
+        proj = np.dot(ovlp, density).reshape(N, 2*l+1).transpose()
+        desc = np.append(desc, proj, axis=0)
+    else:
+        desc = np.append(desc, np.zeros((1, N)), axis=0)
     
-    atm, bas, env = get_gaussian_grid_c(COOR, rho_data[0],
-                                        l=0, s=lc[1], alpha=lc[2],
-                                        a0=a0*2, fac_mul=fac_mul*2,
-                                        amin=amin*2)
-    #env[bas[:,6]] *= env[bas[:,5]]**2
-    gridmol = gto.Mole(_atm=atm, _bas=bas, _env=env)
-    ovlp = gto.mole.intor_cross('int1e_ovlp', auxmol, gridmol).T
-    #print('ovlp3 shape: ', ovlp.shape)
-    if ovlp.shape[-1] < rdm1.shape[0]:
-        #print('ovlp3 shape wrong due to padding. extending.')
-        ovlp = np.pad(ovlp, [(0,0), (0, rdm1.shape[0]-ovlp.shape[-1])])
+    if 4 in chan_idx:
+        atm, bas, env = get_gaussian_grid_c(COOR, rho_data[0],
+                                            l=0, s=lc[1], alpha=lc[2],
+                                            a0=a0*2, fac_mul=fac_mul*2,
+                                            amin=amin*2, template=template)
+        #env[bas[:,6]] *= env[bas[:,5]]**2
+        gridmol = gto.Mole(_atm=atm, _bas=bas, _env=env)
+        ovlp = gto.mole.intor_cross('int1e_ovlp', auxmol, gridmol).T
         #print('ovlp3 shape: ', ovlp.shape)
-    proj = np.dot(ovlp, density).reshape(N, 2*l+1).transpose()
-    desc = np.append(desc, proj, axis=0)
+        if ovlp.shape[-1] < rdm1.shape[0]:
+            #print('ovlp3 shape wrong due to padding. extending.')
+            ovlp = np.pad(ovlp, [(0,0), (0, rdm1.shape[0]-ovlp.shape[-1])])
+            #print('ovlp3 shape: ', ovlp.shape)
+        proj = np.dot(ovlp, density).reshape(N, 2*l+1).transpose()
+        desc = np.append(desc, proj, axis=0)
+    else:
+        desc = np.append(desc, np.zeros((1, N)), axis=0)
     
     return contract_exchange_descriptors(desc)
 
@@ -417,6 +971,7 @@ def _get_x_helper_c(auxmol, rho_data, ddrho, grid, rdm1, ao_to_aux,
 def get_exchange_descriptors2(analyzer, restricted=True, version='a', auxbasis=None, 
                               rdm1=None, dm = None, inmol=False, mol=None, ingrid=False, grid=False,
                               coords=None, weights=None,
+                              max_memory=None, out=None,
                               **kwargs):
     """
     A length-21 descriptor containing semi-local information
@@ -425,6 +980,17 @@ def get_exchange_descriptors2(analyzer, restricted=True, version='a', auxbasis=N
     
     Args:
         analyzer (RHFAnalyzer)
+        max_memory (float, None): If not None, memory budget in MB.
+            The grid is then processed in blocks (see
+            get_exchange_descriptors2_blocked) instead of evaluating
+            the AOs and descriptors on the whole grid at once.
+            If None, the blocked evaluation is still used if the
+            analyzer's mem_plan (see memory_plan) chose it.
+        out (array, None): Preallocated output for the blocked
+            evaluation, e.g. a numpy.memmap. Implies blocked evaluation.
+        kwargs: passed to the descriptor helper, e.g. a0, fac_mul,
+            amin and desc_order (only evaluate the integrals needed
+            for these contracted descriptors, see _get_x_helper_a).
 
     Returns 2D numpy array desc:
         desc[0:6]   = rho_data
@@ -450,36 +1016,22 @@ def get_exchange_descriptors2(analyzer, restricted=True, version='a', auxbasis=N
     if not ingrid:
         grid = analyzer.grid
     #auxbasis = df.aug_etb(analyzer.mol, beta=1.6)
-    nao = analyzer.mol.nao_nr()
-    # #print(f"nao in get_exchange_descriptors2: {nao}")
     # auxmol = df.make_auxmol(analyzer.mol, auxbasis=auxbasis)
     auxmol = analyzer.mol
-    naux = auxmol.nao_nr()
-    # #print(f"naux in get_exchange_descriptors2: {naux}")
-    # shape (naux, naux), symmetric
-    aug_J = auxmol.intor('int2c2e')
-    # shape (nao, nao, naux)
-    aux_e2 = df.incore.aux_e2(analyzer.mol, auxmol)
-    ## #print(aux_e2.shape)
-    # shape (naux, nao * nao)
-    aux_e2 = aux_e2.reshape((-1, aux_e2.shape[-1])).T
-    c_and_lower = cho_factor(aug_J)
-    ao_to_aux = cho_solve(c_and_lower, aux_e2)
-    ao_to_aux = ao_to_aux.reshape(naux, nao, nao)
-    #print(f"ao_to_aux shape: {ao_to_aux.shape}")
-    if nao < dm.shape[0]:
-        #print('ao_to_aux wrong shape due to padded inputs. padding')
-        ao_to_aux = np.pad(ao_to_aux, [(0, dm.shape[0]-nao) for i in ao_to_aux.shape])
+    ao_to_aux = get_descriptor_ao_to_aux(analyzer.mol, auxmol, dm)
+    mem_plan = getattr(analyzer, 'mem_plan', None)
+    if max_memory is None and mem_plan is not None\
+            and mem_plan.get_strategy('descriptors') == 'chunked':
+        max_memory = mem_plan.get_max_memory('descriptors')
+    if max_memory is not None or out is not None:
+        return get_exchange_descriptors2_blocked(
+            analyzer, auxmol, ao_to_aux, _get_x_helper, restricted=restricted,
+            dm=dm, mol=mol, grid=grid, coords=coords, weights=weights,
+            max_memory=max_memory, out=out, **kwargs
+        )
     # rho_dat aand rrdho are polarized if calc is unrestricted
-    ao_data, rho_data = get_mgga_data(mol,
-                                      grid,
-                                      dm,
-                                      coords=coords)
-    ddrho = get_rho_second_deriv(mol,
-                                grid,
-                                dm,
-                                ao_data,
-                                weights=weights)
+    rho_data, ddrho, _ = get_rho_tau_data(mol, grid, dm, coords=coords,
+                                          with_tau=False)
 
     if restricted:
         return _get_x_helper(auxmol, rho_data, ddrho, analyzer.grid,
@@ -491,75 +1043,531 @@ def get_exchange_descriptors2(analyzer, restricted=True, version='a', auxbasis=N
                               2*dm[1], ao_to_aux, coords=coords, **kwargs)
         return desc0, desc1
 
-# TODO: Check the math
+def get_packed_ao_to_aux(mol, auxmol):
+    """
+    Get the (naux, nao*(nao+1)/2) matrix converting the lower triangle
+    of a symmetric density matrix of mol to the density fitting
+    coefficients in the auxmol basis (Coulomb metric). Only the unique
+    AO pairs are stored, which halves the memory and the cost of the
+    fitting solve relative to the (naux, nao, nao) tensor. Apply it with
+    contract_ao_to_aux and contract_aux_to_ao.
+    """
+    # shape (naux, naux), symmetric
+    aug_J = auxmol.intor('int2c2e')
+    # shape (nao*(nao+1)/2, naux)
+    aux_e2 = df.incore.aux_e2(mol, auxmol, aosym='s2ij')
+    c_and_lower = cho_factor(aug_J)
+    return cho_solve(c_and_lower, aux_e2.T)
+
+
+def get_packed_nao(ao_to_aux):
+    """
+    Number of AOs nao of a packed (naux, nao*(nao+1)/2) ao_to_aux matrix.
+    """
+    npair = ao_to_aux.shape[-1]
+    nao = int(round((numpy.sqrt(8 * npair + 1) - 1) / 2))
+    assert nao * (nao + 1) // 2 == npair, 'ao_to_aux is not tril-packed'
+    return nao
+
+
+def contract_ao_to_aux(ao_to_aux, dm):
+    """
+    Density fitting coefficients, equivalent to
+    einsum('npq,pq->n', ao_to_aux_full, dm) for the unpacked
+    (naux, nao, nao) matrix. dm may be padded beyond nao, in which
+    case the padding is ignored.
+    Args:
+        ao_to_aux (array): packed (naux, nao*(nao+1)/2) matrix
+            from get_packed_ao_to_aux
+        dm (array): (nao, nao) density matrix
+    Returns:
+        (naux,) array
+    """
+    nao = get_packed_nao(ao_to_aux)
+    dm = dm[:nao,:nao]
+    rows, cols = numpy.tril_indices(nao)
+    # off-diagonal pairs appear twice in the full contraction
+    dm_tril = (dm + dm.T)[rows,cols] * numpy.where(rows == cols, 0.5, 1.0)
+    return np.dot(ao_to_aux, dm_tril)
+
+
+def contract_aux_to_ao(v_aux, ao_to_aux):
+    """
+    Transform a potential on the auxiliary basis to the (nao, nao)
+    AO basis, equivalent to einsum('a,aij->ij', v_aux, ao_to_aux_full)
+    for the unpacked (naux, nao, nao) matrix.
+    Args:
+        v_aux (array): (naux,) derivative with respect to the
+            density fitting coefficients
+        ao_to_aux (array): packed (naux, nao*(nao+1)/2) matrix
+            from get_packed_ao_to_aux
+    Returns:
+        (nao, nao) numpy array
+    """
+    vmol_tril = numpy.dot(numpy.asarray(v_aux), numpy.asarray(ao_to_aux))
+    return lib.unpack_tril(vmol_tril)
+
+
+def get_descriptor_ao_to_aux(mol, auxmol, dm):
+    """
+    Get the packed (naux, nao*(nao+1)/2) matrix converting the density
+    matrix of mol to the density fitting coefficients in the auxmol
+    basis (Coulomb metric), see get_packed_ao_to_aux. If dm is padded,
+    the auxiliary dimension is padded to the shape of dm so that the
+    fitted density matches the padded overlap matrices.
+    """
+    ao_to_aux = get_packed_ao_to_aux(mol, auxmol)
+    naux = ao_to_aux.shape[0]
+    if naux < dm.shape[-1]:
+        ao_to_aux = numpy.pad(ao_to_aux, [(0, dm.shape[-1]-naux), (0, 0)])
+    return ao_to_aux
+
+
+def get_df_coefficients(mol, auxmol, dm):
+    """
+    Coulomb-metric density fitting coefficients of dm in the auxmol
+    basis, the same as contract_ao_to_aux(get_packed_ao_to_aux(mol,
+    auxmol), dm) but with a single right-hand side in the fitting solve.
+    Returns:
+        coeff (naux,) fitting coefficients
+        rhs (naux,) the integrals (P|dm) they are fitted to
+    """
+    # shape (nao*(nao+1)/2, naux)
+    aux_e2 = df.incore.aux_e2(mol, auxmol, aosym='s2ij')
+    rhs = numpy.asarray(contract_ao_to_aux(numpy.asarray(aux_e2).T, dm))
+    coeff = cho_solve(cho_factor(auxmol.intor('int2c2e')), rhs)
+    return coeff, rhs
+
+
+def get_ha_energy_density_df(mol, rdm1, coords, auxbasis=None, ao_vals=None,
+                             jmat=None, max_memory=2000, return_error=False):
+    """
+    Density-fitted alternative to pyscf_utils.get_ha_energy_density.
+    The density is expanded in an auxiliary basis (Coulomb metric, see
+    get_df_coefficients), and the Hartree potential at the grid points
+    is evaluated from the two-center integrals between the auxiliary
+    basis and point charges, which costs O(ngrid * naux) instead of
+    O(ngrid * nao^2) and needs no vele_mat.
+
+    Args:
+        mol (pyscf.gto.Mole)
+        rdm1 (array): (nao, nao) density matrix, or a (2, nao, nao)
+            pair of spin density matrices which are summed
+        coords (array): (ngrid, 3) grid points
+        auxbasis (str or dict, None): fitting basis, by default
+            df.make_auxbasis(mol)
+        ao_vals (array, None): (ngrid, nao) AO values, evaluated
+            block by block if None
+        jmat (array, None): Coulomb matrix of rdm1 (e.g. from get_jk),
+            used to report the exact Hartree energy
+        max_memory (float): memory budget for the grid blocks in MB
+        return_error (bool): Whether to also return the fitting error
+
+    Returns:
+        ha_energy_density (ngrid,), and if return_error a dict with
+        ha_total_df, the Hartree energy of the fitted potential
+        (the integral of ha_energy_density), and if jmat is given,
+        ha_total (exact) and fit_error, the Coulomb norm
+        (rho - rho_fit | rho - rho_fit) = 2 * (ha_total - ha_total_df)
+    """
+    rdm1 = numpy.asarray(rdm1)
+    if rdm1.ndim == 3:
+        rdm1 = rdm1[0] + rdm1[1]
+    nao = mol.nao_nr()
+    # padded basis functions (see get_mgga_data) have no AO values
+    rdm1 = rdm1[:nao,:nao]
+    if auxbasis is None:
+        auxbasis = make_auxbasis(mol)
+    auxmol = make_auxmol(mol, auxbasis)
+    coeff, rhs = get_df_coefficients(mol, auxmol, rdm1)
+    N = coords.shape[0]
+    blksize = max(1, int(max_memory * 1e6 / (8 * (auxmol.nao_nr() + 2 * nao))))
+    vh = numpy.empty(N)
+    rho = numpy.empty(N)
+    for p0 in range(0, N, blksize):
+        p1 = min(N, p0 + blksize)
+        # (naux, nblk)
+        int2c = _np_intor_cross('int2c2e', auxmol,
+                                fakemol_for_charges(coords[p0:p1]))
+        vh[p0:p1] = numpy.dot(coeff, int2c)
+        if ao_vals is None:
+            ao = eval_ao(mol, coords[p0:p1])
+        else:
+            ao = numpy.asarray(ao_vals[p0:p1,:nao])
+        rho[p0:p1] = numpy.einsum('pi,pi->p', numpy.dot(ao, rdm1), ao)
+    ha_energy_density = 0.5 * vh * rho
+    if not return_error:
+        return ha_energy_density
+    error = {'ha_total_df': 0.5 * numpy.dot(coeff, rhs)}
+    if jmat is not None:
+        jmat = numpy.asarray(jmat)
+        if jmat.ndim == 3:
+            jmat = jmat[0] + jmat[1]
+        error['ha_total'] = 0.5 * numpy.sum(jmat[:nao,:nao] * rdm1)
+        error['fit_error'] = 2 * (error['ha_total'] - error['ha_total_df'])
+    return ha_energy_density, error
+
+
+def get_occ_pair_df_coefficients(mol, auxmol, occ_coeff, max_memory=2000):
+    """
+    Coulomb-metric density fitting coefficients of the occupied orbital
+    pair densities phi_i phi_j in the auxmol basis.
+    Returns:
+        (naux, nocc, nocc) array
+    """
+    nocc = occ_coeff.shape[1]
+    naux = auxmol.nao_nr()
+    # shape (nao*(nao+1)/2, naux)
+    aux_e2 = numpy.asarray(df.incore.aux_e2(mol, auxmol, aosym='s2ij'))
+    nao = mol.nao_nr()
+    blksize = max(1, int(max_memory * 1e6 / (8 * 2 * nao * nao)))
+    ints = numpy.empty((naux, nocc, nocc))
+    for p0 in range(0, naux, blksize):
+        p1 = min(naux, p0 + blksize)
+        ints_ao = lib.unpack_tril(aux_e2[:,p0:p1].T)
+        ints_ao = numpy.dot(ints_ao, occ_coeff)
+        ints[p0:p1] = numpy.einsum('pmj,mi->pij', ints_ao, occ_coeff)
+    coeff = cho_solve(cho_factor(auxmol.intor('int2c2e')),
+                      ints.reshape(naux, nocc * nocc))
+    return coeff.reshape(naux, nocc, nocc)
+
+
+def get_fx_energy_density_ri(mol, occ_coeff, occ, coords, auxbasis=None,
+                             mo_vals=None, max_memory=2000):
+    """
+    RI (density-fitted) approximation to the exchange energy density of
+    pyscf_utils.get_fx_energy_density. Each occupied pair density is
+    fitted in an auxiliary basis (see get_occ_pair_df_coefficients),
+    so its Coulomb potential on the grid only needs the two-center
+    integrals between the auxiliary basis and point charges, and the
+    cost per grid point is O(naux * nocc^2) rather than O(nao^2).
+
+    Args:
+        mol (pyscf.gto.Mole)
+        occ_coeff (array): (nao, nocc) occupied MO coefficients
+        occ (array): (nocc,) occupations
+        coords (array): (ngrid, 3) grid points
+        auxbasis (str or dict, None): fitting basis, by default
+            df.make_auxbasis(mol)
+        mo_vals (array, None): (ngrid, nocc) occupied orbital values,
+            evaluated block by block if None
+        max_memory (float): memory budget for the grid blocks in MB
+
+    Returns:
+        (ngrid,) exchange energy density, which is negative
+    """
+    nao = mol.nao_nr()
+    occ_coeff = numpy.asarray(occ_coeff)[:nao]
+    occ = numpy.asarray(occ)
+    nocc = occ_coeff.shape[1]
+    if auxbasis is None:
+        auxbasis = make_auxbasis(mol)
+    auxmol = make_auxmol(mol, auxbasis)
+    naux = auxmol.nao_nr()
+    coeff = get_occ_pair_df_coefficients(mol, auxmol, occ_coeff,
+                                         max_memory=max_memory)
+    coeff = coeff.reshape(naux, nocc * nocc)
+    N = coords.shape[0]
+    blksize = max(1, int(max_memory * 1e6 / (8 * (naux + nocc * nocc + nao))))
+    fx_energy_density = numpy.empty(N)
+    for p0 in range(0, N, blksize):
+        p1 = min(N, p0 + blksize)
+        # (naux, nblk)
+        int2c = _np_intor_cross('int2c2e', auxmol,
+                                fakemol_for_charges(coords[p0:p1]))
+        # potential of each pair density, (nblk, nocc, nocc)
+        vij = numpy.dot(int2c.T, coeff).reshape(-1, nocc, nocc)
+        if mo_vals is None:
+            mo = numpy.dot(eval_ao(mol, coords[p0:p1]), occ_coeff)
+        else:
+            mo = numpy.asarray(mo_vals[p0:p1])
+        A = occ * mo
+        tmp = numpy.einsum('pi,pij->pj', A, vij)
+        fx_energy_density[p0:p1] = -0.25 * numpy.sum(A * tmp, axis=1)
+    return fx_energy_density
+
+
+def get_descriptor_blksize(nao, naux, max_memory, fixed_memory=0):
+    """
+    Number of grid points per block for blocked descriptor
+    evaluation, such that the block work arrays (AOs up to second
+    derivatives and the intermediates of get_rho_tau_data, and the
+    feature overlaps) fit in max_memory MB, after subtracting
+    fixed_memory MB. Always a multiple of BLKSIZE and at least BLKSIZE.
+    """
+    # 10 AO derivative components, 4 dm-contracted AOs and
+    # temporaries, up to 11 feature functions per point
+    bytes_per_point = 8 * (20 * nao + 11 * naux + 64)
+    avail = (max_memory - fixed_memory) * 1e6
+    blksize = int(avail / bytes_per_point) // BLKSIZE * BLKSIZE
+    return max(BLKSIZE, blksize)
+
+
+def iter_exchange_descriptors2(analyzer, auxmol, ao_to_aux, _get_x_helper,
+                               restricted=True, dm=None, mol=None, grid=None,
+                               coords=None, weights=None, max_memory=2000,
+                               gg_settings=None, **kwargs):
+    """
+    Generator over blocks of the grid for get_exchange_descriptors2,
+    yielding (p0, p1, desc) where desc are the descriptors of grid
+    points p0:p1 (a tuple of the two spin parts if not restricted).
+    The AOs (deriv=2) and descriptors are only evaluated for one
+    block at a time, and the density in the auxiliary basis is
+    computed once for all blocks.
+    Args:
+        analyzer, restricted, dm, mol, grid, coords, weights:
+            see get_exchange_descriptors2
+        auxmol (pyscf.gto.Mole): auxiliary basis for the descriptors
+        ao_to_aux (array): from get_descriptor_ao_to_aux
+        _get_x_helper: _get_x_helper_a or _get_x_helper_c
+        max_memory (float): memory budget in MB
+        gg_settings (list, None): If given, a list of dicts of
+            exponent parameters (a0, fac_mul, amin) and desc is a
+            list with the descriptors for each of them. The AOs, the
+            density and its derivatives are shared by all settings.
+        kwargs: passed to _get_x_helper
+    """
+    if coords is None:
+        coords = grid.coords
+    if weights is None:
+        weights = grid.weights
+    N = coords.shape[0]
+    fixed_memory = ao_to_aux.size * 8 / 1e6
+    blksize = get_descriptor_blksize(mol.nao_nr(), auxmol.nao_nr(),
+                                     max_memory, fixed_memory)
+    logging.debug('Descriptor block size {}'.format(blksize))
+    if restricted:
+        densities = [contract_ao_to_aux(ao_to_aux, dm)]
+        dms = [dm]
+    else:
+        densities = [contract_ao_to_aux(ao_to_aux, 2 * dm[s])
+                     for s in range(2)]
+        dms = [2 * dm[0], 2 * dm[1]]
+    for p0 in range(0, N, blksize):
+        p1 = min(N, p0 + blksize)
+        blk_grid = QuickGrid(coords[p0:p1], weights[p0:p1])
+        rho_data, ddrho, _ = get_rho_tau_data(mol, blk_grid, dm,
+                                              with_tau=False,
+                                              max_memory=max_memory)
+        descs = []
+        for gg_kwargs in ([{}] if gg_settings is None else gg_settings):
+            gg_kwargs = dict(kwargs, **gg_kwargs)
+            if restricted:
+                descs.append(_get_x_helper(auxmol, rho_data, ddrho, blk_grid,
+                                           dms[0], ao_to_aux,
+                                           density=densities[0], **gg_kwargs))
+            else:
+                descs.append(tuple(
+                    _get_x_helper(auxmol, 2*rho_data[s], 2*ddrho[s], blk_grid,
+                                  dms[s], ao_to_aux, density=densities[s],
+                                  **gg_kwargs)
+                    for s in range(2)
+                ))
+        yield p0, p1, descs[0] if gg_settings is None else descs
+
+
+def get_exchange_descriptors2_blocked(analyzer, auxmol, ao_to_aux,
+                                      _get_x_helper, restricted=True,
+                                      max_memory=None, out=None, **kwargs):
+    """
+    Blocked version of get_exchange_descriptors2 which writes
+    the descriptors of each block of iter_exchange_descriptors2
+    into out.
+    Args:
+        max_memory (float, None): memory budget in MB, 2000 if None
+        out (array, None): (nfeat, ngrid) output array (a pair of them,
+            or a (2, nfeat, ngrid) array, if not restricted), for example
+            a numpy.memmap for descriptors that do not fit in memory.
+            Allocated on the first block if None.
+        See iter_exchange_descriptors2 for the other arguments.
+    Returns:
+        out (restricted) or (out[0], out[1]) (unrestricted)
+    """
+    if max_memory is None:
+        max_memory = 2000
+    coords = kwargs.get('coords')
+    if coords is None:
+        coords = kwargs['grid'].coords
+    N = coords.shape[0]
+    if restricted and out is not None:
+        out = [out]
+    for p0, p1, desc in iter_exchange_descriptors2(
+            analyzer, auxmol, ao_to_aux, _get_x_helper,
+            restricted=restricted, max_memory=max_memory, **kwargs):
+        if restricted:
+            desc = [desc]
+        if out is None:
+            out = [numpy.empty((d.shape[0], N)) for d in desc]
+        for s, d in enumerate(desc):
+            out[s][:,p0:p1] = d
+    if restricted:
+        return out[0]
+    return out[0], out[1]
+
+
+def get_gg_settings(gg_settings):
+    """
+    Convert a list of (a0, fac_mul, amin) tuples and/or dicts
+    with these keys to a list of dicts.
+    """
+    settings = []
+    for setting in gg_settings:
+        if not isinstance(setting, dict):
+            a0, fac_mul, amin = setting
+            setting = {'a0': a0, 'fac_mul': fac_mul, 'amin': amin}
+        settings.append(dict(setting))
+    return settings
+
+
+def get_exchange_descriptors2_sweep(analyzer, gg_settings, restricted=True,
+                                    version='a', max_memory=None, **kwargs):
+    """
+    Evaluate the descriptors of get_exchange_descriptors2 for several
+    settings of the exponent parameters at once, e.g. to tune a0,
+    fac_mul and amin. The density fitting, AOs, density and density
+    derivatives only depend on the analyzer, so they are computed
+    once (per grid block) and shared by all settings.
+    Args:
+        analyzer (RHFAnalyzer or UHFAnalyzer)
+        gg_settings (list): (a0, fac_mul, amin) tuples or dicts,
+            see get_gg_settings
+        restricted (bool), version (str): see get_exchange_descriptors2
+        max_memory (float, None): memory budget in MB for the work
+            arrays of one grid block (not counting the outputs),
+            2000 if None
+        kwargs: passed to the descriptor helper
+    Returns:
+        list with the output of get_exchange_descriptors2 for
+        each setting, in the order of gg_settings
+    """
+    if version == 'a':
+        _get_x_helper = _get_x_helper_a
+    elif version == 'c':
+        _get_x_helper = _get_x_helper_c
+    else:
+        raise ValueError('unknown descriptor version')
+    if max_memory is None:
+        max_memory = 2000
+    gg_settings = get_gg_settings(gg_settings)
+    dm = analyzer.rdm1
+    mol = analyzer.mol
+    grid = analyzer.grid
+    auxmol = analyzer.mol
+    ao_to_aux = get_descriptor_ao_to_aux(mol, auxmol, dm)
+    N = grid.coords.shape[0]
+    out = None
+    for p0, p1, descs in iter_exchange_descriptors2(
+            analyzer, auxmol, ao_to_aux, _get_x_helper,
+            restricted=restricted, dm=dm, mol=mol, grid=grid,
+            max_memory=max_memory, gg_settings=gg_settings, **kwargs):
+        if restricted:
+            descs = [[desc] for desc in descs]
+        if out is None:
+            out = [[numpy.empty((d.shape[0], N)) for d in desc]
+                   for desc in descs]
+        for i, desc in enumerate(descs):
+            for s, d in enumerate(desc):
+                out[i][s][:,p0:p1] = d
+    if restricted:
+        return [o[0] for o in out]
+    return [(o[0], o[1]) for o in out]
+
+
+def _get_cg21_tensor():
+    """
+    Real coupling tensor C (3, 5, 3) such that the l=1 part of the
+    product of a real l=2 tensor t2 and a real l=1 vector t1 is
+    einsum('amb,m,b->a', C, t2, t1). It is obtained by transforming
+    the complex Clebsch-Gordan coefficients <2 m2; 1 m1 | 1 m> to the
+    real solid harmonic orders used in the descriptors:
+    l=2: xy, yz, z^2, xz, x^2-y^2 and l=1: x, y, z.
+    """
+    r2 = 1 / numpy.sqrt(2)
+    # real l=2 components -> complex m=-2..2
+    u2 = numpy.zeros((5, 5), dtype=numpy.complex128)
+    u2[4,4], u2[4,0] = r2, 1j * r2
+    u2[3,3], u2[3,1] = -r2, -1j * r2
+    u2[2,2] = 1
+    u2[1,3], u2[1,1] = r2, -1j * r2
+    u2[0,4], u2[0,0] = r2, -1j * r2
+    # real l=1 components -> complex m=-1..1
+    u1 = numpy.zeros((3, 3), dtype=numpy.complex128)
+    u1[2,0], u1[2,1] = -r2, -1j * r2
+    u1[1,2] = 1
+    u1[0,0], u1[0,1] = r2, -1j * r2
+    # <2 m2; 1 m1 | 1 m>, indexed [m, m2, m1]
+    cg = numpy.zeros((3, 5, 3))
+    cg[0,0,2], cg[0,1,1], cg[0,2,0] = numpy.sqrt([0.6, 0.3, 0.1]) * [1, -1, 1]
+    cg[1,1,2], cg[1,2,1], cg[1,3,0] = numpy.sqrt([0.3, 0.4, 0.3]) * [1, -1, 1]
+    cg[2,4,0], cg[2,3,1], cg[2,2,2] = numpy.sqrt([0.6, 0.3, 0.1]) * [1, -1, 1]
+    # complex m=-1..1 -> real x, y, z
+    v1 = numpy.array([[r2, 0, -r2], [1j * r2, 0, 1j * r2], [0, 1, 0]])
+    cg21 = numpy.einsum('ak,kmb,mi,bj->aij', v1, cg, u2, u1)
+    assert numpy.abs(cg21.imag).max() < 1e-12
+    return numpy.ascontiguousarray(cg21.real)
+
+# Symmetric in its two l=1 indices, i.e. CG21_TENSOR[a,m,b] == CG21_TENSOR[b,m,a]
+CG21_TENSOR = _get_cg21_tensor()
+
+
 def contract21(t2, t1):
-    # xy, yz, z2, xz, x2-y2
-    # x, y, z
-    t2c = np.zeros(t2.shape, dtype=np.complex128)
-    # t2c[4] = (t2[4] + 1j * t2[0]) / np.sqrt(2) # +2
-    # t2c[3] = (-t2[3] - 1j * t2[1]) / np.sqrt(2) # +1
-    # t2c[2] = t2[2] # 0
-    # t2c[1] = (t2[3] - 1j * t2[1]) / np.sqrt(2) # -1
-    # t2c[0] = (t2[4] - 1j * t2[0]) / np.sqrt(2) # -2
-
-    t2c = t2c.at[4].set((t2[4] + 1j * t2[0]) / np.sqrt(2))
-    t2c = t2c.at[3].set((-t2[3] - 1j * t2[1]) / np.sqrt(2))
-    t2c = t2c.at[2].set(t2[2])
-    t2c = t2c.at[1].set((t2[3] - 1j * t2[1]) / np.sqrt(2))
-    t2c = t2c.at[0].set((t2[4] - 1j * t2[0]) / np.sqrt(2))
-
-    t1c = np.zeros(t1.shape, dtype=np.complex128)
-    # t1c[2] = -(t1[0] + 1j * t1[1]) / np.sqrt(2) # +1
-    # t1c[1] = t1[2] # 0
-    # t1c[0] = (t1[0] - 1j * t1[1]) / np.sqrt(2) # -1
-
-    t1c = t1c.at[2].set(-(t1[0] + 1j * t1[1]) / np.sqrt(2))
-    t1c = t1c.at[1].set(t1[2])
-    t1c = t1c.at[0].set((t1[0] - 1j * t1[1]) / np.sqrt(2))
-
-    res = np.zeros(t1.shape, dtype=np.complex128)
-    # res[0] = np.sqrt(0.6) * t2c[0] * t1c[2]\
-    #          - np.sqrt(0.3) * t2c[1] * t1c[1]\
-    #          + np.sqrt(0.1) * t2c[2] * t1c[0] # -1
-    # res[1] = np.sqrt(0.3) * t2c[1] * t1c[2]\
-    #          - np.sqrt(0.4) * t2c[2] * t1c[1]\
-    #          + np.sqrt(0.3) * t2c[3] * t1c[0]
-    # res[2] = np.sqrt(0.6) * t2c[4] * t1c[0]\
-    #          - np.sqrt(0.3) * t2c[3] * t1c[1]\
-    #          + np.sqrt(0.1) * t2c[2] * t1c[2]
-
-    res = res.at[0].set(np.sqrt(0.6) * t2c[0] * t1c[2]\
-             - np.sqrt(0.3) * t2c[1] * t1c[1]\
-             + np.sqrt(0.1) * t2c[2] * t1c[0])
-    res = res.at[1].set(np.sqrt(0.3) * t2c[1] * t1c[2]\
-             - np.sqrt(0.4) * t2c[2] * t1c[1]\
-             + np.sqrt(0.3) * t2c[3] * t1c[0])
-    res = res.at[2].set(np.sqrt(0.6) * t2c[4] * t1c[0]\
-             - np.sqrt(0.3) * t2c[3] * t1c[1]\
-             + np.sqrt(0.1) * t2c[2] * t1c[2])
-
-    xterm = (res[0] - res[2]) / np.sqrt(2)
-    yterm = 1j * (res[0] + res[2]) / np.sqrt(2)
-    zterm = res[1]
-
-    ## #print ( np.linalg.norm(np.imag(np.array([xterm, yterm, zterm]))) )
-    #assert np.linalg.norm(np.imag(np.array([xterm, yterm, zterm]))) < 1e-7
-
-    return np.real(np.array([xterm, yterm, zterm]))
+    """
+    l=1 part of the product of the l=2 tensor t2 (5, N) and the
+    l=1 vector t1 (3, N), returned as a (3, N) array. Trailing
+    dimensions of t2 and t1 are broadcast.
+    """
+    return np.einsum('amb,m...,b...->a...', CG21_TENSOR, t2, t1)
 
 def contract21_deriv(t1, t1b=None):
+    """
+    Derivative of t1b . contract21(t2, t1) with respect to t2,
+    shape (5, N).
+    """
     if t1b is None:
         t1b = t1
-    tmp = np.identity(5)
-    derivs = np.zeros((5, 3, t1.shape[1]))
-    for i in range(5):
-        derivs[i] = contract21(tmp[i], t1)
-    return np.einsum('map,ap->mp', derivs, t1b)
+    return np.einsum('amb,bp,ap->mp', CG21_TENSOR, t1, t1b)
 
 
+@functools.partial(bucket_jit, static_argnames=('deriv',))
+def get_cider_invariants(svec, g1, g2, deriv=False):
+    """
+    Rotation-invariant contractions of the reduced gradient svec (3, N)
+    and the l=1 and l=2 CIDER features g1 (3, N) and g2 (5, N), i.e.
+    features 4-9 of contract_exchange_descriptors.
+    Returns:
+        inv (6, N): norm(g1)**2, g1 dot svec, norm(g2)**2,
+            svec dot g2 dot svec, g1 dot g2 dot svec, g1 dot g2 dot g1
+        If deriv, also the Jacobians of inv with respect to
+            svec (6, 3, N), g1 (6, 3, N) and g2 (6, 5, N).
+    """
+    # svec . C . g2 and g1 . C . g2, C symmetric in the l=1 indices
+    sgc = contract21(g2, svec)
+    sgg = contract21(g2, g1)
+    inv = np.stack([
+        np.einsum('an,an->n', g1, g1),
+        np.einsum('an,an->n', svec, g1),
+        np.einsum('mn,mn->n', g2, g2) / np.sqrt(5),
+        np.einsum('an,an->n', sgc, svec),
+        np.einsum('an,an->n', sgc, g1),
+        np.einsum('an,an->n', sgg, g1),
+    ])
+    if not deriv:
+        return inv
+    zero1 = np.zeros_like(g1)
+    zero2 = np.zeros_like(g2)
+    dsvec = np.stack([zero1, g1, zero1, 2 * sgc, sgg, zero1])
+    dg1 = np.stack([2 * g1, svec, zero1, zero1, sgc, 2 * sgg])
+    dg2 = np.stack([zero2, zero2, 2 * g2 / np.sqrt(5),
+                    contract21_deriv(svec), contract21_deriv(svec, g1),
+                    contract21_deriv(g1)])
+    return inv, dsvec, dg1, dg2
+
+
+@bucket_jit
 def contract_exchange_descriptors(desc):
     """
     Contract CIDER descriptors into rotation-invariant quantities.
+    Compiled with bucket_jit, so desc is padded to a bucket size.
     """
     # desc[0:6] = rho_data
     # desc[6:7] = g0
@@ -569,59 +1577,19 @@ def contract_exchange_descriptors(desc):
     # g1 order: x, y, z
     # g2 order: xy, yz, z^2, xz, x^2-y^2
 
-    N = desc.shape[1]
-    res = np.zeros((12,N))
-    rho_data = desc[:6]
-
     rho, s, alpha, tau_w, tau_unif = get_dft_input2(desc[:6])
     sprefac = 2 * (3 * np.pi * np.pi)**(1.0/3)
     n43 = rho**(4.0/3)
     svec = desc[1:4] / (sprefac * n43 + 1e-16)
 
-    # res[0] = rho
-    # res[1] = s**2
-    # res[2] = alpha
-    res = res.at[0].set(rho)
-    res = res.at[1].set(s**2)
-    res = res.at[2].set(alpha)
-    # other setup
-    g0 = desc[6]
-    g1 = desc[7:10]
-    g2 = desc[10:15]
-
-    # g1_norm and 1d dot product
-    g1_norm = np.linalg.norm(g1, axis=0)**2
-    dot1 = np.einsum('an,an->n', svec, g1)
-
-    # Clebsch Gordan https://en.wikipedia.org/wiki/Table_of_Clebsch%E2%80%93Gordan_coefficients
-    g2_norm = 0
-    for i in range(5):
-        g2_norm += g2[i] * g2[i]
-    g2_norm /= np.sqrt(5)
-
-    # res[3] = g0
-    # res[4] = g1_norm
-    # res[5] = dot1
-    # res[6] = g2_norm
-    res = res.at[3].set(g0)
-    res = res.at[4].set(g1_norm)
-    res = res.at[5].set(dot1)
-    res = res.at[6].set(g2_norm)
-
-    sgc = contract21(g2, svec)
-    sgg = contract21(g2, g1)
-
-    # res[7] = np.einsum('pn,pn->n', sgc, svec)
-    # res[8] = np.einsum('pn,pn->n', sgc, g1)
-    # res[9] = np.einsum('pn,pn->n', sgg, g1)
-    res = res.at[7].set(np.einsum('pn,pn->n', sgc, svec))
-    res = res.at[8].set(np.einsum('pn,pn->n', sgc, g1))
-    res = res.at[9].set(np.einsum('pn,pn->n', sgg, g1))
-
-    # res[10] = desc[15]
-    # res[11] = desc[16]
-    res = res.at[10].set(desc[15])
-    res = res.at[11].set(desc[16])
+    # features 4-9 are the invariants of g1 (desc[7:10]), g2 (desc[10:15])
+    # and svec, evaluated with the real Clebsch-Gordan tensor
+    inv = get_cider_invariants(svec, desc[7:10], desc[10:15])
+    res = np.concatenate([
+        np.stack([rho, s**2, alpha, desc[6]]),
+        inv,
+        desc[15:17],
+    ])
     # res
     # 0:  rho
     # 1:  s
@@ -28,12 +28,15 @@ from pyscf import df, scf, dft
 
 from mldftdat.density import get_x_helper_full_a, get_x_helper_full_c, LDA_FACTOR,\
                              contract_exchange_descriptors,\
-                             contract21_deriv, contract21
+                             contract21_deriv, contract21,\
+                             CiderGridTemplate, CIDER_CHANNELS,\
+                             get_packed_ao_to_aux, contract_ao_to_aux
+from mldftdat.pyscf_utils import QuickGrid
 from scipy.linalg import cho_factor, cho_solve
 from mldftdat.dft.utils import *
 
 # import numpy as np
-import jax.numpy as np
+from mldftdat.backend import np
 import logging
 import time
 
@@ -70,12 +73,6 @@ def _uks_gga_wv0a(rho, vxc, weight):
     wvb[1:]+= weight * vgrad[:,:,1]
     return wva, wvb
 
-class QuickGrid():
-    def __init__(self, coords, weights):
-        self.coords = coords
-        self.weights = weights
-
-
 ###################################################################
 # Modified versions of PySCF KS potential helper functions that   #
 # include nonlocal CIDER contributions.                           #
@@ -94,9 +91,9 @@ def nr_rks(ni, mol, grids, xc_code, dms, relativity=0, hermi=0,
     density = []
     if nset > 1:
         for idm in range(nset):
-            density.append(np.einsum('npq,pq->n', mol.ao_to_aux, dms[idm]))
+            density.append(contract_ao_to_aux(mol.ao_to_aux, dms[idm]))
     else:
-        density.append(np.einsum('npq,pq->n', mol.ao_to_aux, dms))
+        density.append(contract_ao_to_aux(mol.ao_to_aux, dms))
 
     nelec = np.zeros(nset)
     excsum = np.zeros(nset)
@@ -104,15 +101,18 @@ def nr_rks(ni, mol, grids, xc_code, dms, relativity=0, hermi=0,
     aow = None
 
     ao_deriv = 2
+    ip0 = 0
     for ao, mask, weight, coords \
             in ni.block_loop(mol, grids, nao, ao_deriv, max_memory):
         ngrid = weight.size
+        grid = ni.get_quick_grid(mol, coords, weight, ip0)
+        ip0 += ngrid
         aow = np.ndarray(ao[0].shape, order='F', buffer=aow)
         for idm in range(nset):
             logging.debug('dm shape %s', str(dms.shape))
             rho = make_rho(idm, ao, mask, 'MGGA')
             exc, vxc = ni.eval_xc_cider(
-                xc_code, mol, rho, QuickGrid(coords, weight), density[idm],
+                xc_code, mol, rho, grid, density[idm],
                 0, relativity, 1,
                 verbose=verbose)[:2]
             vrho, vsigma, vlapl, vtau, vgrad, vmol = vxc[:6]
@@ -162,20 +162,23 @@ def nr_uks(ni, mol, grids, xc_code, dms, relativity=0, hermi=0,
     density = []
     if nset > 1:
         for idm in range(nset):
-            density.append((np.einsum('npq,pq->n', mol.ao_to_aux, dma[idm]),\
-                   np.einsum('npq,pq->n', mol.ao_to_aux, dmb[idm])))
+            density.append((contract_ao_to_aux(mol.ao_to_aux, dma[idm]),\
+                   contract_ao_to_aux(mol.ao_to_aux, dmb[idm])))
     else:
-        density = [(np.einsum('npq,pq->n', mol.ao_to_aux, dma),\
-                                   np.einsum('npq,pq->n', mol.ao_to_aux, dmb))]
+        density = [(contract_ao_to_aux(mol.ao_to_aux, dma),\
+                                   contract_ao_to_aux(mol.ao_to_aux, dmb))]
 
     nelec = np.zeros((2,nset))
     excsum = np.zeros(nset)
     vmat = np.zeros((2,nset,nao,nao))
     aow = None
     ao_deriv = 2
+    ip0 = 0
     for ao, mask, weight, coords \
             in ni.block_loop(mol, grids, nao, ao_deriv, max_memory):
         ngrid = weight.size
+        grid = ni.get_quick_grid(mol, coords, weight, ip0)
+        ip0 += ngrid
         aow = np.ndarray(ao[0].shape, order='F', buffer=aow)
         for idm in range(nset):
             logging.debug('dm shape %s %s', str(dma.shape), str(dmb.shape))
@@ -183,7 +186,7 @@ def nr_uks(ni, mol, grids, xc_code, dms, relativity=0, hermi=0,
             rho_b = make_rhob(idm, ao, mask, 'MGGA')
             exc, vxc = ni.eval_xc_cider(
                 xc_code, mol, (rho_a, rho_b),
-                QuickGrid(coords, weight), density[idm],
+                grid, density[idm],
                 1, relativity, 1, verbose=verbose)[:2]
             vrho, vsigma, vlapl, vtau, vgrad, vmol = vxc[:6]
             den = rho_a[0]*weight
@@ -238,11 +241,20 @@ def nr_uks(ni, mol, grids, xc_code, dms, relativity=0, hermi=0,
 
 class NLNumInt(pyscf_numint.NumInt):
 
-    def __init__(self, mlfunc_x, corr_model=None, xmix=1.0):
+    def __init__(self, mlfunc_x, corr_model=None, xmix=1.0,
+                 screen_tol=None, rho_cutoff=None):
         """
         Args:
             mlfunc_x (MLFunctional): Exchange model
             xmix (float): Fraction of CIDER exchange
+            screen_tol (float, None): If not None, overlaps between
+                the CIDER feature functions and the DF basis are
+                screened with this threshold and stored as sparse
+                matrices, see density.get_screened_cider_ovlps.
+            rho_cutoff (float, None): If not None, the CIDER feature
+                integrals are skipped at grid points where the
+                (spin-scaled) density is below rho_cutoff, and the
+                features are zero there, see density.get_x_helper_full_a.
             corr_model (class, None): Optional class to add hyper-GGA
                 correlation model. Must contain a function called xefc1,
                 which takes the following arguments:
@@ -259,6 +271,9 @@ class NLNumInt(pyscf_numint.NumInt):
         self.mlfunc_x = mlfunc_x
         self.mlfunc_x.corr_model = corr_model
         self.mlfunc_x.xmix = xmix
+        self.mlfunc_x.screen_tol = screen_tol
+        self.mlfunc_x.rho_cutoff = rho_cutoff
+        self._cider_templates = {}
         if mlfunc_x.desc_version == 'c':
             mlfunc_x.get_x_helper_full = get_x_helper_full_c
             mlfunc_x.functional_derivative_loop = functional_derivative_loop
@@ -294,6 +309,22 @@ class NLNumInt(pyscf_numint.NumInt):
                 max_memory, verbose
             )
 
+    def get_quick_grid(self, mol, coords, weights, ip0):
+        """
+        Get a QuickGrid for the block of grid points starting at
+        index ip0, with a CiderGridTemplate for its feature functions.
+        The templates are cached by block, so they are built once and
+        reused in every SCF iteration as long as the grid is unchanged.
+        """
+        nchan = len(CIDER_CHANNELS[self.mlfunc_x.desc_version])
+        key = (ip0, coords.shape[0])
+        template = self._cider_templates.get(key)
+        if template is None \
+                or not template.matches(coords, nchan, mol.auxmol):
+            template = CiderGridTemplate(coords, nchan, mol.auxmol)
+            self._cider_templates[key] = template
+        return QuickGrid(coords, weights, cider_template=template)
+
     def rsh_and_hybrid_coeff(self, xc_code, spin=0):
         return 0, 0, 0
 
@@ -306,7 +337,7 @@ class NLNumInt(pyscf_numint.NumInt):
                 mlfunc (MLFunctional): The nonlocal functional object.
                 auxmol (gto.Mole): auxiliary molecule containing the density basis.
                 ao_to_aux(np.array): Matrix to convert atomic orbital basis to auxiliary
-                    basis, shape (naux, nao, nao)
+                    basis, tril-packed with shape (naux, nao*(nao+1)/2)
             rho_data (array (6, N)): The density, gradient, laplacian, and tau
             grid (Grids): The molecular grid
             density: density in auxiliary space
@@ -384,17 +415,16 @@ def _eval_xc_0(mlfunc, mol, rho_data, grid, density, spin=1):
         rho43 = ntup[spin]**(4.0/3)
         rho13 = ntup[spin]**(1.0/3)
         desc[spin] = np.zeros((N, mlfunc.nfeat))
-        raw_desc[spin], ovlps[spin] = mlfunc.get_x_helper_full(
-                                                auxmol, 2 * rho_data[spin], grid,
-                                                density[spin], ao_to_aux,
-                                                return_ovlp=True, a0=mlfunc.a0,
-                                                fac_mul=mlfunc.fac_mul,
-                                                amin=mlfunc.amin)
-        raw_desc_r2[spin] = mlfunc.get_x_helper_full(auxmol, 2 * rho_data[spin], grid,
-                                               density[spin], ao_to_aux,
-                                               deriv=True, a0=mlfunc.a0,
-                                               fac_mul=mlfunc.fac_mul,
-                                               amin=mlfunc.amin)
+        # descriptors, exponent derivatives and overlaps in one pass
+        raw_desc[spin], raw_desc_r2[spin], ovlps[spin] = \
+            mlfunc.get_x_helper_full(auxmol, 2 * rho_data[spin], grid,
+                                     density[spin], ao_to_aux,
+                                     return_ovlp=True, return_deriv=True,
+                                     a0=mlfunc.a0, fac_mul=mlfunc.fac_mul,
+                                     amin=mlfunc.amin,
+                                     screen_tol=mlfunc.screen_tol,
+                                     desc_order=mlfunc.desc_order,
+                                     rho_cutoff=mlfunc.rho_cutoff)
         contracted_desc[spin] = contract_exchange_descriptors(raw_desc[spin])
         contracted_desc[spin] = contracted_desc[spin][mlfunc.desc_order]
         F[spin], dF[spin] = mlfunc.get_F_and_derivative(contracted_desc[spin])
@@ -468,25 +498,18 @@ def _eval_xc_0(mlfunc, mol, rho_data, grid, density, spin=1):
 
 
 def setup_aux(mol):
-    nao = mol.nao_nr()
     auxmol = df.make_auxmol(mol, 'weigend+etb')
     #auxmol = df.make_auxmol(mol, auxbasis)
-    naux = auxmol.nao_nr()
-    # shape (naux, naux), symmetric
-    aug_J = auxmol.intor('int2c2e')
-    # shape (nao, nao, naux)
-    aux_e2 = df.incore.aux_e2(mol, auxmol)
-    aux_e2 = aux_e2.reshape((-1, aux_e2.shape[-1])).T
-    c_and_lower = cho_factor(aug_J)
-    ao_to_aux = cho_solve(c_and_lower, aux_e2)
-    ao_to_aux = ao_to_aux.reshape(naux, nao, nao)
+    # shape (naux, nao*(nao+1)/2), only unique AO pairs are stored
+    ao_to_aux = get_packed_ao_to_aux(mol, auxmol)
 
     return auxmol, ao_to_aux
 
 
 def setup_rks_calc(mol, mlfunc_x, corr_model=None,
                    grid_level=3,
-                   xc=None, xmix=1.0, **kwargs):
+                   xc=None, xmix=1.0, screen_tol=None, rho_cutoff=None,
+                   **kwargs):
     """
     Initialize a PySCF RKS calculation from pyscf.gto.Mole object mol
     and ML exchange model mlfunc_x.
@@ -497,6 +520,10 @@ def setup_rks_calc(mol, mlfunc_x, corr_model=None,
         grid_level (int): PySCF integration grid level for XC
         xc (str): Semi-local exchange-correlation functional to add to CIDER,
         xmix (float): fraction of CIDER exchange
+        screen_tol (float, None): screening threshold for the CIDER
+            feature overlaps, see NLNumInt.__init__
+        rho_cutoff (float, None): density below which the CIDER
+            features are not evaluated, see NLNumInt.__init__
 
     Example:
         For a PBE0-CIDER calculation (i.e. 75% PBE exchange, 25% CIDER
@@ -506,20 +533,23 @@ def setup_rks_calc(mol, mlfunc_x, corr_model=None,
     """
     rks = dft.RKS(mol)
     rks.xc = xc
-    rks._numint = NLNumInt(mlfunc_x, corr_model, xmix)
+    rks._numint = NLNumInt(mlfunc_x, corr_model, xmix,
+                           screen_tol=screen_tol, rho_cutoff=rho_cutoff)
     rks.grids.level = grid_level
     rks.grids.build()
     return rks
 
 def setup_uks_calc(mol, mlfunc_x, corr_model=None,
                    grid_level=3,
-                   xc=None, xmix=1.0, **kwargs):
+                   xc=None, xmix=1.0, screen_tol=None, rho_cutoff=None,
+                   **kwargs):
     """
     Initialize a PySCF UKS calculation, see setup_rks_calc for docs.
     """
     uks = dft.UKS(mol)
     uks.xc = xc
-    uks._numint = NLNumInt(mlfunc_x, corr_model, xmix)
+    uks._numint = NLNumInt(mlfunc_x, corr_model, xmix,
+                           screen_tol=screen_tol, rho_cutoff=rho_cutoff)
     uks.grids.level = grid_level
     uks.grids.build()
     return uks
@@ -1,9 +1,11 @@
-import numpy as np 
 from mldftdat.pyscf_utils import *
+from mldftdat.backend import np
 from mldftdat.workflow_utils import safe_mem_cap_mb
 from pyscf.dft.numint import eval_ao, make_mask
 from mldftdat.density import LDA_FACTOR,\
-                             contract21_deriv, contract21, GG_AMIN
+                             contract21_deriv, contract21, GG_AMIN,\
+                             get_cider_invariants,\
+                             contract_ao_to_aux, contract_aux_to_ao
 
 def dtauw(rho_data):
     return - get_gradient_magnitude(rho_data)**2 / (8 * rho_data[0,:]**2 + 1e-16),\
@@ -124,7 +126,8 @@ def v_nonlocal_general(rho_data, grid, dedg, density, auxmol,
 
     # (ngrid * (2l+1), naux)
     dedb[:,rho<1e-8] = 0
-    dedaux = np.dot((dedb * grid.weights).T.flatten(), ovlp)
+    # ovlp may be dense or a BlockSparseMatrix
+    dedaux = ovlp.T.dot((dedb * grid.weights).T.flatten())
     dgda = l / (2 * a) * g - gr2
     #print(dgda.shape, gr2.shape)
     dgda[:,rho<1e-8] = 0
@@ -178,7 +181,8 @@ def v_nonlocal(rho_data, grid, dedg, density, auxmol,
 
     # (ngrid * (2l+1), naux)
     dedb[:,rho<1e-8] = 0
-    dedaux = np.dot((dedb * grid.weights).T.flatten(), ovlp)
+    # ovlp may be dense or a BlockSparseMatrix
+    dedaux = ovlp.T.dot((dedb * grid.weights).T.flatten())
     dgda = (l + l_add) / (2 * a) * g - gr2
     dgda[:,rho<1e-8] = 0
 
@@ -233,6 +237,13 @@ def functional_derivative_loop(mol, mlfunc, dEddesc,
     v_npa = np.zeros((4, N))
     v_aniso = np.zeros((3, N))
     v_aux = np.zeros(naux)
+    if any(d in [5, 7, 8, 9] for d in mlfunc.desc_order):
+        # Jacobians of features 4-9 with respect to svec, g1 and g2
+        _, dinv_dsvec, dinv_dg1, dinv_dg2 = [
+            np.asarray(x) for x in get_cider_invariants(
+                svec, raw_desc[7:10], raw_desc[10:15], deriv=True
+            )
+        ]
 
     for i, d in enumerate(mlfunc.desc_order):
         if d == 0:
@@ -291,17 +302,16 @@ def functional_derivative_loop(mol, mlfunc, dEddesc,
                 g = raw_desc[7:10]
                 gr2 = raw_desc_r2[7:10]
                 ovlp = ovlps[1]
-                dfmul = svec
-                v_aniso += dEddesc[:,i] * g
+                dfmul = dinv_dg1[1]
+                v_aniso += dEddesc[:,i] * dinv_dsvec[1]
                 l = -1
             elif d == 7:
                 l = -2
                 g = raw_desc[10:15]
                 gr2 = raw_desc_r2[10:15]
                 ovlp = ovlps[2]
-                dfmul = contract21_deriv(svec)
-                ddesc_dsvec = contract21(g, svec)
-                v_aniso += dEddesc[:,i] * 2 * ddesc_dsvec
+                dfmul = dinv_dg2[3]
+                v_aniso += dEddesc[:,i] * dinv_dsvec[3]
             elif d == 8:
                 g2 = raw_desc[10:15]
                 g2r2 = raw_desc_r2[10:15]
@@ -309,10 +319,9 @@ def functional_derivative_loop(mol, mlfunc, dEddesc,
                 g1 = raw_desc[7:10]
                 g1r2 = raw_desc_r2[7:10]
                 ovlp1 = ovlps[1]
-                dfmul = contract21_deriv(svec, g1)
-                ddesc_dsvec = contract21(g2, g1)
-                ddesc_dg1 = contract21(g2, svec)
-                v_aniso += dEddesc[:,i] * ddesc_dsvec
+                dfmul = dinv_dg2[4]
+                ddesc_dg1 = dinv_dg1[4]
+                v_aniso += dEddesc[:,i] * dinv_dsvec[4]
                 vtmp1, dedaux1 = v_nonlocal(rho_data, grid,
                                          dEddesc[:,i] * ddesc_dg1,
                                          density, mol.auxmol, g1,
@@ -330,8 +339,8 @@ def functional_derivative_loop(mol, mlfunc, dEddesc,
                 g1 = raw_desc[7:10]
                 g1r2 = raw_desc_r2[7:10]
                 ovlp1 = ovlps[1]
-                dfmul = contract21_deriv(g1)
-                ddesc_dg1 = 2 * contract21(g2, g1)
+                dfmul = dinv_dg2[5]
+                ddesc_dg1 = dinv_dg1[5]
                 vtmp1, dedaux1 = v_nonlocal(rho_data, grid,
                                          dEddesc[:,i] * ddesc_dg1,
                                          density, mol.auxmol, g1,
@@ -364,7 +373,7 @@ def functional_derivative_loop(mol, mlfunc, dEddesc,
             vtmp = None
             dedaux = None
 
-    vmol = np.einsum('a,aij->ij', v_aux, mol.ao_to_aux)
+    vmol = contract_aux_to_ao(v_aux, mol.ao_to_aux)
     v_nst = v_basis_transform(rho_data, v_npa)
     v_nst[0] += np.einsum('ap,ap->p', -4.0 * svec / (3 * rho_data[0] + 1e-20), v_aniso)
     v_grad = v_aniso / (sprefac * n43 + 1e-20)
@@ -373,7 +382,7 @@ def functional_derivative_loop(mol, mlfunc, dEddesc,
 
 
 def get_density_in_basis(ao_to_aux, rdm1):
-    return np.einsum('npq,pq->n', ao_to_aux, rdm1)
+    return contract_ao_to_aux(ao_to_aux, rdm1)
 
 def arcsinh_deriv(x):
     return 1 / np.sqrt(x * x + 1)
@@ -3,10 +3,13 @@ from pyscf.dft.numint import eval_ao, eval_rho
 from pyscf.dft.gen_grid import Grids
 from pyscf.pbc.tools.pyscf_ase import atoms_from_ase
 from mldftdat.pyscf_utils import *
+from mldftdat.density import get_ha_energy_density_df, get_fx_energy_density_ri
+from mldftdat.memory_plan import plan_analyzer_memory
 import numpy as np
 from abc import ABC, abstractmethod, abstractproperty
 from io import BytesIO
 import psutil
+import h5py
 
 """
 Module for loading, storing, and analyzing PySCF HF/DFT calculations.
@@ -25,6 +28,81 @@ def recursive_remove_none(obj):
     else:
         return obj
 
+# Version of the hdf5 layout written by ElectronAnalyzer.dump, stored
+# in the format_version attribute of the analyzer group.
+#   1: lib.chkfile.dump layout, contiguous float64 data arrays
+#   2: same groups, but the data arrays are chunked along the grid
+#      (grid_axis attribute) and optionally compressed and/or stored
+#      in single precision
+ANALYZER_FORMAT_VERSION = 2
+# grid points per hdf5 chunk of the data arrays
+DUMP_CHUNK_SIZE = 16384
+
+def get_grid_axis(shape, ngrid):
+    """
+    Axis of an analyzer data array that runs over the grid points,
+    e.g. 0 for coords (ngrid, 3) and 1 for rho_data (6, ngrid).
+    None for scalars like ha_total.
+    """
+    if len(shape) > 0 and shape[-1] == ngrid:
+        return len(shape) - 1
+    elif len(shape) > 0 and shape[0] == ngrid:
+        return 0
+    return None
+
+def get_analyzer_format_version(fname):
+    with h5py.File(fname, 'r') as f:
+        return int(f['analyzer'].attrs.get('format_version', 1))
+
+def load_analyzer_data(fname, fields=None, start=None, stop=None):
+    """
+    Read data arrays of an analyzer hdf5 file written by
+    ElectronAnalyzer.dump without loading the analyzer.
+
+    Args:
+        fname (str): Name of the analyzer file
+        fields (list of str): data arrays to read, e.g.
+            ['rho_data', 'weights'], all of them if None
+        start, stop (int): range of grid points to read, all if None.
+            For format version 2 only the hdf5 chunks that overlap
+            the range are read from disk.
+
+    Returns:
+        dict of field name to array, in the dtype it was stored in
+    """
+    with h5py.File(fname, 'r') as f:
+        group = f['analyzer/data']
+        if fields is None:
+            fields = list(group.keys())
+        ngrid = group['weights'].shape[0]
+        data = {}
+        for key in fields:
+            dset = group[key]
+            axis = dset.attrs.get('grid_axis',
+                                  get_grid_axis(dset.shape, ngrid))
+            if axis is None:
+                data[key] = dset[()]
+            else:
+                index = [slice(None)] * dset.ndim
+                index[axis] = slice(start, stop)
+                data[key] = dset[tuple(index)]
+    return data
+
+def _to_double(value):
+    # data arrays dumped in single precision, see ElectronAnalyzer.dump
+    if isinstance(value, np.ndarray) and value.dtype == np.float32:
+        return value.astype(np.float64)
+    return value
+
+def recursive_bytes_to_str(obj):
+    # h5py >= 3 reads string datasets back as bytes
+    if type(obj) == dict:
+        return {k: recursive_bytes_to_str(v) for k, v in obj.items()}
+    elif isinstance(obj, bytes):
+        return obj.decode()
+    else:
+        return obj
+
 
 class ElectronAnalyzer(ABC):
     """
@@ -40,20 +118,34 @@ class ElectronAnalyzer(ABC):
         mol: pyscf.gto.Mole object on which calculation was performed
         conv_tol: convergence tolerance of SCF calculation in Ha
         converged (bool): Whether the PySCF calculation is converged
-        max_mem: Maximum memory chunk size for use in calculating
-            energy density quantities, in MB.
+        max_mem: Memory budget in MB for planning the large arrays
+            (see memory_plan), or None to use safe_mem_cap_mb().
+        direct (bool): Whether the energy densities are computed
+            integral-direct (see get_ee_energy_density_direct).
+        ri (bool): Whether the exchange energy density is computed
+            with RI (see density.get_fx_energy_density_ri).
+        num_threads (int): Number of vele_mat chunks or integral-direct
+            blocks processed concurrently.
+        lazy (bool): Whether the expensive parts of post_process are
+            deferred until their results are first accessed (see load).
 
         ## IN POST PROCESS ##
         grid: pyscf.dft.gen_grid.Grids object onto which distributions
             such as density and exchange energy density are projected
+            (a QuickGrid of the stored coords and weights when loaded)
         e_tot: total energy of the calculation
         mo_coeff: Molecular orbital coefficients for SCF calculation
         mo_occ: Occupations of molecular orbitals
+        occ_coeff, occ: mo_coeff and mo_occ of the occupied (including
+            fractionally occupied) orbitals, per spin if unrestricted
+            (see get_occ_orbitals)
         ao_vals: Atomic orbitals projected onto grid
-        mo_vals: Molecular orbitals projected onto grid
+        mo_vals: Occupied molecular orbitals projected onto grid
+        mem_plan (MemoryPlan): strategies and block sizes of the
+            memory-intensive routines, see plan_memory
         num_chunks (int): Number of chunks for memory-intensive routines
         ao_vele_mat: Projection of the Coulomb repulsion tensor into
-            real space on one side.
+            real space on one side. None if direct.
 
         ## COMPUTABLE DATA ## (initialized to None)
         rho_data (array (6, ngrid)): The density (0),
@@ -68,7 +160,21 @@ class ElectronAnalyzer(ABC):
     calc_class = None
     calc_type = None
 
-    def __init__(self, calc, require_converged=True, max_mem=None):
+    # Parts of post_process that lazy analyzers only run when one of
+    # the attributes they set is first accessed (see __getattr__).
+    _deferred = {
+        'grid': '_setup_grid',
+        'ao_vals': '_setup_orbital_vals',
+        'mo_vals': '_setup_orbital_vals',
+        'mem_plan': '_setup_vele_mat',
+        'num_chunks': '_setup_vele_mat',
+        'direct': '_setup_vele_mat',
+        'ao_vele_mat': '_setup_vele_mat',
+    }
+
+    def __init__(self, calc, require_converged=True, max_mem=None,
+                 direct=False, ri=False, num_threads=None, lazy=False,
+                 grid=None):
         """
         Args:
             calc: A PySCF object of type calc_type
@@ -77,7 +183,31 @@ class ElectronAnalyzer(ABC):
             max_mem: Maximum memory in MB that the class is allowed
                 to use in performing calculations. This is necessary
                 because many routines performed here are memory intensive
-                and must be split into chunks for large systems.
+                and must be split into chunks for large systems. If None,
+                safe_mem_cap_mb() is used. See plan_memory.
+            direct: If True, the Hartree and exchange energy densities
+                are computed integral-direct, one block of grid points
+                at a time, instead of through the (ngrid, nao, nao)
+                vele_mat. It is also used if plan_memory finds that
+                not even small chunks of vele_mat fit in max_mem.
+            ri: If True, the exchange energy density is computed with
+                the RI approximation of get_fx_energy_density_ri, which
+                costs O(naux * nocc^2) per grid point, and mo_vele_mat is
+                not set up. The error in the exchange energy is a few
+                1e-4 Ha with minimal bases and below 1e-4 Ha with the
+                def2 bases; get_fx_energy_density_ri can be used to
+                check it against the exact exchange.
+            num_threads: Number of threads (1 if None) over which the
+                vele_mat chunks, or the blocks of the direct algorithm,
+                are distributed (see pyscf_utils.map_blocks). Each
+                thread holds one chunk, so the chunks are made
+                num_threads times smaller to stay within max_mem.
+            lazy: If True, the grid, ao_vals, mo_vals, vele_mat
+                generators and get_jk are only computed when one of
+                their attributes is first accessed.
+            grid: Grids or QuickGrid to use instead of get_grid(mol),
+                e.g. the stored grid of a loaded analyzer (see
+                from_dict).
         """
         # max_mem in MB
         if not isinstance(calc, self.calc_class):
@@ -91,8 +221,30 @@ class ElectronAnalyzer(ABC):
         self.conv_tol = self.calc.conv_tol
         self.converged = calc.converged
         self.max_mem = max_mem
+        self.direct = direct
+        self.ri = ri
+        self.num_threads = num_threads or 1
+        self.lazy = lazy
+        self.grid = grid
         self.post_process()
 
+    def __getattr__(self, name):
+        # Only called for attributes that are not set, i.e. the stored
+        # data of a lazy analyzer that has not been read yet (see load)
+        # and the deferred parts of post_process.
+        stored_data = self.__dict__.get('_stored_data')
+        if stored_data is not None and name in stored_data:
+            value = _to_double(lib.chkfile.load(stored_data.pop(name),
+                                                'analyzer/data/' + name))
+            setattr(self, name, value)
+            return value
+        if self.__dict__.get('lazy') and name in self._deferred:
+            getattr(self, self._deferred[name])()
+            if name in self.__dict__:
+                return self.__dict__[name]
+        raise AttributeError('{} object has no attribute {}'.format(
+            type(self).__name__, name))
+
     def as_dict(self):
         """
         Save all the propeties of self to a dict.
@@ -123,29 +275,63 @@ class ElectronAnalyzer(ABC):
             'data' : data
         }
 
-    def dump(self, fname):
+    def dump(self, fname, compression=None, dtype=None,
+             chunk_size=DUMP_CHUNK_SIZE):
         """
-        Dump self to an hdf5 file called fname.
+        Dump self to an hdf5 file called fname, in format version
+        ANALYZER_FORMAT_VERSION. The data arrays are chunked along the
+        grid, so that ranges of grid points can be read with
+        load_analyzer_data.
 
         Args:
             fname (str): Name of file to dump to
+            compression (str): hdf5 filter for the data arrays, e.g.
+                'gzip' or 'lzf', None for no compression
+            dtype: type to store the data arrays as, e.g. np.float32 to
+                halve the file size. coords and weights are always
+                stored in double precision, and loading converts
+                single precision arrays back to float64.
+            chunk_size (int): Number of grid points per hdf5 chunk
         """
         h5dict = recursive_remove_none(self.as_dict())
+        data = h5dict.pop('data')
         lib.chkfile.dump(fname, 'analyzer', h5dict)
+        ngrid = data['weights'].shape[0]
+        with h5py.File(fname, 'r+') as f:
+            f['analyzer'].attrs['format_version'] = ANALYZER_FORMAT_VERSION
+            group = f['analyzer'].create_group('data')
+            for key, value in data.items():
+                value = np.asarray(value)
+                axis = get_grid_axis(value.shape, ngrid)
+                if axis is None:
+                    group[key] = value
+                    continue
+                if dtype is not None and key not in ['coords', 'weights']:
+                    value = value.astype(dtype)
+                chunks = list(value.shape)
+                chunks[axis] = min(chunk_size, ngrid)
+                dset = group.create_dataset(
+                    key, data=value, chunks=tuple(chunks),
+                    compression=compression,
+                    shuffle=compression is not None
+                )
+                dset.attrs['grid_axis'] = axis
 
     @classmethod
-    def from_dict(cls, analyzer_dict, max_mem = None):
+    def from_dict(cls, analyzer_dict, max_mem = None, direct = False,
+                  ri = False, num_threads = None, lazy = False):
         """
         Initialize an instance of cls from analyzer_dict, which should be
         generated by the as_dict method.
 
         Args:
             analyzer_dict (dict): dict form of cls
-            max_mem: See __init__
+            max_mem, direct, ri, num_threads, lazy: See __init__
 
         Returns:
             cls instance initialized from analyzer_dict
         """
+        analyzer_dict = recursive_bytes_to_str(analyzer_dict)
         if analyzer_dict['calc_type'] != cls.calc_type:
             raise ValueError('Dict is from wrong type of calc, {} vs {}!'.format(
                                 analyzer_dict['calc_type'], cls.calc_type))
@@ -153,51 +339,81 @@ class ElectronAnalyzer(ABC):
         mol.build()
         calc = cls.calc_class(mol)
         calc.__dict__.update(analyzer_dict['calc'])
-        analyzer = cls(calc, require_converged = False, max_mem = max_mem)
-        analyzer_dict['data'].pop('coords')
-        analyzer_dict['data'].pop('weights')
-        analyzer.__dict__.update(analyzer_dict['data'])
+        # reuse the grid the stored data was computed on
+        grid = None
+        if 'coords' in analyzer_dict['data']:
+            grid = QuickGrid(analyzer_dict['data'].pop('coords'),
+                             analyzer_dict['data'].pop('weights'))
+        analyzer = cls(calc, require_converged = False, max_mem = max_mem,
+                       direct = direct, ri = ri, num_threads = num_threads,
+                       lazy = lazy, grid = grid)
+        analyzer.__dict__.update({k: _to_double(v) for k, v
+                                  in analyzer_dict['data'].items()})
         return analyzer
 
     @classmethod
-    def load(cls, fname, max_mem = None):
+    def load(cls, fname, max_mem = None, direct = False, ri = False,
+             num_threads = None, lazy = False):
         """
         Load instance of cls from hdf5
         Args:
             fname (str): Name of file from which to load
-            max_mem: See __init__
+            max_mem, direct, ri, num_threads: See __init__
+            lazy (bool): If True, only the molecule and SCF data are
+                read. Each stored data array (e.g. rho_data or
+                fx_energy_density) is read from fname when it is first
+                accessed, and the expensive parts of post_process are
+                deferred in the same way (see __init__), so loading
+                many analyzers to use a few stored arrays is fast.
+
+        The grid is a QuickGrid of the stored coords and weights, so
+        it matches the stored data exactly and is not rebuilt.
         """
-        analyzer_dict = lib.chkfile.load(fname, 'analyzer')
-        return cls.from_dict(analyzer_dict, max_mem)
+        version = get_analyzer_format_version(fname)
+        if version > ANALYZER_FORMAT_VERSION:
+            raise ValueError('{} has analyzer format version {}, but only '
+                             'versions up to {} are supported'.format(
+                                fname, version, ANALYZER_FORMAT_VERSION))
+        if not lazy:
+            analyzer_dict = lib.chkfile.load(fname, 'analyzer')
+            return cls.from_dict(analyzer_dict, max_mem, direct, ri,
+                                 num_threads)
+        analyzer_dict = {key: lib.chkfile.load(fname, 'analyzer/' + key)
+                         for key in ['mol', 'calc_type', 'calc']}
+        analyzer_dict['data'] = {}
+        analyzer = cls.from_dict(analyzer_dict, max_mem, direct, ri,
+                                 num_threads, lazy=True)
+        with h5py.File(fname, 'r') as f:
+            keys = list(f['analyzer/data'].keys())
+        for key in keys:
+            analyzer.__dict__.pop(key, None)
+        analyzer._stored_data = {key: fname for key in keys}
+        return analyzer
 
-    def assign_num_chunks(self, ao_vals_shape, ao_vals_dtype):
+    def plan_memory(self):
         """
-        Internal method for assigning the number of chunks into
-        which to split the vele_mat array, which is the (nao, nao, ngrid)
-        shaped matrix projecting the Coulomb repulsion tensor into
-        real space on one side.
-
-        Args:
-            ao_vals_shape: Shape of the ao_vals object
-                (ngrid, nao, ...)
-            ao_vals_dtype: Should be np.float32 or np.float64
+        Internal method that plans the memory of the analyzer with
+        memory_plan.plan_analyzer_memory, within max_mem, or
+        safe_mem_cap_mb() if max_mem is None. Sets mem_plan, the number
+        of chunks into which to split the vele_mat array, which is the
+        (ngrid, nao, nao) shaped matrix projecting the Coulomb repulsion
+        tensor into real space on one side, and sets direct if not even
+        small chunks of vele_mat fit.
 
         Returns:
-            Sets self.num_chunks and also returns it.
+            Sets self.mem_plan and also returns it.
         """
-        if self.max_mem == None:
-            self.num_chunks = 1
-            return self.num_chunks
-
-        if ao_vals_dtype == np.float32:
-            nbytes = 4
-        elif ao_vals_dtype == np.float64:
-            nbytes = 8
-        else:
-            raise ValueError('Wrong dtype for ao_vals')
-        num_mbytes = nbytes * ao_vals_shape[0] * ao_vals_shape[1]**2 // 1000000
-        self.num_chunks = int(num_mbytes // self.max_mem) + 1
-        return self.num_chunks
+        nocc = [c.shape[1] for c in self.occ_coeff] \
+            if isinstance(self.occ_coeff, list) else [self.occ_coeff.shape[1]]
+        self.mem_plan = plan_analyzer_memory(
+            self.mol.nao_nr(), self.grid.coords.shape[0], nocc,
+            max_mem=self.max_mem, nspin=len(nocc),
+            num_threads=self.num_threads
+        )
+        self.num_chunks = self.mem_plan.num_chunks
+        if self.mem_plan.get_strategy('ee') == 'direct':
+            self.direct = True
+        return self.mem_plan
 
     def post_process(self):
         """
@@ -210,19 +426,16 @@ class ElectronAnalyzer(ABC):
         by subclasses to add more data that can be calcualted.
         """
         # The child post process function must set up the RDMs
-        self.grid = get_grid(self.mol)
-
         self.e_tot = self.calc.e_tot
         self.mo_coeff = self.calc.mo_coeff
         self.mo_occ = self.calc.mo_occ
+        # only the occupied orbitals contribute to the exchange
+        self.occ_coeff, self.occ = get_occ_orbitals(self.mo_coeff, self.mo_occ)
         ###self.mo_energy = self.calc.mo_energy
-        self.ao_vals = get_ao_vals(self.mol, self.grid.coords)
-        self.mo_vals = get_mo_vals(self.ao_vals, self.mo_coeff)
-
-        self.assign_num_chunks(self.ao_vals.shape, self.ao_vals.dtype)
-
-        self.ao_vele_mat = get_vele_mat_generator(self.mol, self.grid.coords,
-                                                  self.num_chunks)
+        if not self.lazy:
+            self._setup_grid()
+            self._setup_orbital_vals()
+            self._setup_vele_mat()
 
         self.rdm1 = None
         self.rdm2 = None
@@ -237,6 +450,47 @@ class ElectronAnalyzer(ABC):
         self.fx_energy_density = None
         self.xc_energy_density = None
         self.ee_energy_density = None
+        self.ha_energy_density_df = None
+        self.ha_df_error = None
+        self.fx_energy_density_ri = None
+        self.fx_ri_error = None
+
+        if self.lazy:
+            # the values passed to __init__, see _setup_grid and
+            # _setup_vele_mat
+            self._requested_grid = self.grid
+            self._requested_direct = self.direct
+            for name in self._deferred:
+                self.__dict__.pop(name, None)
+
+    def _setup_grid(self):
+        if 'grid' not in self.__dict__:
+            self.grid = self._requested_grid
+        stored_data = self.__dict__.get('_stored_data') or {}
+        if self.grid is None and 'coords' in stored_data:
+            # lazily loaded, see load
+            self.grid = QuickGrid(
+                lib.chkfile.load(stored_data.pop('coords'),
+                                 'analyzer/data/coords'),
+                lib.chkfile.load(stored_data.pop('weights'),
+                                 'analyzer/data/weights'))
+        elif self.grid is None:
+            self.grid = get_grid(self.mol)
+
+    def _setup_orbital_vals(self):
+        self.ao_vals = get_ao_vals(self.mol, self.grid.coords)
+        self.mo_vals = get_mo_vals(self.ao_vals, self.occ_coeff)
+
+    def _setup_vele_mat(self):
+        if 'direct' not in self.__dict__:
+            self.direct = self._requested_direct
+        self.plan_memory()
+        if self.direct:
+            self.ao_vele_mat = None
+        else:
+            self.ao_vele_mat = get_vele_mat_generator(self.mol, self.grid.coords,
+                                                      self.num_chunks,
+                                                      num_threads=self.num_threads)
 
     def get_ao_rho_data(self):
         """
@@ -251,19 +505,66 @@ class ElectronAnalyzer(ABC):
                 of the system.
         """
         if self.rho_data is None or self.tau_data is None:
-            ao_data, self.rho_data = get_mgga_data(
-                                        self.mol, self.grid, self.rdm1)
-            self.tau_data = get_tau_and_grad(self.mol, self.grid,
-                                            self.rdm1, ao_data)
+            self.rho_data, _, self.tau_data = get_rho_tau_data(
+                self.mol, self.grid, self.rdm1, with_ddrho=False,
+                max_memory=self.mem_plan.get_max_memory('density'))
         return self.rho_data, self.tau_data
 
+    def get_ha_energy_density_df(self, auxbasis=None):
+        """
+        Density-fitted Hartree energy density (see
+        density.get_ha_energy_density_df), which does not need the
+        vele matrix. Also sets ha_df_error, a dict with the fitted and
+        exact Hartree energies and the Coulomb-norm fitting error, plus
+        the max and integrated absolute deviations from
+        ha_energy_density if that has already been computed.
+        """
+        if self.ha_energy_density_df is None:
+            self.ha_energy_density_df, self.ha_df_error = \
+                get_ha_energy_density_df(
+                    self.mol, self.rdm1, self.grid.coords, auxbasis=auxbasis,
+                    jmat=self.jmat, max_memory=self.mem_plan.get_max_memory('ee'),
+                    return_error=True
+                )
+            if self.ha_energy_density is not None:
+                diff = np.abs(self.ha_energy_density_df
+                              - self.ha_energy_density)
+                self.ha_df_error['max_abs_error'] = np.max(diff)
+                self.ha_df_error['int_abs_error'] = np.dot(diff, self.grid.weights)
+        return self.ha_energy_density_df
+
+    def get_fx_energy_density_ri(self, auxbasis=None):
+        """
+        RI exchange energy density (see density.get_fx_energy_density_ri).
+        Also sets fx_ri_error, a dict with the exact exchange energy,
+        the integral of the RI exchange energy density and their
+        difference, plus the max and integrated absolute deviations from
+        the exact fx_energy_density if that has already been computed.
+        """
+        if self.fx_energy_density_ri is None:
+            fx_ri = sum(self._get_fx_energy_density_ri(auxbasis))
+            weights = self.grid.weights
+            self.fx_energy_density_ri = fx_ri
+            self.fx_ri_error = {
+                'fx_total': self.fx_total,
+                'fx_total_ri': np.dot(fx_ri, weights),
+            }
+            self.fx_ri_error['total_error'] = self.fx_ri_error['fx_total_ri']\
+                                              - self.fx_total
+            if self.fx_energy_density is not None and not self.ri:
+                diff = np.abs(fx_ri - self.fx_energy_density)
+                self.fx_ri_error['max_abs_error'] = np.max(diff)
+                self.fx_ri_error['int_abs_error'] = np.dot(diff, weights)
+        return self.fx_energy_density_ri
+
     def perform_full_analysis(self):
         """
         Perform all the main distribution calculations provided by this analyzer.
         Overridden by subclasses to compute additional data.
         """
         self.get_ao_rho_data()
-        self.get_ha_energy_density()
+        # computes the Hartree and exchange energy densities in one pass
+        # over the vele_mat chunks (see get_ee_energy_density)
         self.get_ee_energy_density()
 
 
@@ -287,7 +588,8 @@ class RHFAnalyzer(ElectronAnalyzer):
             1-particle Hamiltonian
         ha_total, fx_total: Direct and exchange Coulomb energies of the
             Slater determinant
-        mo_vele_mat: Same as ao_vele_mat but in molecular orbital basis
+        mo_vele_mat: Same as ao_vele_mat but in the basis of the occupied
+            molecular orbitals. None if direct or ri.
 
         ## COMPUTABLE DATA ## (initialized to None)
         ha_energy_density: Classical Hartree energy density on grid
@@ -298,6 +600,11 @@ class RHFAnalyzer(ElectronAnalyzer):
     calc_class = scf.hf.RHF
     calc_type = 'RHF'
 
+    _deferred = dict(ElectronAnalyzer._deferred,
+                     jmat='_setup_jk', kmat='_setup_jk',
+                     ha_total='_setup_jk', fx_total='_setup_jk',
+                     mo_vele_mat='_setup_mo_vele_mat')
+
     def as_dict(self):
         analyzer_dict = super(RHFAnalyzer, self).as_dict()
         analyzer_dict['calc']['mo_energy'] = self.mo_energy
@@ -307,18 +614,69 @@ class RHFAnalyzer(ElectronAnalyzer):
         super(RHFAnalyzer, self).post_process()
         self.rdm1 = np.array(self.calc.make_rdm1())
         self.mo_energy = self.calc.mo_energy
+        if not self.lazy:
+            self._setup_jk()
+            self._setup_mo_vele_mat()
+
+    def _setup_jk(self):
         self.jmat, self.kmat = scf.hf.get_jk(self.mol, self.rdm1)
         self.ha_total, self.fx_total = get_hf_coul_ex_total2(self.rdm1,
                                                     self.jmat, self.kmat)
-        self.mo_vele_mat = get_vele_mat_generator(self.mol, self.grid.coords,
-                                            self.num_chunks, self.mo_coeff)
+
+    def _setup_mo_vele_mat(self):
+        if self.direct or self.ri:
+            self.mo_vele_mat = None
+        else:
+            self.mo_vele_mat = get_vele_mat_generator(self.mol, self.grid.coords,
+                                                self.num_chunks, self.occ_coeff,
+                                                self.num_threads)
+
+    def _get_ee_energy_density_direct(self):
+        """
+        Compute the Hartree and exchange energy densities together
+        with get_ee_energy_density_direct, which shares the integrals
+        between them. In ri mode only the Hartree energy density
+        is computed.
+        """
+        fx_dms = None if self.ri else \
+            [scf.hf.make_rdm1(self.occ_coeff, self.occ)]
+        self.ha_energy_density, fx_energy_density = \
+            get_ee_energy_density_direct(
+                self.mol, self.grid.coords, self.rdm1, fx_dms,
+                max_memory=self.mem_plan.get_max_memory('ee'), num_threads=self.num_threads
+            )
+        if fx_energy_density is not None:
+            self.fx_energy_density = fx_energy_density[0]
+
+    def _get_ee_energy_density_chunks(self):
+        """
+        Compute the Hartree and exchange energy densities with
+        get_ee_energy_density_chunks, which shares the vele_mat
+        chunks between them.
+        """
+        self.ha_energy_density, fx_energy_density = \
+            get_ee_energy_density_chunks(
+                self.mol, self.grid.coords, self.num_chunks, self.rdm1,
+                self.ao_vals, [self.occ_coeff], [self.occ], [self.mo_vals],
+                num_threads=self.num_threads
+            )
+        self.fx_energy_density = fx_energy_density[0]
+
+    def _get_fx_energy_density_ri(self, auxbasis=None):
+        return [get_fx_energy_density_ri(
+            self.mol, self.occ_coeff, self.occ, self.grid.coords,
+            auxbasis=auxbasis, mo_vals=self.mo_vals,
+            max_memory=self.mem_plan.get_max_memory('ee')
+        )]
 
     def get_ha_energy_density(self):
         """
         Return the classical Hartree energy density
         e_{Ha} (r_1) = (1/2) \int dr_2 n(r_1) n(r_2) / |r_1 - r_2|.
         """
-        if self.ha_energy_density is None:
+        if self.ha_energy_density is None and self.direct:
+            self._get_ee_energy_density_direct()
+        elif self.ha_energy_density is None:
             self.ha_energy_density = get_ha_energy_density2(
                                     self.mol, self.rdm1,
                                     self.ao_vele_mat, self.ao_vals
@@ -330,9 +688,13 @@ class RHFAnalyzer(ElectronAnalyzer):
         Return the HF exchange energy density
         e_X (r_1) = -(1/2) \int dr_2 |n_1(r_1, r_2)|^2 / |r_1 - r_2|.
         """
-        if self.fx_energy_density is None:
+        if self.fx_energy_density is None and self.ri:
+            self.fx_energy_density = self._get_fx_energy_density_ri()[0]
+        elif self.fx_energy_density is None and self.direct:
+            self._get_ee_energy_density_direct()
+        elif self.fx_energy_density is None:
             self.fx_energy_density = get_fx_energy_density2(
-                                    self.mol, self.mo_occ,
+                                    self.mol, self.occ,
                                     self.mo_vele_mat, self.mo_vals
                                     )
         return self.fx_energy_density
@@ -340,8 +702,12 @@ class RHFAnalyzer(ElectronAnalyzer):
     def get_ee_energy_density(self):
         """
         Returns the sum of E_{Ha} and E_{X}, i.e. the Coulomb repulsion
-        energy of the HF or KS Slater determinant.
+        energy of the HF or KS Slater determinant. If neither is computed
+        yet, both are computed in one pass over the vele_mat chunks.
         """
+        if self.ha_energy_density is None and self.fx_energy_density is None\
+                and not (self.direct or self.ri):
+            self._get_ee_energy_density_chunks()
         if self.ee_energy_density is None:
             self.ee_energy_density = self.get_ha_energy_density()\
                                      + self.get_fx_energy_density()
@@ -368,7 +734,8 @@ class UHFAnalyzer(ElectronAnalyzer):
             1-particle Hamiltonian
         ha_total, fx_total: Direct and exchange Coulomb energies of the
             Slater determinant
-        mo_vele_mat: Same as ao_vele_mat but in molecular orbital basis
+        mo_vele_mat: Same as ao_vele_mat but in the basis of the occupied
+            molecular orbitals. None if direct or ri.
 
         ## COMPUTABLE DATA ## (initialized to None)
         ha_energy_density: Classical Hartree energy density on grid
@@ -380,6 +747,11 @@ class UHFAnalyzer(ElectronAnalyzer):
     calc_class = scf.uhf.UHF
     calc_type = 'UHF'
 
+    _deferred = dict(ElectronAnalyzer._deferred,
+                     jmat='_setup_jk', kmat='_setup_jk',
+                     ha_total='_setup_jk', fx_total='_setup_jk',
+                     mo_vele_mat='_setup_mo_vele_mat')
+
     def as_dict(self):
         analyzer_dict = super(UHFAnalyzer, self).as_dict()
         analyzer_dict['calc']['mo_energy'] = self.mo_energy
@@ -393,20 +765,79 @@ class UHFAnalyzer(ElectronAnalyzer):
         self.mo_energy = self.calc.mo_energy
         self.fx_energy_density_u = None
         self.fx_energy_density_d = None
+        if not self.lazy:
+            self._setup_jk()
+            self._setup_mo_vele_mat()
+
+    def _setup_jk(self):
         self.jmat, self.kmat = scf.hf.get_jk(self.mol, self.rdm1)
         self.ha_total, self.fx_total = get_hf_coul_ex_total2(self.rdm1,
                                                     self.jmat, self.kmat)
-        self.mo_vele_mat = [get_vele_mat_generator(self.mol, self.grid.coords,
-                                            self.num_chunks, self.mo_coeff[0]),\
-                            get_vele_mat_generator(self.mol, self.grid.coords,
-                                            self.num_chunks, self.mo_coeff[1])]
+
+    def _setup_mo_vele_mat(self):
+        if self.direct or self.ri:
+            self.mo_vele_mat = None
+        else:
+            self.mo_vele_mat = [get_vele_mat_generator(self.mol, self.grid.coords,
+                                                self.num_chunks, self.occ_coeff[0],
+                                                self.num_threads),\
+                                get_vele_mat_generator(self.mol, self.grid.coords,
+                                                self.num_chunks, self.occ_coeff[1],
+                                                self.num_threads)]
+
+    def _get_ee_energy_density_direct(self):
+        """
+        Compute the Hartree and exchange energy densities together
+        with get_ee_energy_density_direct, which shares the integrals
+        between them. In ri mode only the Hartree energy density
+        is computed.
+        """
+        fx_dms = None if self.ri else \
+            [scf.hf.make_rdm1(self.occ_coeff[s], 2 * self.occ[s])
+             for s in range(2)]
+        self.ha_energy_density, fx_energy_density = \
+            get_ee_energy_density_direct(
+                self.mol, self.grid.coords, np.sum(self.rdm1, axis=0),
+                fx_dms, max_memory=self.mem_plan.get_max_memory('ee'),
+                num_threads=self.num_threads
+            )
+        if fx_energy_density is not None:
+            self.fx_energy_density_u = 0.5 * fx_energy_density[0]
+            self.fx_energy_density_d = 0.5 * fx_energy_density[1]
+            self.fx_energy_density = self.fx_energy_density_u + self.fx_energy_density_d
+
+    def _get_ee_energy_density_chunks(self):
+        """
+        Compute the Hartree and both exchange energy densities with
+        get_ee_energy_density_chunks, which shares the vele_mat
+        chunks between them.
+        """
+        self.ha_energy_density, fx_energy_density = \
+            get_ee_energy_density_chunks(
+                self.mol, self.grid.coords, self.num_chunks,
+                np.sum(self.rdm1, axis=0), self.ao_vals, self.occ_coeff,
+                [2 * self.occ[0], 2 * self.occ[1]], self.mo_vals,
+                num_threads=self.num_threads
+            )
+        self.fx_energy_density_u = 0.5 * fx_energy_density[0]
+        self.fx_energy_density_d = 0.5 * fx_energy_density[1]
+        self.fx_energy_density = self.fx_energy_density_u + self.fx_energy_density_d
+
+    def _get_fx_energy_density_ri(self, auxbasis=None):
+        return [0.5 * get_fx_energy_density_ri(
+            self.mol, self.occ_coeff[s], 2 * self.occ[s], self.grid.coords,
+            auxbasis=auxbasis, mo_vals=self.mo_vals[s],
+            max_memory=self.mem_plan.get_max_memory('ee')
+        ) for s in range(2)]
 
     def get_ha_energy_density(self):
         """
         Return the classical Hartree energy density
         e_{Ha} (r_1) = (1/2) \int dr_2 n(r_1) n(r_2) / |r_1 - r_2|.
         """
-        if self.ha_energy_density is None:
+        if self.ha_energy_density is None and self.direct:
+            self._get_ee_energy_density_direct()
+        elif self.ha_energy_density is None:
             self.ha_energy_density = get_ha_energy_density2(
                                     self.mol, np.sum(self.rdm1, axis=0),
                                     self.ao_vele_mat, self.ao_vals
@@ -420,13 +851,19 @@ class UHFAnalyzer(ElectronAnalyzer):
         Saves the spin-separated contributions, which can be accessed
         directly.
         """
-        if self.fx_energy_density is None:
+        if self.fx_energy_density is None and self.ri:
+            self.fx_energy_density_u, self.fx_energy_density_d = \
+                self._get_fx_energy_density_ri()
+            self.fx_energy_density = self.fx_energy_density_u + self.fx_energy_density_d
+        elif self.fx_energy_density is None and self.direct:
+            self._get_ee_energy_density_direct()
+        elif self.fx_energy_density is None:
             self.fx_energy_density_u = 0.5 * get_fx_energy_density2(
-                                        self.mol, 2 * self.mo_occ[0],
+                                        self.mol, 2 * self.occ[0],
                                         self.mo_vele_mat[0], self.mo_vals[0]
                                         )
             self.fx_energy_density_d = 0.5 * get_fx_energy_density2(
-                                        self.mol, 2 * self.mo_occ[1],
+                                        self.mol, 2 * self.occ[1],
                                         self.mo_vele_mat[1], self.mo_vals[1]
                                         )
             self.fx_energy_density = self.fx_energy_density_u + self.fx_energy_density_d
@@ -435,8 +872,12 @@ class UHFAnalyzer(ElectronAnalyzer):
     def get_ee_energy_density(self):
         """
         Returns the sum of E_{Ha} and E_{X}, i.e. the Coulomb repulsion
-        energy of the HF or KS Slater determinant.
+        energy of the HF or KS Slater determinant. If neither is computed
+        yet, both are computed in one pass over the vele_mat chunks.
         """
+        if self.ha_energy_density is None and self.fx_energy_density is None\
+                and not (self.direct or self.ri):
+            self._get_ee_energy_density_chunks()
         if self.ee_energy_density is None:
             self.ee_energy_density = self.get_ha_energy_density()\
                                      + self.get_fx_energy_density()
@@ -448,7 +889,9 @@ class RKSAnalyzer(RHFAnalyzer):
     Same as RHFAnalyzer, but input must be an RKS object.
     """
 
-    def __init__(self, calc, require_converged=True, max_mem=None):
+    def __init__(self, calc, require_converged=True, max_mem=None,
+                 direct=False, ri=False, num_threads=None, lazy=False,
+                 grid=None):
         if type(calc) != dft.rks.RKS:
             raise ValueError('Calculation must be RKS.')
         self.dft = calc
@@ -458,7 +901,9 @@ class RKSAnalyzer(RHFAnalyzer):
         hf.mo_occ = self.dft.mo_occ
         hf.mo_energy = self.dft.mo_energy
         hf.converged = self.dft.converged
-        super(RKSAnalyzer, self).__init__(hf, require_converged, max_mem)
+        super(RKSAnalyzer, self).__init__(hf, require_converged, max_mem,
+                                          direct, ri, num_threads, lazy,
+                                          grid)
 
 
 class UKSAnalyzer(UHFAnalyzer):
@@ -466,7 +911,9 @@ class UKSAnalyzer(UHFAnalyzer):
     Same as UHFAnalyzer, but input must be an RKS object.
     """
 
-    def __init__(self, calc, require_converged=True, max_mem=None):
+    def __init__(self, calc, require_converged=True, max_mem=None,
+                 direct=False, ri=False, num_threads=None, lazy=False,
+                 grid=None):
         if type(calc) != dft.uks.UKS:
             raise ValueError('Calculation must be UKS.')
         self.dft = calc
@@ -476,4 +923,6 @@ class UKSAnalyzer(UHFAnalyzer):
         hf.mo_occ = self.dft.mo_occ
         hf.mo_energy = self.dft.mo_energy
         hf.converged = self.dft.converged
-        super(UKSAnalyzer, self).__init__(hf, require_converged, max_mem)
+        super(UKSAnalyzer, self).__init__(hf, require_converged, max_mem,
+                                          direct, ri, num_threads, lazy,
+                                          grid)
@@ -0,0 +1,191 @@
+"""
+Memory planning for the analyzers and the descriptor evaluation.
+
+plan_analyzer_memory estimates the size of every large array an
+analyzer and get_exchange_descriptors2 create for a given molecule,
+grid and basis, and splits the memory budget (max_mem, or
+workflow_utils.safe_mem_cap_mb() if None) between them. The arrays
+that the analyzer keeps for its whole lifetime (ao_vals, mo_vals and
+the density data) are subtracted from the budget, and the rest is
+given to each stage in turn, which picks a strategy:
+
+    incore:  the whole stage fits at once
+    chunked: the grid is processed in chunks/blocks that fit
+    direct:  (ee stage only) not even a BLKSIZE chunk of vele_mat per
+             thread fits, so the energy densities are computed
+             integral-direct (see get_ee_energy_density_direct)
+
+The plan is stored on the analyzer as mem_plan and can be logged with
+MemoryPlan.log, e.g.
+
+    analyzer = RHFAnalyzer(calc, max_mem=4000)
+    analyzer.mem_plan.log()
+"""
+
+import logging
+from mldftdat.workflow_utils import safe_mem_cap_mb
+from pyscf.dft.gen_grid import BLKSIZE
+from mldftdat.pyscf_utils import get_density_blksize, get_direct_blksize
+from mldftdat.density import get_descriptor_blksize
+
+# rows of get_exchange_descriptors2 per spin
+NUM_DESCRIPTORS = 21
+
+
+def estimate_array_sizes(nao, ngrid, nocc, naux=None, nspin=1,
+                         ndesc=NUM_DESCRIPTORS, itemsize=8):
+    """
+    Sizes in MB of the large arrays of an analyzer and of the
+    descriptor evaluation.
+
+    Args:
+        nao (int): number of AOs
+        ngrid (int): number of grid points
+        nocc (list of int): number of occupied orbitals of each spin
+        naux (int, None): auxiliary basis size of the descriptors,
+            nao if None
+        nspin (int): 1 for restricted, 2 for unrestricted
+        ndesc (int): number of descriptors per spin
+        itemsize (int): bytes per array element
+
+    Returns:
+        dict of array name to size in MB
+    """
+    if naux is None:
+        naux = nao
+    mb = itemsize / 1e6
+    return {
+        'ao_vals': mb * ngrid * nao,
+        'mo_vals': mb * ngrid * sum(nocc),
+        # rho_data (6), ddrho (6) and tau_data (4)
+        'rho_data': mb * nspin * 16 * ngrid,
+        # deriv=3 AOs of get_mgga_data
+        'ao_data': mb * 20 * ngrid * nao,
+        'vele_mat': mb * ngrid * nao * nao,
+        'mo_vele_mat': mb * ngrid * sum(n * n for n in nocc),
+        'ao_to_aux': mb * naux * (nao * (nao + 1) // 2),
+        'descriptors': mb * nspin * ndesc * ngrid,
+    }
+
+
+class MemoryPlan():
+    """
+    Memory budget, array size estimates and per-stage strategies
+    from plan_analyzer_memory.
+
+    Attributes:
+        max_mem (float): total budget in MB
+        sizes (dict): estimated array sizes in MB, see
+            estimate_array_sizes
+        resident (float): MB held by the analyzer for its lifetime
+        stages (dict): for each stage ('ee', 'density', 'descriptors'),
+            a dict with the strategy, the max_memory in MB given to
+            the stage, and num_chunks or blksize
+    """
+
+    def __init__(self, max_mem, sizes, resident, stages):
+        self.max_mem = max_mem
+        self.sizes = sizes
+        self.resident = resident
+        self.stages = stages
+
+    @property
+    def num_chunks(self):
+        return self.stages['ee'].get('num_chunks', 1)
+
+    def get_strategy(self, stage):
+        return self.stages[stage]['strategy']
+
+    def get_max_memory(self, stage):
+        return self.stages[stage]['max_memory']
+
+    def as_dict(self):
+        return {
+            'max_mem': self.max_mem,
+            'sizes': dict(self.sizes),
+            'resident': self.resident,
+            'stages': {k: dict(v) for k, v in self.stages.items()},
+        }
+
+    def __str__(self):
+        lines = ['Memory plan: budget {:.1f} MB, resident {:.1f} MB'.format(
+            self.max_mem, self.resident)]
+        for name, size in self.sizes.items():
+            lines.append('  {:<12s} {:12.1f} MB'.format(name, size))
+        for name, stage in self.stages.items():
+            opts = ', '.join('{}={}'.format(k, v) for k, v in stage.items()
+                             if k != 'strategy')
+            lines.append('  stage {:<12s} {:<8s} {}'.format(
+                name, stage['strategy'], opts))
+        return '\n'.join(lines)
+
+    def log(self, logger=None, level=logging.INFO):
+        (logger or logging).log(level, str(self))
+
+
+def plan_analyzer_memory(nao, ngrid, nocc, max_mem=None, naux=None,
+                         nspin=1, num_threads=1, ndesc=NUM_DESCRIPTORS,
+                         itemsize=8):
+    """
+    Pick strategies and chunk/block sizes for the Hartree and exchange
+    energy densities ('ee'), the density and its derivatives ('density')
+    and the exchange descriptors ('descriptors') within max_mem MB.
+
+    Args:
+        nao, ngrid, nocc, naux, nspin, ndesc, itemsize:
+            see estimate_array_sizes
+        max_mem (float, None): budget in MB, safe_mem_cap_mb() if None
+        num_threads (int): number of vele_mat chunks held at once,
+            see pyscf_utils.map_blocks
+
+    Returns:
+        MemoryPlan
+    """
+    if max_mem is None:
+        max_mem = safe_mem_cap_mb()
+    num_threads = num_threads or 1
+    sizes = estimate_array_sizes(nao, ngrid, nocc, naux=naux, nspin=nspin,
+                                 ndesc=ndesc, itemsize=itemsize)
+    resident = sizes['ao_vals'] + sizes['mo_vals'] + sizes['rho_data']
+    avail = max_mem - resident
+    if avail < 0.1 * max_mem:
+        logging.warning('Analyzer arrays (%.1f MB) leave less than 10%% '
+                        'of max_mem (%.1f MB) for work arrays',
+                        resident, max_mem)
+        avail = 0.1 * max_mem
+    stages = {}
+
+    ee_mem = sizes['vele_mat'] + sizes['mo_vele_mat']
+    if ee_mem <= avail:
+        # the lowmem analyzers still split the grid between the threads
+        stages['ee'] = {'strategy': 'incore', 'max_memory': avail,
+                        'num_chunks': num_threads}
+    else:
+        # vele_mat and mo_vele_mat of one chunk per thread
+        mb_per_point = ee_mem / ngrid
+        chunk_size = int(avail / mb_per_point / num_threads)
+        if chunk_size >= BLKSIZE:
+            num_chunks = max(-(-ngrid // chunk_size), num_threads)
+            stages['ee'] = {'strategy': 'chunked', 'max_memory': avail,
+                            'num_chunks': num_chunks}
+        else:
+            stages['ee'] = {'strategy': 'direct', 'max_memory': avail,
+                            'blksize': get_direct_blksize(nao, avail,
+                                                          num_threads)}
+
+    blksize = get_density_blksize(nao, avail)
+    stages['density'] = {
+        'strategy': 'incore' if blksize >= ngrid else 'chunked',
+        'max_memory': avail, 'blksize': min(blksize, ngrid)
+    }
+
+    if naux is None:
+        naux = nao
+    # ao_to_aux and the output are held during the whole evaluation
+    fixed_memory = sizes['ao_to_aux'] + sizes['descriptors']
+    blksize = get_descriptor_blksize(nao, naux, avail, fixed_memory)
+    stages['descriptors'] = {
+        'strategy': 'incore' if blksize >= ngrid else 'chunked',
+        'max_memory': avail, 'blksize': min(blksize, ngrid)
+    }
+    return MemoryPlan(max_mem, sizes, resident, stages)
@@ -1,13 +1,17 @@
 from pyscf import scf, dft, gto, ao2mo, df, lib, cc
 # from pyscf.dft.numint import eval_ao, eval_rho
-from pyscfad.dft.numint import eval_rho
+from pyscfad.dft.numint import eval_rho as _ad_eval_rho
 from pyscf.dft.numint import eval_ao
+from pyscf.dft.numint import eval_rho as _np_eval_rho
 
-from pyscf.dft.gen_grid import Grids
+from pyscf.dft.gen_grid import Grids, make_mask, BLKSIZE
 from pyscf.pbc.tools.pyscf_ase import atoms_from_ase
 
 # import numpy as np
-import jax.numpy as np
+import jax
+import numpy
+from mldftdat.backend import np, is_jax_backend
+import functools
 import logging
 
 
@@ -148,6 +152,27 @@ def get_grid(mol, level=3):
     grid.kernel()
     return grid
 
+def eval_rho(*args, **kwargs):
+    """
+    eval_rho of pyscfad for the jax backend and of pyscf for the
+    numpy backend (see mldftdat.backend).
+    """
+    if is_jax_backend():
+        return _ad_eval_rho(*args, **kwargs)
+    return _np_eval_rho(*args, **kwargs)
+
+class QuickGrid():
+    """
+    Lightweight stand-in for a pyscf Grids object holding only
+    coords and weights, e.g. for one block of a larger grid.
+    cider_template can hold a density.CiderGridTemplate for the
+    coordinates, so the CIDER feature environment is only built once.
+    """
+    def __init__(self, coords, weights, cider_template=None):
+        self.coords = coords
+        self.weights = weights
+        self.cider_template = cider_template
+
 def get_ha_total(rdm1, eeint):
     return np.sum(np.sum(eeint * rdm1, axis=(2,3)) * rdm1)
 
@@ -276,9 +301,18 @@ def get_tau_and_grad(mol, grid, rdm1, ao_data):
         return np.array([get_tau_and_grad_helper(mol, grid, rdm1[0], ao_data),\
                         get_tau_and_grad_helper(mol, grid, rdm1[1], ao_data)])
 
-def get_rho_second_deriv_helper(mol, grid, dm, ao, weights=None):
-    from pyscfad.dft.numint import _contract_rho, _dot_ao_dm
-    from pyscf.dft.gen_grid import make_mask, BLKSIZE
+def get_rho_second_deriv_helper(mol, grid, dm, ao, weights=None,
+                                coords=None):
+    """
+    Second derivatives of the density (xx, xy, xz, yy, yz, zz) from
+    the AOs up to second derivatives. The shells that are negligible
+    in each BLKSIZE block of grid.coords (or coords) are screened
+    with make_mask, as in pyscf's numint.
+    """
+    if is_jax_backend():
+        from pyscfad.dft.numint import _contract_rho, _dot_ao_dm
+    else:
+        from pyscf.dft.numint import _contract_rho, _dot_ao_dm
     if weights is not None:
         WEIGHT = weights
     else:
@@ -290,36 +324,142 @@ def get_rho_second_deriv_helper(mol, grid, dm, ao, weights=None):
         #print('nao generated from mol incorrect due to padding. changing')
         nao = dm.shape[0]
     N = WEIGHT.shape[0]
-    non0tab = np.ones(((N+BLKSIZE-1)//BLKSIZE, mol.nbas),
-                         dtype=np.uint8)
+    if coords is None and grid is not None:
+        coords = grid.coords
+    if coords is not None and coords.shape[0] == N:
+        non0tab = make_mask(mol, coords)
+    else:
+        non0tab = numpy.ones(((N+BLKSIZE-1)//BLKSIZE, mol.nbas),
+                             dtype=numpy.uint8)
     shls_slice = (0, mol.nbas)
     ao_loc = mol.ao_loc_nr()
     c0 = _dot_ao_dm(mol, ao[0], dm, non0tab, shls_slice, ao_loc)
-    c1 = np.zeros((3, N, nao))
     # 0 1 2 3 4  5  6  7  8  9
     # 0 x y z xx xy xz yy yz zz
     # - - - - 0  1  2  3  4  5
     # - - - - 11 12 13 22 23 33
-    ddrho = np.zeros((6, N))
     alphas = [0, 0, 0, 1, 1, 2]
     betas =  [0, 1, 2, 1, 2, 2]
-    for i in range(3):
-        # c1[i] = _dot_ao_dm(mol, ao[i+1], dm.T, non0tab, shls_slice, ao_loc)
-        c1 = c1.at[i].set(_dot_ao_dm(mol, ao[i+1], dm.T, non0tab, shls_slice, ao_loc))
+    c1 = [_dot_ao_dm(mol, ao[i+1], dm.T, non0tab, shls_slice, ao_loc)
+          for i in range(3)]
+    ddrho = []
     for i in range(6):
         term1 = _contract_rho(c0, ao[i + 4])
         term2 = _contract_rho(c1[alphas[i]], ao[betas[i]+1])
         total = term1 + term2
-        # ddrho[i] = total + total.conj()
-        ddrho = ddrho.at[i].set(total + total.conj())
-    return ddrho
+        ddrho.append(total + total.conj())
+    # one stack instead of a copy per component
+    return np.stack(ddrho)
 
-def get_rho_second_deriv(mol, grid, rdm1, ao_data, weights=None):
+def get_rho_second_deriv(mol, grid, rdm1, ao_data, weights=None,
+                         coords=None):
     if len(rdm1.shape) == 2:
-        return get_rho_second_deriv_helper(mol, grid, rdm1, ao_data, weights)
+        return get_rho_second_deriv_helper(mol, grid, rdm1, ao_data, weights,
+                                           coords)
     else:
-        return np.array([get_rho_second_deriv_helper(mol, grid, rdm1[0], ao_data, weights),\
-                        get_rho_second_deriv_helper(mol, grid, rdm1[1], ao_data, weights)])
+        return np.array([get_rho_second_deriv_helper(mol, grid, rdm1[0], ao_data, weights, coords),\
+                        get_rho_second_deriv_helper(mol, grid, rdm1[1], ao_data, weights, coords)])
+
+# index of the second derivative d_a d_b in eval_ao(deriv=2) output,
+# D2_IDX[a][b] for a, b in x, y, z
+D2_IDX = [[4, 5, 6], [5, 7, 8], [6, 8, 9]]
+
+def get_density_blksize(nao, max_memory):
+    """
+    Number of grid points per block for get_rho_tau_data such that
+    the AOs up to second derivatives, the dm-contracted AOs and
+    temporaries fit in max_memory MB. Always a multiple of BLKSIZE.
+    """
+    # 10 AO derivative components, 4 dm-contracted AOs, 6 temporaries
+    bytes_per_point = 8 * 20 * nao
+    blksize = int(max_memory * 1e6 / bytes_per_point) // BLKSIZE * BLKSIZE
+    return max(BLKSIZE, blksize)
+
+def _get_rho_tau_data_block(mol, ao, dm, non0tab, with_ddrho, with_tau):
+    # c[i] = ao[i] @ dm for the value and first derivatives,
+    # shared by all the quantities below. dm must be symmetric.
+    if is_jax_backend():
+        c = np.dot(ao[:4], dm)
+    else:
+        from pyscf.dft.numint import _dot_ao_dm
+        shls_slice = (0, mol.nbas)
+        ao_loc = mol.ao_loc_nr()
+        c = np.stack([_dot_ao_dm(mol, ao[i], dm, non0tab, shls_slice, ao_loc)
+                      for i in range(4)])
+    rho = np.einsum('pn,pn->p', c[0], ao[0])
+    grad = 2 * np.einsum('pn,ipn->ip', c[0], ao[1:4])
+    # (3, 3, ngrid) first derivative products d_a phi dm d_b phi
+    c1ao1 = np.einsum('apn,bpn->abp', c[1:4], ao[1:4])
+    tau = 0.5 * (c1ao1[0,0] + c1ao1[1,1] + c1ao1[2,2])
+    # (6, ngrid) phi dm d_a d_b phi, components xx xy xz yy yz zz
+    c0ao2 = np.einsum('pn,ipn->ip', c[0], ao[4:10])
+    lapl = 2 * (c0ao2[0] + c0ao2[3] + c0ao2[5]) + 4 * tau
+    rho_data = np.concatenate([rho[None], grad, lapl[None], tau[None]])
+    ddrho = None
+    if with_ddrho:
+        alphas = [0, 0, 0, 1, 1, 2]
+        betas =  [0, 1, 2, 1, 2, 2]
+        ddrho = 2 * (c0ao2 + c1ao1[alphas, betas])
+    tau_data = None
+    if with_tau:
+        dtau = [sum(np.einsum('pn,pn->p', c[i+1], ao[D2_IDX[i][a]])
+                    for i in range(3))
+                for a in range(3)]
+        tau_data = np.stack([tau] + dtau)
+    return rho_data, ddrho, tau_data
+
+def get_rho_tau_data(mol, grid, rdm1, coords=None, with_ddrho=True,
+                     with_tau=True, max_memory=2000):
+    """
+    Fused evaluation of rho_data (as from get_mgga_data), ddrho
+    (as from get_rho_second_deriv) and tau_data (as from
+    get_tau_and_grad). The AOs are evaluated in blocks of grid points,
+    only up to second derivatives (which is all that the tau
+    gradient needs), skipping the shells that are negligible in each
+    BLKSIZE block of points (make_mask), and the products of the density matrix with the
+    AOs and their first derivatives are computed once per block and
+    shared by all three quantities (and, if rdm1 is a pair of spin
+    density matrices, the AOs are shared by both spins).
+    Args:
+        mol (pyscf.gto.Mole)
+        grid (Grids): only its coords are used, unless coords is given
+        rdm1 (array): symmetric (nao, nao) density matrix, or a
+            (2, nao, nao) pair of spin density matrices. Rows of rdm1
+            beyond mol.nao_nr() (padding) are ignored.
+        with_ddrho, with_tau (bool): whether to compute ddrho and
+            tau_data
+        max_memory (float): memory budget for the AO blocks in MB
+    Returns:
+        rho_data (6, ngrid), ddrho (6, ngrid), tau_data (4, ngrid),
+        each with a leading spin axis if rdm1 is 3D, and None
+        if not requested.
+    """
+    if coords is None:
+        coords = grid.coords
+    nao = mol.nao_nr()
+    restricted = len(rdm1.shape) == 2
+    # padded basis functions have no AO values
+    dms = [rdm1[:nao,:nao]] if restricted else [dm[:nao,:nao] for dm in rdm1]
+    N = coords.shape[0]
+    blksize = get_density_blksize(nao, max_memory)
+    blocks = [[] for dm in dms]
+    for p0 in range(0, N, blksize):
+        p1 = min(N, p0 + blksize)
+        non0tab = make_mask(mol, coords[p0:p1])
+        ao = eval_ao(mol, coords[p0:p1], deriv=2, non0tab=non0tab)
+        for s, dm in enumerate(dms):
+            blocks[s].append(_get_rho_tau_data_block(mol, ao, dm, non0tab,
+                                                     with_ddrho, with_tau))
+        ao = None
+    result = []
+    for i, needed in enumerate([True, with_ddrho, with_tau]):
+        if not needed:
+            result.append(None)
+            continue
+        data = [np.concatenate([blk[i] for blk in blks], axis=-1)
+                for blks in blocks]
+        result.append(data[0] if restricted else np.stack(data))
+    return tuple(result)
 
 def get_vele_mat(mol, points, shape_mo_coeff=None):
     """
@@ -355,20 +495,49 @@ def get_vele_mat(mol, points, shape_mo_coeff=None):
     #print('returning contiguous array')
     return retarr
 
+def get_occ_orbitals(mo_coeff, mo_occ):
+    """
+    Select the occupied (including fractionally occupied) orbitals,
+    which are the only ones that contribute to the exchange energy
+    density.
+    Args:
+        mo_coeff shape (nao,nmo), or (2,nao,nmo) for two spins
+        mo_occ shape (nmo,), or (2,nmo)
+    Returns
+        occ_coeff shape (nao,nocc) and occ shape (nocc,), or lists with
+        one of them per spin, since nocc can differ between the spins
+    """
+    mo_occ = numpy.asarray(mo_occ)
+    if mo_occ.ndim == 1:
+        mask = mo_occ > 0
+        return mo_coeff[:,mask], mo_occ[mask]
+    occ_coeff, occ = [], []
+    for s in range(len(mo_occ)):
+        c, o = get_occ_orbitals(mo_coeff[s], mo_occ[s])
+        occ_coeff.append(c)
+        occ.append(o)
+    return occ_coeff, occ
+
 def get_mo_vals(ao_vals, mo_coeff):
     """
     Args:
         ao_vals shape (N,nao)
-        mo_coeff shape (nao,nao)
+        mo_coeff shape (nao,nmo), or a list of them
     Returns
-        shape (N,nao)
+        shape (N,nmo), or a list of them
     """
+    if isinstance(mo_coeff, list):
+        return [np.matmul(ao_vals, c) for c in mo_coeff]
     return np.matmul(ao_vals, mo_coeff)
 
 def get_mo_vele_mat(vele_mat, mo_coeff):
     """
     Convert the return value of get_vele_mat to the MO basis.
+    mo_coeff can also be a list, e.g. of the occupied orbitals
+    of each spin from get_occ_orbitals.
     """
+    if isinstance(mo_coeff, list):
+        return [get_mo_vele_mat(vele_mat, c) for c in mo_coeff]
     if len(mo_coeff.shape) == 2:
         return np.matmul(mo_coeff.transpose(),
             np.matmul(vele_mat, mo_coeff))
@@ -376,27 +545,75 @@ def get_mo_vele_mat(vele_mat, mo_coeff):
         tmp = np.einsum('puv,svj->spuj', vele_mat, mo_coeff)
         return np.einsum('sui,spuj->spij', mo_coeff, tmp)
 
+def get_chunk_bounds(num_pts, num_chunks):
+    """
+    (start, end) of each of num_chunks nearly equal chunks of num_pts
+    grid points.
+    """
+    return [((i * num_pts) // num_chunks, ((i+1) * num_pts) // num_chunks)
+            for i in range(num_chunks)]
+
+def get_vele_mat_chunk(mol, points, mo_coeff=None):
+    """
+    vele_mat (npts, nao, nao) for one chunk of points, in the basis of
+    mo_coeff if it is given.
+    """
+    auxmol = gto.fakemol_for_charges(points)
+    vele_mat_chunk = df.incore.aux_e2(mol, auxmol)
+    vele_mat_chunk = numpy.ascontiguousarray(numpy.transpose(
+                            vele_mat_chunk, axes=(2,0,1)))
+    if mo_coeff is not None:
+        vele_mat_chunk = get_mo_vele_mat(vele_mat_chunk, mo_coeff)
+    return vele_mat_chunk
+
 def get_vele_mat_chunks(mol, points, num_chunks, orb_vals, mo_coeff=None):
     """
     Generate chunks of vele_mat on the fly to reduce memory load.
     """
-    num_pts = points.shape[0]
-    for i in range(num_chunks):
-        start = (i * num_pts) // num_chunks
-        end = ((i+1) * num_pts) // num_chunks
-        auxmol = gto.fakemol_for_charges(points[start:end])
-        orb_vals_chunk = orb_vals[start:end]
-        vele_mat_chunk = df.incore.aux_e2(mol, auxmol)
-        vele_mat_chunk = np.ascontiguousarray(np.transpose(
-                                vele_mat_chunk, axes=(2,0,1)))
-        if mo_coeff is not None:
-            vele_mat_chunk = get_mo_vele_mat(vele_mat_chunk, mo_coeff)
-        yield vele_mat_chunk, orb_vals_chunk
-
-def get_vele_mat_generator(mol, points, num_chunks, mo_coeff=None):
-    get_generator = lambda orb_vals: get_vele_mat_chunks(mol, points,
-                                num_chunks, orb_vals, mo_coeff)
-    return get_generator
+    for start, end in get_chunk_bounds(points.shape[0], num_chunks):
+        vele_mat_chunk = get_vele_mat_chunk(mol, points[start:end], mo_coeff)
+        yield vele_mat_chunk, orb_vals[start:end]
+
+class VeleMatGenerator():
+    """
+    Callable returned by get_vele_mat_generator. Calling it with orb_vals
+    yields the (vele_mat_chunk, orb_vals_chunk) of get_vele_mat_chunks.
+    map_chunks instead computes the chunks independently, num_threads
+    at a time, so each thread holds one chunk of vele_mat.
+    """
+
+    def __init__(self, mol, points, num_chunks, mo_coeff=None,
+                 num_threads=1):
+        self.mol = mol
+        self.points = points
+        self.num_chunks = num_chunks
+        self.mo_coeff = mo_coeff
+        self.num_threads = num_threads
+
+    def __call__(self, orb_vals):
+        return get_vele_mat_chunks(self.mol, self.points, self.num_chunks,
+                                   orb_vals, self.mo_coeff)
+
+    def map_chunks(self, func, orb_vals):
+        """
+        Evaluate func(vele_mat_chunk, orb_vals_chunk), which must return
+        an array of shape (chunk size,), for each chunk and return the
+        results in a preallocated (ngrid,) array.
+        """
+        out = numpy.empty(self.points.shape[0])
+        def get_chunk(bounds):
+            start, end = bounds
+            vele_mat_chunk = get_vele_mat_chunk(
+                self.mol, self.points[start:end], self.mo_coeff)
+            out[start:end] = func(vele_mat_chunk, orb_vals[start:end])
+        map_blocks(get_chunk,
+                   get_chunk_bounds(self.points.shape[0], self.num_chunks),
+                   self.num_threads)
+        return out
+
+def get_vele_mat_generator(mol, points, num_chunks, mo_coeff=None,
+                           num_threads=1):
+    return VeleMatGenerator(mol, points, num_chunks, mo_coeff, num_threads)
 
 def get_ha_energy_density(mol, rdm1, vele_mat, ao_vals):
     """
@@ -434,25 +651,182 @@ def get_ha_energy_density2(mol, rdm1, vele_mat, ao_vals):
     if isinstance(vele_mat, np.ndarray):
         return get_ha_energy_density(mol, rdm1, vele_mat, ao_vals)
     else:
-        ha_energy_density = np.array([])
-        for vele_mat_chunk, orb_vals_chunk in vele_mat(ao_vals):
-            ha_energy_density = np.append(ha_energy_density,
-                                    get_ha_energy_density(mol, rdm1,
-                                        vele_mat_chunk, orb_vals_chunk))
-        return ha_energy_density
+        return vele_mat.map_chunks(
+            lambda vele_mat_chunk, orb_vals_chunk: get_ha_energy_density(
+                mol, rdm1, vele_mat_chunk, orb_vals_chunk),
+            ao_vals)
 
 def get_fx_energy_density2(mol, mo_occ, mo_vele_mat, mo_vals):
     # make sure to test that the grids end up the same
     if isinstance(mo_vele_mat, np.ndarray):
         return get_fx_energy_density(mol, mo_occ, mo_vele_mat, mo_vals)
     else:
-        fx_energy_density = np.array([])
-        for vele_mat_chunk, orb_vals_chunk in mo_vele_mat(mo_vals):
-            fx_energy_density = np.append(fx_energy_density,
-                                    get_fx_energy_density(mol, mo_occ,
-                                        vele_mat_chunk, orb_vals_chunk))
-        return fx_energy_density
+        return mo_vele_mat.map_chunks(
+            lambda vele_mat_chunk, orb_vals_chunk: get_fx_energy_density(
+                mol, mo_occ, vele_mat_chunk, orb_vals_chunk),
+            mo_vals)
+
+
+def get_ee_energy_density_chunks(mol, points, num_chunks, rdm1, ao_vals,
+                                 occ_coeffs, occs, mo_vals, num_threads=1):
+    """
+    Hartree and exchange energy densities in one pass over the vele_mat
+    chunks of get_vele_mat_chunks, so that the fake-charge integrals of
+    each chunk are computed once and shared between the Hartree energy
+    density and the exchange energy density of every spin channel.
+
+    Args:
+        mol (pyscf.gto.Mole)
+        points (array (ngrid, 3)): grid points
+        num_chunks (int): number of chunks
+        rdm1 (array): density matrix for get_ha_energy_density
+        ao_vals (array (ngrid, nao)): AO values on points
+        occ_coeffs (list of arrays (nao, nocc)): occupied orbitals of
+            each exchange term
+        occs (list of arrays (nocc,)): occupations of each exchange term
+        mo_vals (list of arrays (ngrid, nocc)): values of occ_coeffs
+            on points
+        num_threads (int): number of chunks processed concurrently,
+            see map_blocks
+    Returns:
+        ha_energy_density (ngrid,), fx_energy_density (list of (ngrid,)),
+        the same as get_ha_energy_density2 and get_fx_energy_density2
+        with get_vele_mat_generator
+    """
+    num_pts = points.shape[0]
+    ha_energy_density = numpy.empty(num_pts)
+    fx_energy_density = numpy.empty((len(occ_coeffs), num_pts))
+    def get_chunk(bounds):
+        start, end = bounds
+        vele_mat_chunk = get_vele_mat_chunk(mol, points[start:end])
+        ha_energy_density[start:end] = get_ha_energy_density(
+            mol, rdm1, vele_mat_chunk, ao_vals[start:end])
+        for s, (occ_coeff, occ) in enumerate(zip(occ_coeffs, occs)):
+            mo_vele_mat_chunk = get_mo_vele_mat(vele_mat_chunk, occ_coeff)
+            fx_energy_density[s,start:end] = get_fx_energy_density(
+                mol, occ, mo_vele_mat_chunk, mo_vals[s][start:end])
+    map_blocks(get_chunk, get_chunk_bounds(num_pts, num_chunks), num_threads)
+    return ha_energy_density, list(fx_energy_density)
+
+
+# Integral-direct evaluation of the Hartree and exchange energy
+# densities. Instead of the (ngrid, nao, nao) vele_mat, the
+# fake-charge integrals of one block of grid points are computed,
+# contracted with the density matrices, and discarded.
+
+def map_blocks(func, blocks, num_threads=1):
+    """
+    [func(block) for block in blocks], with the blocks distributed over
+    a pool of num_threads threads if num_threads > 1. Each thread runs
+    with lib.num_threads() // num_threads OpenMP threads, so the
+    integral and BLAS calls in func do not oversubscribe the cores.
+    """
+    if num_threads is None or num_threads <= 1 or len(blocks) <= 1:
+        return [func(block) for block in blocks]
+    import concurrent.futures
+    omp_threads = max(1, lib.num_threads() // num_threads)
+    def func_in_worker(block):
+        # omp_set_num_threads only affects the calling thread
+        lib.num_threads(omp_threads)
+        return func(block)
+    with concurrent.futures.ThreadPoolExecutor(num_threads) as pool:
+        return list(pool.map(func_in_worker, blocks))
+
+def get_direct_blksize(nao, max_memory, num_threads=1):
+    """
+    Number of grid points per block for get_ee_energy_density_direct
+    such that the integrals and intermediates of num_threads blocks
+    fit in max_memory MB.
+    """
+    npair = nao * (nao + 1) // 2
+    # packed integrals, pair products of the dm-contracted AOs and
+    # one temporary of the same size, AOs
+    bytes_per_point = 8 * (3 * npair + 2 * nao)
+    blksize = int(max_memory * 1e6 / bytes_per_point / num_threads)
+    return max(1, blksize)
+
+def _get_pair_weights(nao):
+    # weights to sum a symmetric matrix over its lower triangle
+    weights = numpy.full(nao * (nao + 1) // 2, 2.0)
+    diag = numpy.arange(nao)
+    weights[diag * (diag + 3) // 2] = 1.0
+    return weights
+
+def _get_ee_energy_density_block(mol, coords, ha_dm, fx_dms):
+    nao = mol.nao_nr()
+    fakemol = gto.fakemol_for_charges(coords)
+    # (npair, nblk) packed over the lower triangle of the AO pair
+    vele = df.incore.aux_e2(mol, fakemol, aosym='s2ij')
+    ao = eval_ao(mol, coords)
+    tril = numpy.tril_indices(nao)
+    pair_weights = _get_pair_weights(nao)
+    ha = None
+    if ha_dm is not None:
+        rho = numpy.einsum('pi,pi->p', numpy.dot(ao, ha_dm), ao)
+        vh = numpy.dot(pair_weights * ha_dm[tril], vele)
+        ha = 0.5 * vh * rho
+    fx = []
+    for dm in fx_dms:
+        b = numpy.dot(ao, dm)
+        bb = b[:,tril[0]] * b[:,tril[1]]
+        bb *= pair_weights
+        fx.append(-0.25 * numpy.einsum('pk,kp->p', bb, vele))
+    return ha, fx
+
+def get_ee_energy_density_direct(mol, coords, ha_dm=None, fx_dms=None,
+                                 max_memory=2000, num_threads=None):
+    """
+    Integral-direct Hartree and exchange energy densities, equivalent to
+    get_ha_energy_density and get_fx_energy_density but without forming
+    vele_mat or mo_vele_mat. The fake-charge integrals (ij|r) of one block
+    of grid points are computed with df.incore.aux_e2 (packed over the
+    AO pairs), contracted with the density matrices, and discarded, so
+    the peak memory is O(blksize * nao^2) instead of O(ngrid * nao^2).
+    The exchange energy density only depends on the occupied orbitals
+    through the density matrix C occ C^T, so no MO transformation of
+    the integrals is needed.
 
+    Args:
+        mol (pyscf.gto.Mole)
+        coords (array (ngrid, 3)): grid points
+        ha_dm (array (nao, nao), None): total density matrix for
+            the Hartree energy density
+        fx_dms (list of arrays (nao, nao), None): density matrices
+            C occ C^T for which to compute the exchange energy density,
+            -1/4 sum_ij dm_ik dm_jl phi_k(r) phi_l(r) (ij|r)
+        max_memory (float): memory budget in MB
+        num_threads (int, None): If > 1, the blocks are distributed
+            over a pool of num_threads threads, each of which runs
+            the integrals with lib.num_threads() // num_threads
+            OpenMP threads.
+    Returns:
+        ha_energy_density (ngrid,) or None,
+        fx_energy_density (len(fx_dms), ngrid) or None
+    """
+    nao = mol.nao_nr()
+    # padded basis functions (see get_mgga_data) have no AO values
+    if ha_dm is not None:
+        ha_dm = numpy.asarray(ha_dm)[:nao,:nao]
+    fx_dms = [numpy.asarray(dm)[:nao,:nao] for dm in (fx_dms or [])]
+    num_threads = num_threads or 1
+    N = coords.shape[0]
+    blksize = get_direct_blksize(nao, max_memory, num_threads)
+    blocks = [(p0, min(N, p0 + blksize)) for p0 in range(0, N, blksize)]
+    def get_block(block):
+        p0, p1 = block
+        return _get_ee_energy_density_block(mol, coords[p0:p1], ha_dm,
+                                            fx_dms)
+    results = map_blocks(get_block, blocks, num_threads)
+    ha_energy_density = None
+    if ha_dm is not None:
+        ha_energy_density = numpy.concatenate([res[0] for res in results])
+    fx_energy_density = None
+    if len(fx_dms) > 0:
+        fx_energy_density = numpy.stack([
+            numpy.concatenate([res[1][s] for res in results])
+            for s in range(len(fx_dms))
+        ])
+    return ha_energy_density, fx_energy_density
 
 def mol_from_dict(mol_dict):
     for item in ['charge', 'spin', 'symmetry', 'verbose']:
@@ -497,6 +871,56 @@ def load_analyzer_data(fname):
 # HELPER FUNCTIONS FOR COMPUTING DFT INGREDIENTS #
 ##################################################
 
+# Smallest grid size compiled by bucket_jit. Larger inputs are padded
+# to the next power-of-two multiple of it, so at most a few dozen shapes
+# are ever compiled for a given function.
+JIT_MIN_BUCKET = 256
+
+def get_bucket_size(n, min_bucket=JIT_MIN_BUCKET):
+    """
+    Smallest power-of-two multiple of min_bucket that is at least n.
+    """
+    size = min_bucket
+    while size < n:
+        size *= 2
+    return size
+
+def pad_to_bucket(arr, size):
+    """
+    Zero-pad the last (grid) axis of arr to length size.
+    """
+    pad = [(0, 0)] * (arr.ndim - 1) + [(0, size - arr.shape[-1])]
+    return np.pad(arr, pad)
+
+def bucket_jit(fun, static_argnames=None):
+    """
+    Compile fun with jax.jit for pointwise functions of grid arrays.
+    The array positional arguments of fun must share a trailing grid
+    dimension N, which is zero-padded to get_bucket_size(N) before the
+    call, and every output is sliced back to N along its last axis.
+    jax keeps the executable for each bucket, so repeated calls on
+    grid blocks of varying size only compile O(log N) times per process.
+    Other arguments (python scalars, static_argnames) are passed through.
+    With the numpy backend, fun is called directly.
+    """
+    jitted = jax.jit(fun, static_argnames=static_argnames)
+
+    @functools.wraps(fun)
+    def wrapper(*args, **kwargs):
+        if not is_jax_backend():
+            return fun(*args, **kwargs)
+        n = args[0].shape[-1]
+        size = get_bucket_size(n)
+        if size != n:
+            args = [pad_to_bucket(np.asarray(a), size) if np.ndim(a) > 0
+                    else a for a in args]
+        out = jitted(*args, **kwargs)
+        if size == n:
+            return out
+        return jax.tree_util.tree_map(lambda x: x[...,:n], out)
+    return wrapper
+
+
 
 def get_ws_radii(rho):
     return (3.0 / (4 * np.pi * rho + 1e-16))**(1.0/3)
@@ -533,9 +957,9 @@ def get_dft_input(rho_data):
     alpha = get_regularized_tau(rho_data[5], tau_w, tau_unif)
     return rho, s, alpha, tau_w, tau_unif
 
+@bucket_jit
 def get_dft_input2(rho_data):
     rho = rho_data[0,:]
-    r_s = get_ws_radii(rho)
     mag_grad = get_gradient_magnitude(rho_data)
     s = get_normalized_grad(rho, mag_grad)
     tau_w = get_single_orbital_tau(rho, mag_grad)
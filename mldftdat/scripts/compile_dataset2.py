@@ -4,7 +4,8 @@ import os, time
 import numpy as np
 from mldftdat.lowmem_analyzers import RHFAnalyzer, UHFAnalyzer
 from mldftdat.workflow_utils import get_save_dir, SAVE_ROOT, load_mol_ids
-from mldftdat.density import get_exchange_descriptors2, LDA_FACTOR, GG_AMIN
+from mldftdat.density import get_exchange_descriptors2, LDA_FACTOR, GG_AMIN,\
+                             get_exchange_descriptors2_sweep, get_gg_settings
 from mldftdat.data import get_unique_coord_indexes_spherical
 import logging
 import yaml
@@ -17,8 +18,24 @@ Script to compile a dataset from the CIDER DB for training a CIDER functional.
 
 def compile_dataset2(DATASET_NAME, MOL_IDS, SAVE_ROOT, CALC_TYPE, FUNCTIONAL, BASIS,
                     spherical_atom=False, locx=False, lam=0.5,
-                    version='a', **gg_kwargs):
-
+                    version='a', max_memory=None, gg_sweep=None,
+                    desc_order=None, rho_cutoff=None, **gg_kwargs):
+    """
+    Compile the descriptors, exchange energy densities, densities and
+    weights of MOL_IDS into a dataset under SAVE_ROOT/DATASETS.
+    If gg_sweep is a list of (a0, fac_mul, amin) settings (see
+    density.get_gg_settings), one dataset is saved per setting
+    (named with get_sweep_dataset_name) and gg_kwargs is ignored.
+    The analyzer data, density fitting and AOs are then shared
+    by all settings.
+    If desc_order is given, only the feature integrals needed by these
+    contracted descriptors are computed, and the other descriptors in
+    the dataset are zero (see density.get_desc_channels).
+    If rho_cutoff is given, the feature integrals are skipped for
+    points with a density below rho_cutoff, whose features are zero.
+    """
+    if gg_sweep is not None:
+        gg_sweep = get_gg_settings(gg_sweep)
     all_descriptor_data = None
     all_rho_data = None
     all_values = []
@@ -36,7 +53,8 @@ def compile_dataset2(DATASET_NAME, MOL_IDS, SAVE_ROOT, CALC_TYPE, FUNCTIONAL, BA
         logging.info('Computing descriptors for {}'.format(MOL_ID))
         data_dir = get_save_dir(SAVE_ROOT, CALC_TYPE, BASIS, MOL_ID, FUNCTIONAL)
         start = time.monotonic()
-        analyzer = Analyzer.load(data_dir + '/data.hdf5')
+        analyzer = Analyzer.load(data_dir + '/data.hdf5', lazy=True)
+        analyzer.mem_plan.log()
         analyzer.get_ao_rho_data()
         if type(analyzer.calc) == scf.hf.RHF:
             restricted = True
@@ -50,19 +68,21 @@ def compile_dataset2(DATASET_NAME, MOL_IDS, SAVE_ROOT, CALC_TYPE, FUNCTIONAL, BA
             end = time.monotonic()
             logging.info('Index scanning time {}'.format(end - start))
         start = time.monotonic()
-        if restricted:
-            descriptor_data = get_exchange_descriptors2(
-                analyzer, restricted=True, version=version,
-                **gg_kwargs
+        if gg_sweep is not None:
+            descriptor_data = get_exchange_descriptors2_sweep(
+                analyzer, gg_sweep, restricted=restricted, version=version,
+                max_memory=max_memory, desc_order=desc_order,
+                rho_cutoff=rho_cutoff
             )
         else:
-            descriptor_data_u, descriptor_data_d = \
-                              get_exchange_descriptors2(
-                                analyzer, restricted=False, version=version,
-                                **gg_kwargs
-                              )
-            descriptor_data = np.append(descriptor_data_u, descriptor_data_d,
-                                        axis = 1)
+            descriptor_data = [get_exchange_descriptors2(
+                analyzer, restricted=restricted, version=version,
+                max_memory=max_memory, desc_order=desc_order,
+                rho_cutoff=rho_cutoff, **gg_kwargs
+            )]
+        if not restricted:
+            descriptor_data = [np.append(desc_u, desc_d, axis=1)
+                               for desc_u, desc_d in descriptor_data]
         end = time.monotonic()
         logging.info('Get descriptor time {}'.format(end - start))
         if locx:
@@ -81,7 +101,7 @@ def compile_dataset2(DATASET_NAME, MOL_IDS, SAVE_ROOT, CALC_TYPE, FUNCTIONAL, BA
             rho_data = 2 * np.append(rho_data[0], rho_data[1], axis=1)
         if spherical_atom:
             values = values[indexes]
-            descriptor_data = descriptor_data[:,indexes]
+            descriptor_data = [desc[:,indexes] for desc in descriptor_data]
             rho_data = rho_data[:,indexes]
             weights = analyzer.grid.weights[indexes]
         else:
@@ -90,8 +110,9 @@ def compile_dataset2(DATASET_NAME, MOL_IDS, SAVE_ROOT, CALC_TYPE, FUNCTIONAL, BA
         if all_descriptor_data is None:
             all_descriptor_data = descriptor_data
         else:
-            all_descriptor_data = np.append(all_descriptor_data, descriptor_data,
-                                            axis = 1)
+            all_descriptor_data = [np.append(all_desc, desc, axis = 1)
+                                   for all_desc, desc in
+                                   zip(all_descriptor_data, descriptor_data)]
         if all_rho_data is None:
             all_rho_data = rho_data
         else:
@@ -104,35 +125,65 @@ def compile_dataset2(DATASET_NAME, MOL_IDS, SAVE_ROOT, CALC_TYPE, FUNCTIONAL, BA
         cutoffs.append(all_values.shape[0])
 
     DATASET_NAME = os.path.basename(DATASET_NAME)
-    save_dir = os.path.join(SAVE_ROOT, 'DATASETS',
-                            FUNCTIONAL, BASIS, version, DATASET_NAME)
-    if not os.path.isdir(save_dir):
-        os.makedirs(save_dir, exist_ok=True)
-    rho_file = os.path.join(save_dir, 'rho.npy')
-    desc_file = os.path.join(save_dir, 'desc.npy')
-    val_file = os.path.join(save_dir, 'val.npy')
-    wt_file = os.path.join(save_dir, 'wt.npy')
-    cut_file = os.path.join(save_dir, 'cut.npy')
-    np.save(rho_file, all_rho_data)
-    np.save(desc_file, all_descriptor_data)
-    np.save(val_file, all_values)
-    np.save(wt_file, all_weights)
-    np.save(cut_file, np.array(cutoffs))
-    settings = {
-        'DATASET_NAME': DATASET_NAME,
-        'MOL_IDS': MOL_IDS,
-        'SAVE_ROOT': SAVE_ROOT,
-        'CALC_TYPE': CALC_TYPE,
-        'FUNCTIONAL': FUNCTIONAL,
-        'BASIS': BASIS,
-        'spherical_atom': spherical_atom,
-        'locx': locx,
-        'lam': lam,
-        'version': version
-    }
-    settings.update(gg_kwargs)
-    with open(os.path.join(save_dir, 'settings.yaml'), 'w') as f:
-        yaml.dump(settings, f)
+    if gg_sweep is None:
+        names = [DATASET_NAME]
+        gg_list = [gg_kwargs]
+    else:
+        names = [get_sweep_dataset_name(DATASET_NAME, setting)
+                 for setting in gg_sweep]
+        gg_list = gg_sweep
+    for name, settings_gg, descriptor_data in zip(names, gg_list,
+                                                  all_descriptor_data):
+        save_dir = os.path.join(SAVE_ROOT, 'DATASETS',
+                                FUNCTIONAL, BASIS, version, name)
+        if not os.path.isdir(save_dir):
+            os.makedirs(save_dir, exist_ok=True)
+        rho_file = os.path.join(save_dir, 'rho.npy')
+        desc_file = os.path.join(save_dir, 'desc.npy')
+        val_file = os.path.join(save_dir, 'val.npy')
+        wt_file = os.path.join(save_dir, 'wt.npy')
+        cut_file = os.path.join(save_dir, 'cut.npy')
+        np.save(rho_file, all_rho_data)
+        np.save(desc_file, descriptor_data)
+        np.save(val_file, all_values)
+        np.save(wt_file, all_weights)
+        np.save(cut_file, np.array(cutoffs))
+        settings = {
+            'DATASET_NAME': name,
+            'MOL_IDS': MOL_IDS,
+            'SAVE_ROOT': SAVE_ROOT,
+            'CALC_TYPE': CALC_TYPE,
+            'FUNCTIONAL': FUNCTIONAL,
+            'BASIS': BASIS,
+            'spherical_atom': spherical_atom,
+            'locx': locx,
+            'lam': lam,
+            'version': version,
+            'desc_order': desc_order,
+            'rho_cutoff': rho_cutoff
+        }
+        settings.update(settings_gg)
+        with open(os.path.join(save_dir, 'settings.yaml'), 'w') as f:
+            yaml.dump(settings, f)
+
+
+def get_sweep_dataset_name(DATASET_NAME, gg_kwargs):
+    """
+    Name of the dataset for one setting of a gg_sweep.
+    """
+    return '{}_A{:g}_F{:g}_M{:g}'.format(DATASET_NAME, gg_kwargs['a0'],
+                                        gg_kwargs['fac_mul'],
+                                        gg_kwargs['amin'])
+
+
+def parse_gg_setting(setting):
+    """
+    Parse an a0,fac_mul,amin command line triple.
+    """
+    values = [float(v) for v in setting.split(',')]
+    if len(values) != 3:
+        raise ValueError('gg setting must be a0,fac_mul,amin')
+    return tuple(values)
 
 
 if __name__ == '__main__':
@@ -160,10 +211,28 @@ if __name__ == '__main__':
     parser.add_argument('--gg-amin', default=GG_AMIN, type=float)
     parser.add_argument('--suffix', default=None, type=str,
                         help='customize data directories with this suffix')
+    parser.add_argument('--max-memory', default=None, type=float,
+                        help='if set, memory budget in MB for computing the '
+                             'descriptors of each molecule block by block')
+    parser.add_argument('--gg-sweep', default=None, nargs='+',
+                        type=parse_gg_setting, metavar='A0,FACMUL,AMIN',
+                        help='compile one dataset for each of these exponent '
+                             'settings in one pass over the molecules, '
+                             'overrides --gg-a0, --gg-facmul and --gg-amin')
+    parser.add_argument('-o', '--desc-order', default=None, type=str,
+                        help='comma-separated list of descriptor order with no '
+                             'spaces. only the integrals for these descriptors '
+                             'are computed, the others are set to zero')
+    parser.add_argument('--rho-cutoff', default=None, type=float,
+                        help='if set, skip the feature integrals at points '
+                             'with density below this value (features are '
+                             'set to zero there)')
     args = parser.parse_args()
 
     version = args.version.lower()
     assert version in ['a', 'b', 'c']
+    if args.desc_order is not None:
+        args.desc_order = [int(d) for d in args.desc_order.split(',')]
 
     calc_type, mol_ids = load_mol_ids(args.mol_id_file)
     assert ('HF' in calc_type) or (args.functional is not None),\
@@ -189,13 +258,16 @@ if __name__ == '__main__':
             dataname, mol_ids, SAVE_ROOT, calc_type, args.functional, args.basis,
             spherical_atom=args.spherical_atom, locx=args.locx, lam=args.lam,
             version=version, a0=args.gg_a0, fac_mul=args.gg_facmul,
-            amin=args.gg_amin
+            amin=args.gg_amin, max_memory=args.max_memory,
+            gg_sweep=args.gg_sweep, desc_order=args.desc_order,
+            rho_cutoff=args.rho_cutoff
         )
     else:
         compile_dataset2(
             dataname, mol_ids, SAVE_ROOT, calc_type, args.functional, args.basis, 
             spherical_atom=args.spherical_atom, locx=args.locx, lam=args.lam,
             version=version, a0=args.gg_a0, fac_mul=args.gg_facmul,
-            amin=args.gg_amin
-
+            amin=args.gg_amin, max_memory=args.max_memory,
+            gg_sweep=args.gg_sweep, desc_order=args.desc_order,
+            rho_cutoff=args.rho_cutoff
         )
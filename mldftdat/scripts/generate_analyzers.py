@@ -0,0 +1,264 @@
+from pyscf import gto, lib
+from pyscf.pbc.tools.pyscf_ase import atoms_from_ase
+from mldftdat.pyscf_utils import run_scf
+from mldftdat.lowmem_analyzers import RHFAnalyzer, UHFAnalyzer
+from mldftdat.workflow_utils import get_save_dir, SAVE_ROOT, load_mol_ids,\
+                                   read_accdb_structure, safe_mem_cap_mb,\
+                                   time_func
+from mldftdat.backend import set_backend
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import numpy as np
+import traceback
+import logging
+import time
+import yaml
+import os
+
+from argparse import ArgumentParser
+
+"""
+Script to run the SCF calculations and analyzers (see lowmem_analyzers)
+of the molecules in a mol_id file in parallel, and dump the analyzers
+into the CIDER DB layout read by compile_dataset2
+(get_save_dir(SAVE_ROOT, calc_type, basis, mol_id, functional)/data.hdf5).
+
+The mol_id file has the format read by workflow_utils.load_mol_ids.
+Molecules from ACCDB (mol_id ACCDB/<struct_id>) are read with
+read_accdb_structure, all other structures must be given in an
+optional structures section, either as a pyscf atom string or as a
+dict with atom and optionally spin and charge, e.g.
+
+    calc_type: RKS
+    mols:
+    - ATOMS/He
+    - MOLS/HF
+    structures:
+      ATOMS/He: He
+      MOLS/HF:
+        atom: H 0 0 0; F 0 0 0.93
+        spin: 0
+
+Molecules are distributed over num_workers processes, each of which
+uses num_threads threads and max_mem MB. Molecules whose data.hdf5
+already exists are skipped, so an interrupted run can be restarted with
+the same command. The status, timings and errors of each molecule are
+recorded in a yaml manifest next to the molecule directories.
+"""
+
+MANIFEST_NAME = 'manifest_{}.yaml'
+
+
+def load_structures(mol_id_file):
+    """
+    Read the optional structures section of a mol_id file,
+    a dict of mol_id to structure (see get_mol).
+    """
+    if not mol_id_file.endswith('.yaml'):
+        mol_id_file += '.yaml'
+    with open(mol_id_file, 'r') as f:
+        contents = yaml.load(f, Loader=yaml.Loader)
+    return contents.get('structures') or {}
+
+
+def get_mol(mol_id, basis, structure=None, max_mem=None):
+    """
+    Build the gto.Mole of mol_id. structure is an atom string or a dict
+    with atom, spin and charge. If it is None, mol_id must be an
+    ACCDB structure.
+    """
+    if structure is None:
+        if not mol_id.startswith('ACCDB/'):
+            raise ValueError('No structure given for {}'.format(mol_id))
+        struct, _, spin, charge = read_accdb_structure(mol_id[len('ACCDB/'):])
+        atom = atoms_from_ase(struct)
+    elif isinstance(structure, dict):
+        atom = structure['atom']
+        spin = structure.get('spin', 0)
+        charge = structure.get('charge', 0)
+    else:
+        atom, spin, charge = structure, 0, 0
+    mol = gto.M(atom=atom, basis=basis, spin=spin, charge=charge, verbose=0)
+    if max_mem is not None:
+        mol.max_memory = max_mem
+    return mol
+
+
+def _init_worker(num_threads):
+    # dataset generation does not differentiate anything, see backend
+    set_backend('numpy')
+    lib.num_threads(num_threads)
+
+
+def generate_analyzer(mol_id, save_dir, calc_type, basis, functional=None,
+                      structure=None, max_mem=None, num_threads=1,
+                      compression=None, dtype=None):
+    """
+    Run the SCF calculation of mol_id, perform the full analysis and dump
+    the analyzer to save_dir/data.hdf5.
+
+    Returns:
+        dict with the status ('done' or 'failed') and timings of mol_id,
+        and the error traceback if it failed
+    """
+    record = {'mol_id': mol_id, 'save_dir': save_dir}
+    start = time.monotonic()
+    try:
+        mol = get_mol(mol_id, basis, structure, max_mem)
+        calc, record['scf_time'] = time_func(run_scf, mol, calc_type,
+                                             functional)
+        record['e_tot'] = float(calc.e_tot)
+        record['converged'] = bool(calc.converged)
+        Analyzer = UHFAnalyzer if 'U' in calc_type else RHFAnalyzer
+        t0 = time.monotonic()
+        analyzer = Analyzer(calc, max_mem=max_mem, num_threads=num_threads)
+        analyzer.perform_full_analysis()
+        record['analysis_time'] = time.monotonic() - t0
+        os.makedirs(save_dir, exist_ok=True)
+        # write to a temporary file first, so that an interrupted dump
+        # is not taken for a finished molecule
+        fname = os.path.join(save_dir, 'data.hdf5')
+        if os.path.exists(fname + '.tmp'):
+            os.remove(fname + '.tmp')
+        analyzer.dump(fname + '.tmp', compression=compression, dtype=dtype)
+        os.replace(fname + '.tmp', fname)
+        record['status'] = 'done'
+    except Exception:
+        record['status'] = 'failed'
+        record['error'] = traceback.format_exc()
+    record['total_time'] = time.monotonic() - start
+    return record
+
+
+def write_manifest(manifest_file, manifest):
+    with open(manifest_file + '.tmp', 'w') as f:
+        yaml.dump(manifest, f)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def generate_analyzers(MOL_IDS, SAVE_ROOT, CALC_TYPE, FUNCTIONAL, BASIS,
+                       structures=None, num_workers=1, num_threads=1,
+                       max_mem=None, compression=None, dtype=None,
+                       manifest_file=None, overwrite=False):
+    """
+    Generate the analyzers of MOL_IDS in parallel with generate_analyzer,
+    num_workers molecules at a time, each with num_threads threads and
+    max_mem MB (safe_mem_cap_mb() / num_workers if None).
+    Molecules with an existing data.hdf5 are skipped unless overwrite.
+    If manifest_file is given, the records of generate_analyzer are
+    written to it after every molecule, keeping the records of earlier
+    runs for the skipped molecules.
+
+    Returns:
+        manifest dict of mol_id to record
+    """
+    structures = structures or {}
+    if max_mem is None:
+        max_mem = safe_mem_cap_mb() / num_workers
+    manifest = {}
+    if manifest_file is not None and os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            manifest = yaml.load(f, Loader=yaml.Loader) or {}
+
+    tasks = []
+    for mol_id in MOL_IDS:
+        save_dir = get_save_dir(SAVE_ROOT, CALC_TYPE, BASIS, mol_id, FUNCTIONAL)
+        if not overwrite and os.path.exists(os.path.join(save_dir, 'data.hdf5')):
+            logging.info('Skipping {}, data.hdf5 exists'.format(mol_id))
+            if manifest.get(mol_id, {}).get('status') != 'done':
+                manifest[mol_id] = {'mol_id': mol_id, 'save_dir': save_dir,
+                                    'status': 'done'}
+            continue
+        tasks.append((mol_id, save_dir))
+    logging.info('Generating {} of {} analyzers with {} workers'.format(
+        len(tasks), len(MOL_IDS), num_workers))
+
+    kwargs = dict(calc_type=CALC_TYPE, basis=BASIS, functional=FUNCTIONAL,
+                  max_mem=max_mem, num_threads=num_threads,
+                  compression=compression, dtype=dtype)
+    def finish(record):
+        manifest[record['mol_id']] = record
+        if record['status'] == 'done':
+            logging.info('Finished {} in {:.1f} s'.format(
+                record['mol_id'], record['total_time']))
+        else:
+            logging.error('Failed {}\n{}'.format(record['mol_id'],
+                                                 record['error']))
+        if manifest_file is not None:
+            write_manifest(manifest_file, manifest)
+
+    if num_workers == 1:
+        _init_worker(num_threads)
+        for mol_id, save_dir in tasks:
+            finish(generate_analyzer(mol_id, save_dir,
+                                     structure=structures.get(mol_id),
+                                     **kwargs))
+    else:
+        # jax, which mldftdat imports, does not support fork
+        ctx = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=ctx,
+                                 initializer=_init_worker,
+                                 initargs=(num_threads,)) as executor:
+            futures = [executor.submit(generate_analyzer, mol_id, save_dir,
+                                       structure=structures.get(mol_id),
+                                       **kwargs)
+                       for mol_id, save_dir in tasks]
+            for future in as_completed(futures):
+                finish(future.result())
+    return manifest
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    m_desc = 'Run SCF calculations and dump analyzers of a mol_id list in parallel'
+
+    parser = ArgumentParser(description=m_desc)
+    parser.add_argument('mol_id_file', type=str,
+                        help='yaml file from which to read mol_ids '
+                             '(and structures) to compute')
+    parser.add_argument('basis', metavar='basis', type=str,
+                        help='basis set code')
+    parser.add_argument('--functional', metavar='functional', type=str, default=None,
+                        help='exchange-correlation functional, HF for Hartree-Fock')
+    parser.add_argument('--num-workers', default=1, type=int,
+                        help='number of molecules computed at the same time')
+    parser.add_argument('--num-threads', default=1, type=int,
+                        help='number of threads of each worker')
+    parser.add_argument('--max-memory', default=None, type=float,
+                        help='memory budget in MB of each worker, '
+                             'available memory / num-workers by default')
+    parser.add_argument('--compression', default=None, type=str,
+                        help='hdf5 compression of the analyzer data, '
+                             'e.g. gzip or lzf')
+    parser.add_argument('--single-precision', action='store_true', default=False,
+                        help='store the analyzer data (except the grid) as float32')
+    parser.add_argument('--overwrite', action='store_true', default=False,
+                        help='recompute molecules whose data.hdf5 exists')
+    args = parser.parse_args()
+
+    calc_type, mol_ids = load_mol_ids(args.mol_id_file)
+    assert ('HF' in calc_type) or (args.functional is not None),\
+           'Must specify functional if not using HF reference.'
+    structures = load_structures(args.mol_id_file)
+    mol_id_code = os.path.basename(args.mol_id_file)
+    if mol_id_code.endswith('.yaml'):
+        mol_id_code = mol_id_code[:-5]
+    manifest_dir = get_save_dir(SAVE_ROOT, calc_type, args.basis, '',
+                                args.functional)
+    os.makedirs(manifest_dir, exist_ok=True)
+    manifest_file = os.path.join(manifest_dir, MANIFEST_NAME.format(mol_id_code))
+
+    manifest = generate_analyzers(
+        mol_ids, SAVE_ROOT, calc_type, args.functional, args.basis,
+        structures=structures, num_workers=args.num_workers,
+        num_threads=args.num_threads, max_mem=args.max_memory,
+        compression=args.compression,
+        dtype=np.float32 if args.single_precision else None,
+        manifest_file=manifest_file, overwrite=args.overwrite
+    )
+    failed = [mol_id for mol_id in mol_ids
+              if manifest.get(mol_id, {}).get('status') != 'done']
+    logging.info('Manifest written to {}'.format(manifest_file))
+    if len(failed) > 0:
+        logging.error('{} molecules failed: {}'.format(len(failed), failed))
@@ -41,7 +41,7 @@ def error_table(dirs, Analyzer, models, rows):
     rtse = np.zeros(NMODEL)
     for d in dirs:
         print(d.split('/')[-1])
-        analyzer = Analyzer.load(os.path.join(d, 'data.hdf5'))
+        analyzer = Analyzer.load(os.path.join(d, 'data.hdf5'), lazy=True)
         weights = analyzer.grid.weights
         rho = analyzer.rho_data[0,:]
         condition = rho > 3e-3
@@ -93,7 +93,7 @@ def error_table_unrestricted(dirs, Analyzer, models, rows):
     rtse = np.zeros(NMODEL)
     for d in dirs:
         print(d.split('/')[-1])
-        analyzer = Analyzer.load(os.path.join(d, 'data.hdf5'))
+        analyzer = Analyzer.load(os.path.join(d, 'data.hdf5'), lazy=True)
         analyzer.get_ao_rho_data()
         weights = analyzer.grid.weights
         rho = analyzer.rho_data[0,:]
@@ -146,7 +146,7 @@ def error_table2(dirs, Analyzer, models, rows):
             data_dict[model] = {'eps_data': []}
     for d in dirs:
         print(d.split('/')[-1])
-        analyzer = Analyzer.load(os.path.join(d, 'data.hdf5'))
+        analyzer = Analyzer.load(os.path.join(d, 'data.hdf5'), lazy=True)
         weights = analyzer.grid.weights
         rho = analyzer.rho_data[0,:]
         condition = rho > 3e-3
@@ -230,7 +230,7 @@ def error_table3(dirs, Analyzer, models, rows, basis, functional):
     rtse = np.zeros(NMODEL)
     for d in dirs:
         print(d.split('/')[-1])
-        analyzer = Analyzer.load(os.path.join(d, 'data.hdf5'))
+        analyzer = Analyzer.load(os.path.join(d, 'data.hdf5'), lazy=True)
         atoms = [atomic_numbers[a[0]] for a in analyzer.mol._atom]
         formula = Counter(atoms)
         element_analyzers = {}
@@ -241,9 +241,9 @@ def error_table3(dirs, Analyzer, models, rows, basis, functional):
             path = '{}/{}KS/{}/{}/atoms/{}-{}-{}/data.hdf5'.format(
                         SAVE_ROOT, letter, functional, basis, Z, symbol, spin)
             if letter == 'R':
-                element_analyzers[Z] = RHFAnalyzer.load(path)
+                element_analyzers[Z] = RHFAnalyzer.load(path, lazy=True)
             else:
-                element_analyzers[Z] = UHFAnalyzer.load(path)
+                element_analyzers[Z] = UHFAnalyzer.load(path, lazy=True)
         weights = analyzer.grid.weights
         rho = analyzer.rho_data[0,:]
         condition = rho > 3e-5
@@ -320,7 +320,7 @@ def error_table3u(dirs, Analyzer, models, rows, basis, functional):
     rtse = np.zeros(NMODEL)
     for d in dirs:
         print(d.split('/')[-1])
-        analyzer = Analyzer.load(os.path.join(d, 'data.hdf5'))
+        analyzer = Analyzer.load(os.path.join(d, 'data.hdf5'), lazy=True)
         atoms = [atomic_numbers[a[0]] for a in analyzer.mol._atom]
         formula = Counter(atoms)
         element_analyzers = {}
@@ -331,9 +331,9 @@ def error_table3u(dirs, Analyzer, models, rows, basis, functional):
             path = '{}/{}KS/{}/{}/atoms/{}-{}-{}/data.hdf5'.format(
                         SAVE_ROOT, letter, functional, basis, Z, symbol, spin)
             if letter == 'R':
-                element_analyzers[Z] = RHFAnalyzer.load(path)
+                element_analyzers[Z] = RHFAnalyzer.load(path, lazy=True)
             else:
-                element_analyzers[Z] = UHFAnalyzer.load(path)
+                element_analyzers[Z] = UHFAnalyzer.load(path, lazy=True)
         weights = analyzer.grid.weights
         rho = analyzer.rho_data[0,:]
         condition = rho > 3e-5
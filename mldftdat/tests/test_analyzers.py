@@ -29,6 +29,13 @@ class TestRHFAnalyzer():
         # This is tested in the rest of the module
         assert_almost_equal(self.ha_tot_ref + self.fx_tot_ref, self.rhf.energy_elec()[1])
 
+    def test_occ_orbitals(self):
+        nocc = self.mol.nelectron // 2
+        assert_equal(self.analyzer.occ_coeff.shape, (self.mol.nao_nr(), nocc))
+        assert_equal(self.analyzer.occ, 2)
+        assert_equal(self.analyzer.mo_vals.shape,
+                     (self.analyzer.ao_vals.shape[0], nocc))
+
     def test_get_ha_energy_density(self):
         ha_density = self.analyzer.get_ha_energy_density()
         ha_tot = np.dot(ha_density, self.analyzer.grid.weights)
@@ -96,6 +103,26 @@ class TestRHFAnalyzerChunks(TestRHFAnalyzer):
         cls.ha_tot_ref, cls.fx_tot_ref = get_hf_coul_ex_total(cls.mol, cls.rhf)
 
 
+class TestRHFAnalyzerDirect(TestRHFAnalyzer):
+
+    @classmethod
+    def setup_class(cls):
+        cls.mol = gto.Mole(atom='H 0 0 0; F 0 0 1.1', basis = 'sto-3g')
+        cls.mol.build()
+        cls.rhf = run_scf(cls.mol, 'RHF')
+        # small max_mem to use several blocks
+        cls.analyzer = RHFAnalyzer(cls.rhf, max_mem=1, direct=True)
+        cls.ha_tot_ref, cls.fx_tot_ref = get_hf_coul_ex_total(cls.mol, cls.rhf)
+
+    def test_direct_energy_densities(self):
+        assert self.analyzer.ao_vele_mat is None
+        ref_analyzer = RHFAnalyzer(self.rhf)
+        assert_almost_equal(self.analyzer.get_ha_energy_density(),
+                            ref_analyzer.get_ha_energy_density())
+        assert_almost_equal(self.analyzer.get_fx_energy_density(),
+                            ref_analyzer.get_fx_energy_density())
+
+
 class TestRKSAnalyzer(TestRHFAnalyzer):
 
     @classmethod
@@ -122,6 +149,13 @@ class TestUHFAnalyzer():
         # This is tested in the rest of the module
         assert_almost_equal(self.ha_tot_ref + self.fx_tot_ref, self.uhf.energy_elec()[1])
 
+    def test_occ_orbitals(self):
+        for s, nocc in enumerate(self.mol.nelec):
+            assert_equal(self.analyzer.occ_coeff[s].shape,
+                         (self.mol.nao_nr(), nocc))
+            assert_equal(self.analyzer.mo_vals[s].shape,
+                         (self.analyzer.ao_vals.shape[0], nocc))
+
     def test_get_ha_energy_density(self):
         ha_density = self.analyzer.get_ha_energy_density()
         ha_tot = np.dot(ha_density, self.analyzer.grid.weights)
@@ -193,6 +227,29 @@ class TestUHFAnalyzerChunks(TestUHFAnalyzer):
         cls.ha_tot_ref, cls.fx_tot_ref = get_hf_coul_ex_total_unrestricted(cls.mol, cls.uhf)
 
 
+class TestUHFAnalyzerDirect(TestUHFAnalyzer):
+
+    @classmethod
+    def setup_class(cls):
+        cls.mol = gto.Mole(atom='N 0 0 0; O 0 0 1.15', basis = 'sto-3g', spin = 1)
+        cls.mol.build()
+        cls.uhf = run_scf(cls.mol, 'UHF')
+        cls.analyzer = UHFAnalyzer(cls.uhf, max_mem=1, direct=True)
+        cls.ha_tot_ref, cls.fx_tot_ref = get_hf_coul_ex_total_unrestricted(cls.mol, cls.uhf)
+
+    def test_direct_energy_densities(self):
+        assert self.analyzer.ao_vele_mat is None
+        ref_analyzer = UHFAnalyzer(self.uhf)
+        assert_almost_equal(self.analyzer.get_ha_energy_density(),
+                            ref_analyzer.get_ha_energy_density())
+        assert_almost_equal(self.analyzer.get_fx_energy_density(),
+                            ref_analyzer.get_fx_energy_density())
+        assert_almost_equal(self.analyzer.fx_energy_density_u,
+                            ref_analyzer.fx_energy_density_u)
+        assert_almost_equal(self.analyzer.fx_energy_density_d,
+                            ref_analyzer.fx_energy_density_d)
+
+
 class TestUKSAnalyzer(TestUHFAnalyzer):
 
     @classmethod
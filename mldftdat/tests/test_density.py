@@ -0,0 +1,334 @@
+from pyscf import scf, gto, dft, df
+from numpy.testing import assert_almost_equal, assert_equal
+
+from mldftdat.lowmem_analyzers import RHFAnalyzer, UHFAnalyzer
+from mldftdat.backend import use_backend, get_backend
+from mldftdat.density import get_x_helper_full_a, get_x_helper_full_c,\
+                             get_exchange_descriptors2,\
+                             get_gaussian_grid_c, get_dft_input2,\
+                             CIDER_CHANNELS, CIDER_INTORS, GG_AMIN,\
+                             BlockSparseMatrix, get_packed_ao_to_aux,\
+                             contract_ao_to_aux, contract_aux_to_ao,\
+                             get_cider_invariants, contract21,\
+                             contract21_deriv, CG21_TENSOR,\
+                             get_exchange_descriptors2_sweep,\
+                             get_desc_channels, contract_exchange_descriptors,\
+                             get_point_runs, scatter_ovlp_rows
+import numpy as np
+
+
+def get_channel_ovlps_ref(auxmol, grid, rho_data, channels, deriv=False):
+    # one intor_cross call per channel, as in the original SCF path
+    lc = [np.asarray(x) for x in get_dft_input2(rho_data)[:3]]
+    ovlps = []
+    for l, mul, r2pow in channels:
+        atm, bas, env = get_gaussian_grid_c(grid.coords, rho_data[0],
+                                            l=l, s=lc[1], alpha=lc[2],
+                                            a0=8.0*mul, fac_mul=0.25*mul,
+                                            amin=GG_AMIN*mul)
+        atm, bas, env = np.asarray(atm), np.asarray(bas), np.array(env)
+        if r2pow > 0:
+            env[bas[:,6]] *= env[bas[:,5]]**r2pow
+        gridmol = gto.Mole(_atm=atm, _bas=bas, _env=env)
+        intor = CIDER_INTORS[r2pow + int(deriv)]
+        ovlps.append(gto.mole.intor_cross(intor, auxmol, gridmol).T)
+    return ovlps
+
+
+class TestCiderDescriptors():
+
+    @classmethod
+    def setup_class(cls):
+        cls.mol = gto.Mole(atom='H 0 0 0; F 0 0 1.1', basis='def2-svp')
+        cls.mol.build()
+        cls.auxmol = df.make_auxmol(cls.mol, 'weigend+etb')
+        cls.rhf = scf.RHF(cls.mol).run()
+        cls.grid = dft.gen_grid.Grids(cls.mol)
+        cls.grid.level = 1
+        cls.grid.build()
+        # keep the high-density region so the exponent floor is not used
+        cond = cls.grid.weights > 1e-3
+        cls.grid.coords = cls.grid.coords[cond]
+        cls.grid.weights = cls.grid.weights[cond]
+        ao = dft.numint.eval_ao(cls.mol, cls.grid.coords, deriv=2)
+        cls.rho_data = dft.numint.eval_rho(cls.mol, ao, cls.rhf.make_rdm1(),
+                                           xctype='MGGA')
+        cls.rho_data[0] = np.maximum(cls.rho_data[0], 1e-10)
+        cls.density = np.random.rand(cls.auxmol.nao_nr())
+
+    def _check_fused(self, version, helper):
+        N = self.grid.weights.shape[0]
+        for deriv in [False, True]:
+            ref_ovlps = get_channel_ovlps_ref(self.auxmol, self.grid,
+                                              self.rho_data,
+                                              CIDER_CHANNELS[version],
+                                              deriv=deriv)
+            desc, ovlps = helper(self.auxmol, self.rho_data, self.grid,
+                                 self.density, None, deriv=deriv,
+                                 return_ovlp=True)
+            assert_equal(len(ovlps), len(ref_ovlps))
+            ref_desc = [self.rho_data]
+            for ovlp, ref_ovlp in zip(ovlps, ref_ovlps):
+                assert_equal(ovlp.shape, ref_ovlp.shape)
+                assert_almost_equal(ovlp, ref_ovlp, 5)
+                ref_desc.append(np.dot(ref_ovlp, self.density).reshape(N, -1).T)
+            assert_almost_equal(desc, np.concatenate(ref_desc, axis=0), 5)
+
+    def test_get_x_helper_full_a(self):
+        self._check_fused('a', get_x_helper_full_a)
+
+    def test_get_x_helper_full_c(self):
+        self._check_fused('c', get_x_helper_full_c)
+
+    def test_screened_ovlps(self):
+        N = self.grid.weights.shape[0]
+        for deriv in [False, True]:
+            desc, ovlps = get_x_helper_full_c(self.auxmol, self.rho_data,
+                                              self.grid, self.density, None,
+                                              deriv=deriv, return_ovlp=True)
+            sdesc, sovlps = get_x_helper_full_c(self.auxmol, self.rho_data,
+                                                self.grid, self.density, None,
+                                                deriv=deriv, return_ovlp=True,
+                                                screen_tol=1e-12)
+            assert_almost_equal(np.asarray(sdesc), np.asarray(desc))
+            for ovlp, sovlp in zip(ovlps, sovlps):
+                assert isinstance(sovlp, BlockSparseMatrix)
+                assert_equal(sovlp.shape, ovlp.shape)
+                assert_almost_equal(sovlp.toarray(), ovlp)
+                vec = np.random.rand(ovlp.shape[0])
+                assert_almost_equal(sovlp.T.dot(vec), ovlp.T.dot(vec))
+
+    def test_block_sparse_matrix(self):
+        mat = np.zeros((7, 5))
+        mat[1:3, 0:2] = np.random.rand(2, 2)
+        mat[4:7, 2:5] = np.random.rand(3, 3)
+        bmat = BlockSparseMatrix(mat.shape, [(1, 0, mat[1:3, 0:2]),
+                                             (4, 2, mat[4:7, 2:5])])
+        assert_equal(bmat.nnz, 13)
+        assert_equal(bmat.T.shape, (5, 7))
+        assert_almost_equal(bmat.toarray(), mat)
+        assert_almost_equal(bmat.T.toarray(), mat.T)
+        vec = np.random.rand(5)
+        assert_almost_equal(bmat.dot(vec), mat.dot(vec))
+        vec = np.random.rand(7)
+        assert_almost_equal(bmat.T.dot(vec), mat.T.dot(vec))
+
+    def test_desc_order(self):
+        assert_equal(get_desc_channels([0, 1, 2, 3, 4]), (0, 1))
+        assert_equal(get_desc_channels([0, 1, 2, 8, 11]), (1, 2, 4))
+        assert_equal(get_desc_channels(None), (0, 1, 2, 3, 4))
+        for helper in [get_x_helper_full_a, get_x_helper_full_c]:
+            ref, ref_r2, ref_ovlps = helper(self.auxmol, self.rho_data,
+                                            self.grid, self.density, None,
+                                            return_ovlp=True,
+                                            return_deriv=True)
+            ref_cont = np.asarray(contract_exchange_descriptors(ref))
+            for desc_order in [[0, 1, 2, 3, 4], [0, 1, 2, 6, 8, 10], [0, 1]]:
+                desc, desc_r2, ovlps = helper(self.auxmol, self.rho_data,
+                                              self.grid, self.density, None,
+                                              return_ovlp=True,
+                                              return_deriv=True,
+                                              desc_order=desc_order)
+                chan_idx = get_desc_channels(desc_order)
+                for i in range(5):
+                    assert (ovlps[i] is None) == (i not in chan_idx)
+                cont = np.asarray(contract_exchange_descriptors(desc))
+                assert_almost_equal(cont[desc_order], ref_cont[desc_order])
+                for i in chan_idx:
+                    assert_almost_equal(ovlps[i], ref_ovlps[i])
+
+    def test_rho_cutoff(self):
+        mask = np.array([0, 1, 1, 0, 0, 1, 0, 1, 1, 1], dtype=bool)
+        assert_equal(get_point_runs(mask), [[1, 3], [5, 6], [7, 10]])
+        ovlp = np.random.rand(mask.sum() * 3, 4)
+        full = np.zeros((mask.size, 3, 4))
+        full[mask] = ovlp.reshape(-1, 3, 4)
+        full = full.reshape(-1, 4)
+        runs = get_point_runs(mask)
+        assert_almost_equal(scatter_ovlp_rows(ovlp, runs, 3, 10).toarray(),
+                            full)
+        sparse = BlockSparseMatrix(ovlp.shape, [(0, 0, ovlp[:5]),
+                                                (5, 1, ovlp[5:,1:])])
+        assert_almost_equal(scatter_ovlp_rows(sparse, runs, 3, 10).toarray(),
+                            scatter_ovlp_rows(sparse.toarray(), runs, 3,
+                                              10).toarray())
+
+        rho_cutoff = np.median(self.rho_data[0])
+        mask = self.rho_data[0] >= rho_cutoff
+        for helper in [get_x_helper_full_a, get_x_helper_full_c]:
+            for screen_tol in [None, 1e-12]:
+                ref, ref_r2, ref_ovlps = helper(self.auxmol, self.rho_data,
+                                                self.grid, self.density, None,
+                                                return_ovlp=True,
+                                                return_deriv=True,
+                                                screen_tol=screen_tol)
+                desc, desc_r2, ovlps = helper(self.auxmol, self.rho_data,
+                                              self.grid, self.density, None,
+                                              return_ovlp=True,
+                                              return_deriv=True,
+                                              screen_tol=screen_tol,
+                                              rho_cutoff=rho_cutoff)
+                assert_almost_equal(desc[:,mask], np.asarray(ref)[:,mask])
+                assert_almost_equal(desc_r2[:,mask],
+                                    np.asarray(ref_r2)[:,mask])
+                assert_equal(desc[6:,~mask], 0)
+                assert_almost_equal(desc[:6], self.rho_data)
+                for ovlp, ref_ovlp in zip(ovlps, ref_ovlps):
+                    if screen_tol is not None:
+                        ref_ovlp = ref_ovlp.toarray()
+                    ovlp = ovlp.toarray().reshape(mask.size, -1, ovlp.shape[1])
+                    ref_ovlp = ref_ovlp.reshape(ovlp.shape)
+                    assert_almost_equal(ovlp[mask], ref_ovlp[mask])
+                    assert_equal(ovlp[~mask], 0)
+
+    def test_return_deriv(self):
+        for helper in [get_x_helper_full_a, get_x_helper_full_c]:
+            for screen_tol in [None, 1e-12]:
+                desc, ovlps = helper(self.auxmol, self.rho_data, self.grid,
+                                     self.density, None, return_ovlp=True,
+                                     screen_tol=screen_tol)
+                desc_r2 = helper(self.auxmol, self.rho_data, self.grid,
+                                 self.density, None, deriv=True,
+                                 screen_tol=screen_tol)
+                desc1, desc_r21, ovlps1 = helper(self.auxmol, self.rho_data,
+                                                 self.grid, self.density, None,
+                                                 return_ovlp=True,
+                                                 return_deriv=True,
+                                                 screen_tol=screen_tol)
+                assert_almost_equal(np.asarray(desc1), np.asarray(desc))
+                assert_almost_equal(np.asarray(desc_r21), np.asarray(desc_r2))
+                for ovlp, ovlp1 in zip(ovlps, ovlps1):
+                    if screen_tol is not None:
+                        ovlp, ovlp1 = ovlp.toarray(), ovlp1.toarray()
+                    assert_almost_equal(ovlp1, ovlp)
+
+    def test_packed_ao_to_aux(self):
+        nao = self.mol.nao_nr()
+        naux = self.auxmol.nao_nr()
+        aux_e2 = df.incore.aux_e2(self.mol, self.auxmol)
+        aux_e2 = aux_e2.reshape(nao * nao, naux).T
+        ao_to_aux_full = np.linalg.solve(self.auxmol.intor('int2c2e'), aux_e2)
+        ao_to_aux_full = ao_to_aux_full.reshape(naux, nao, nao)
+        ao_to_aux = get_packed_ao_to_aux(self.mol, self.auxmol)
+        assert_equal(ao_to_aux.shape, (naux, nao * (nao + 1) // 2))
+        # non-symmetric and padded density matrices
+        dm = np.random.rand(nao + 2, nao + 2)
+        dm[nao:] = dm[:,nao:] = 0
+        ref = np.einsum('npq,pq->n', ao_to_aux_full, dm[:nao,:nao])
+        assert_almost_equal(np.asarray(contract_ao_to_aux(ao_to_aux, dm)),
+                            ref, 4)
+        v_aux = np.random.rand(naux)
+        ref = np.einsum('a,aij->ij', v_aux, ao_to_aux_full)
+        assert_almost_equal(contract_aux_to_ao(v_aux, ao_to_aux), ref)
+
+    def test_cider_invariants(self):
+        assert_almost_equal(CG21_TENSOR, CG21_TENSOR.transpose(2, 1, 0))
+        svec, g1 = np.random.rand(3, 4), np.random.rand(3, 4)
+        g2 = np.random.rand(5, 4)
+        inv, dsvec, dg1, dg2 = [np.asarray(x) for x in \
+            get_cider_invariants(svec, g1, g2, deriv=True)]
+        assert_almost_equal(inv[0], np.linalg.norm(g1, axis=0)**2)
+        assert_almost_equal(inv[1], np.einsum('an,an->n', svec, g1))
+        assert_almost_equal(inv[5], np.einsum('an,an->n',
+                                              contract21(g2, g1), g1))
+        assert_almost_equal(np.asarray(contract21_deriv(svec, g1)),
+                            [np.einsum('an,an->n', contract21(e, svec), g1)
+                             for e in np.identity(5)])
+        delta = 1e-6
+        for x, jac in [(svec, dsvec), (g1, dg1), (g2, dg2)]:
+            for k in range(x.shape[0]):
+                x[k] += delta
+                invp = np.asarray(get_cider_invariants(svec, g1, g2))
+                x[k] -= 2 * delta
+                invm = np.asarray(get_cider_invariants(svec, g1, g2))
+                x[k] += delta
+                assert_almost_equal((invp - invm) / (2 * delta), jac[:,k], 5)
+
+
+class TestBlockedDescriptors():
+
+    @classmethod
+    def setup_class(cls):
+        mol = gto.Mole(atom='H 0 0 0; F 0 0 1.1', basis='def2-svp')
+        mol.build()
+        cls.rhf_analyzer = RHFAnalyzer(scf.RHF(mol).run())
+        mol = gto.Mole(atom='N 0 0 0; H 0 0 1.0', basis='def2-svp', spin=2)
+        mol.build()
+        cls.uhf_analyzer = UHFAnalyzer(scf.UHF(mol).run())
+
+    def test_blocked_restricted(self):
+        ref = get_exchange_descriptors2(self.rhf_analyzer, restricted=True,
+                                        version='c')
+        desc = get_exchange_descriptors2(self.rhf_analyzer, restricted=True,
+                                         version='c', max_memory=10)
+        assert_almost_equal(desc, np.asarray(ref))
+        out = np.zeros(ref.shape)
+        desc = get_exchange_descriptors2(self.rhf_analyzer, restricted=True,
+                                         version='c', out=out)
+        assert desc is out
+        assert_almost_equal(out, np.asarray(ref))
+
+    def test_blocked_unrestricted(self):
+        ref = get_exchange_descriptors2(self.uhf_analyzer, restricted=False,
+                                        version='a')
+        desc = get_exchange_descriptors2(self.uhf_analyzer, restricted=False,
+                                         version='a', max_memory=10)
+        for s in range(2):
+            assert_almost_equal(desc[s], np.asarray(ref[s]))
+
+    def test_descriptor_sweep(self):
+        gg_settings = [(8.0, 0.25, GG_AMIN),
+                       {'a0': 4.0, 'fac_mul': 0.5, 'amin': 2 * GG_AMIN}]
+        refs = [get_exchange_descriptors2(self.uhf_analyzer, restricted=False,
+                                          version='c'),
+                get_exchange_descriptors2(self.uhf_analyzer, restricted=False,
+                                          version='c', a0=4.0, fac_mul=0.5,
+                                          amin=2*GG_AMIN)]
+        descs = get_exchange_descriptors2_sweep(self.uhf_analyzer, gg_settings,
+                                                restricted=False, version='c',
+                                                max_memory=10)
+        assert_equal(len(descs), 2)
+        for desc, ref in zip(descs, refs):
+            for s in range(2):
+                assert_almost_equal(desc[s], np.asarray(ref[s]))
+        descs = get_exchange_descriptors2_sweep(self.rhf_analyzer,
+                                                gg_settings[1:], version='a')
+        ref = get_exchange_descriptors2(self.rhf_analyzer, version='a',
+                                        a0=4.0, fac_mul=0.5, amin=2*GG_AMIN)
+        assert_almost_equal(descs[0], np.asarray(ref))
+
+    def test_blocked_desc_order(self):
+        desc_order = [0, 1, 2, 3, 4, 5]
+        for version in ['a', 'c']:
+            ref = get_exchange_descriptors2(self.rhf_analyzer, version=version)
+            desc = get_exchange_descriptors2(self.rhf_analyzer,
+                                             version=version, max_memory=10,
+                                             desc_order=desc_order)
+            assert_almost_equal(desc[desc_order],
+                                np.asarray(ref)[desc_order])
+            assert_equal(desc[6:], 0)
+
+    def test_blocked_rho_cutoff(self):
+        rho_cutoff = 1e-3
+        for version in ['a', 'c']:
+            ref = get_exchange_descriptors2(self.rhf_analyzer, version=version)
+            mask = np.asarray(ref[0]) >= rho_cutoff
+            assert 0 < mask.sum() < mask.size
+            desc = get_exchange_descriptors2(self.rhf_analyzer,
+                                             version=version, max_memory=10,
+                                             rho_cutoff=rho_cutoff)
+            assert_almost_equal(desc[:,mask], np.asarray(ref)[:,mask])
+            assert_almost_equal(desc[:3,~mask], np.asarray(ref)[:3,~mask])
+            assert_equal(desc[3:,~mask], 0)
+
+    def test_numpy_backend(self):
+        backend = get_backend()
+        ref = get_exchange_descriptors2(self.rhf_analyzer, restricted=True,
+                                        version='c')
+        with use_backend('numpy'):
+            desc = get_exchange_descriptors2(self.rhf_analyzer,
+                                             restricted=True, version='c')
+        assert get_backend() == backend
+        assert isinstance(desc, np.ndarray)
+        # features reach ~1e8 in the density tails, so round-off differs
+        assert_almost_equal(desc, np.asarray(ref), 5)
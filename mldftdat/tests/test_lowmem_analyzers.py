@@ -2,15 +2,21 @@ from pyscf import scf, gto, lib
 from nose import SkipTest
 from nose.tools import nottest
 from nose.plugins.skip import Skip
-from numpy.testing import assert_almost_equal, assert_equal
+from numpy.testing import assert_almost_equal, assert_equal, assert_allclose
 
 from mldftdat.pyscf_utils import get_hf_coul_ex_total, get_hf_coul_ex_total_unrestricted,\
-                                run_scf, run_cc, transform_basis_1e
+                                run_scf, run_cc, transform_basis_1e,\
+                                get_ha_energy_density2, get_fx_energy_density2,\
+                                QuickGrid
 import test_analyzers
-from mldftdat.lowmem_analyzers import RHFAnalyzer, UHFAnalyzer, RKSAnalyzer, UKSAnalyzer
+from mldftdat.lowmem_analyzers import RHFAnalyzer, UHFAnalyzer, RKSAnalyzer, UKSAnalyzer,\
+                                      load_analyzer_data, get_analyzer_format_version,\
+                                      ANALYZER_FORMAT_VERSION
 import numpy as np
 import numbers
 import os
+import tempfile
+import h5py
 
 TMP_TEST = 'test_files/tmp'
 
@@ -29,6 +35,13 @@ class TestRHFAnalyzer():
         # This is tested in the rest of the module
         assert_almost_equal(self.ha_tot_ref + self.fx_tot_ref, self.rhf.energy_elec()[1])
 
+    def test_occ_orbitals(self):
+        nocc = self.mol.nelectron // 2
+        assert_equal(self.analyzer.occ_coeff.shape, (self.mol.nao_nr(), nocc))
+        assert_equal(self.analyzer.occ, 2)
+        assert_equal(self.analyzer.mo_vals.shape,
+                     (self.analyzer.ao_vals.shape[0], nocc))
+
     def test_get_ha_energy_density(self):
         ha_density = self.analyzer.get_ha_energy_density()
         ha_tot = np.dot(ha_density, self.analyzer.grid.weights)
@@ -41,6 +54,32 @@ class TestRHFAnalyzer():
         assert_almost_equal(fx_tot, self.fx_tot_ref, 5)
         assert_almost_equal(self.analyzer.fx_total, self.fx_tot_ref)
 
+    def test_get_ha_energy_density_df(self):
+        ha_density = self.analyzer.get_ha_energy_density_df()
+        error = self.analyzer.ha_df_error
+        ha_tot = np.dot(ha_density, self.analyzer.grid.weights)
+        assert_almost_equal(ha_tot, error['ha_total_df'], 4)
+        assert_almost_equal(error['ha_total'], self.ha_tot_ref)
+        assert_almost_equal(error['ha_total_df'], self.ha_tot_ref, 2)
+        assert error['fit_error'] > -1e-8
+        assert error['fit_error'] < 1e-4 * error['ha_total']
+
+    def test_get_fx_energy_density_ri(self):
+        fx_ref = self.analyzer.get_fx_energy_density()
+        fx_density = self.analyzer.get_fx_energy_density_ri()
+        error = self.analyzer.fx_ri_error
+        assert_almost_equal(error['fx_total'], self.fx_tot_ref)
+        assert_almost_equal(error['fx_total_ri'],
+                            np.dot(fx_density, self.analyzer.grid.weights))
+        assert abs(error['total_error']) < 1e-4 * abs(self.fx_tot_ref)
+        assert_almost_equal(error['int_abs_error'],
+                            np.dot(np.abs(fx_density - fx_ref),
+                                   self.analyzer.grid.weights))
+        assert error['int_abs_error'] < 1e-3 * abs(self.fx_tot_ref)
+        ri_analyzer = RHFAnalyzer(self.rhf, ri=True)
+        assert ri_analyzer.mo_vele_mat is None
+        assert_almost_equal(ri_analyzer.get_fx_energy_density(), fx_density)
+
     def test_get_ee_energy_density(self):
         ee_density = self.analyzer.get_ee_energy_density()
         ee_tot = np.dot(ee_density, self.analyzer.grid.weights)
@@ -65,6 +104,22 @@ class TestRHFAnalyzer():
         assert_almost_equal(analyzer1.fx_energy_density, analyzer3.fx_energy_density)
         assert_almost_equal(analyzer1.ee_energy_density, analyzer3.ee_energy_density)
 
+    def test_stored_grid(self):
+        analyzer1 = RHFAnalyzer(self.rhf)
+        analyzer_dict = analyzer1.as_dict()
+        # a grid that get_grid would not produce
+        analyzer_dict['data']['coords'] = analyzer1.grid.coords[::7].copy()
+        analyzer_dict['data']['weights'] = analyzer1.grid.weights[::7].copy()
+        analyzer2 = RHFAnalyzer.from_dict(analyzer_dict)
+        assert isinstance(analyzer2.grid, QuickGrid)
+        assert_equal(analyzer2.grid.coords, analyzer1.grid.coords[::7])
+        assert_equal(analyzer2.grid.weights, analyzer1.grid.weights[::7])
+        assert_equal(analyzer2.ao_vals.shape[0], analyzer2.grid.coords.shape[0])
+        analyzer1.get_ha_energy_density()
+        analyzer2.get_ha_energy_density()
+        assert_almost_equal(analyzer2.ha_energy_density,
+                            analyzer1.ha_energy_density[::7])
+
     def test_dump_load(self):
         analyzer1 = RHFAnalyzer(self.rhf)
         analyzer1.perform_full_analysis()
@@ -84,6 +139,68 @@ class TestRHFAnalyzer():
         assert_equal(analyzer1.ee_energy_density, data_dict['ee_energy_density'])
         os.remove(TMP_TEST)
 
+    def test_lazy_load(self):
+        analyzer1 = RHFAnalyzer(self.rhf)
+        analyzer1.get_ao_rho_data()
+        analyzer1.get_ha_energy_density()
+        fd, fname = tempfile.mkstemp(suffix='.hdf5')
+        os.close(fd)
+        try:
+            analyzer1.dump(fname)
+            analyzer2 = RHFAnalyzer.load(fname, lazy=True)
+            for key in ['grid', 'ao_vals', 'jmat', 'rho_data',
+                        'ha_energy_density']:
+                assert key not in analyzer2.__dict__
+            assert_equal(analyzer2.rho_data, analyzer1.rho_data)
+            assert_equal(analyzer2.ha_energy_density,
+                         analyzer1.ha_energy_density)
+            assert 'ao_vals' not in analyzer2.__dict__
+            assert analyzer2.fx_energy_density is None
+            assert isinstance(analyzer2.grid, QuickGrid)
+            assert_equal(analyzer2.grid.coords, analyzer1.grid.coords)
+            assert_almost_equal(analyzer2.ao_vals, analyzer1.ao_vals)
+            assert_almost_equal(analyzer2.fx_total, analyzer1.fx_total)
+            assert_equal(analyzer2.num_chunks, analyzer1.num_chunks)
+            analyzer2.get_fx_energy_density()
+            analyzer1.get_fx_energy_density()
+            assert_almost_equal(analyzer2.fx_energy_density,
+                                analyzer1.fx_energy_density)
+        finally:
+            os.remove(fname)
+
+    def test_dump_chunked(self):
+        analyzer1 = RHFAnalyzer(self.rhf)
+        analyzer1.get_ao_rho_data()
+        analyzer1.get_ha_energy_density()
+        fd, fname = tempfile.mkstemp(suffix='.hdf5')
+        os.close(fd)
+        try:
+            analyzer1.dump(fname, compression='gzip', dtype=np.float32,
+                           chunk_size=1000)
+            assert_equal(get_analyzer_format_version(fname),
+                         ANALYZER_FORMAT_VERSION)
+            with h5py.File(fname, 'r') as f:
+                dset = f['analyzer/data/rho_data']
+                assert_equal(dset.chunks, (6, 1000))
+                assert_equal(dset.compression, 'gzip')
+                assert_equal(dset.dtype, np.float32)
+                assert_equal(f['analyzer/data/coords'].dtype, np.float64)
+            data = load_analyzer_data(fname, ['rho_data', 'coords',
+                                              'ha_total'],
+                                      start=1500, stop=2600)
+            assert_equal(data['coords'], analyzer1.grid.coords[1500:2600])
+            assert_allclose(data['rho_data'],
+                            analyzer1.rho_data[:,1500:2600], rtol=1e-6,
+                            atol=1e-8)
+            assert_almost_equal(data['ha_total'], analyzer1.ha_total)
+            analyzer2 = RHFAnalyzer.load(fname)
+            assert_equal(analyzer2.rho_data.dtype, np.float64)
+            assert_allclose(analyzer2.ha_energy_density,
+                            analyzer1.ha_energy_density, rtol=1e-6,
+                            atol=1e-8)
+        finally:
+            os.remove(fname)
+
 
 class TestRHFAnalyzerChunks(TestRHFAnalyzer):
 
@@ -95,6 +212,47 @@ class TestRHFAnalyzerChunks(TestRHFAnalyzer):
         cls.analyzer = RHFAnalyzer(cls.rhf, max_mem=5)
         cls.ha_tot_ref, cls.fx_tot_ref = get_hf_coul_ex_total(cls.mol, cls.rhf)
 
+    def test_fused_ee_energy_density(self):
+        analyzer = RHFAnalyzer(self.rhf, max_mem=5)
+        assert analyzer.num_chunks > 1
+        analyzer.perform_full_analysis()
+        assert_almost_equal(analyzer.ha_energy_density,
+                            get_ha_energy_density2(
+                                analyzer.mol, analyzer.rdm1,
+                                analyzer.ao_vele_mat, analyzer.ao_vals))
+        assert_almost_equal(analyzer.fx_energy_density,
+                            get_fx_energy_density2(
+                                analyzer.mol, analyzer.occ,
+                                analyzer.mo_vele_mat, analyzer.mo_vals))
+
+    def test_threaded_chunks(self):
+        analyzer = RHFAnalyzer(self.rhf, max_mem=5, num_threads=2)
+        assert analyzer.num_chunks >= 2 * self.analyzer.num_chunks - 1
+        assert_almost_equal(analyzer.get_ha_energy_density(),
+                            self.analyzer.get_ha_energy_density())
+        assert_almost_equal(analyzer.get_fx_energy_density(),
+                            self.analyzer.get_fx_energy_density())
+
+
+class TestRHFAnalyzerDirect(TestRHFAnalyzer):
+
+    @classmethod
+    def setup_class(cls):
+        cls.mol = gto.Mole(atom='H 0 0 0; F 0 0 1.1', basis = 'sto-3g')
+        cls.mol.build()
+        cls.rhf = run_scf(cls.mol, 'RHF')
+        # small max_mem to use several blocks
+        cls.analyzer = RHFAnalyzer(cls.rhf, max_mem=1, direct=True)
+        cls.ha_tot_ref, cls.fx_tot_ref = get_hf_coul_ex_total(cls.mol, cls.rhf)
+
+    def test_direct_energy_densities(self):
+        assert self.analyzer.ao_vele_mat is None
+        ref_analyzer = RHFAnalyzer(self.rhf)
+        assert_almost_equal(self.analyzer.get_ha_energy_density(),
+                            ref_analyzer.get_ha_energy_density())
+        assert_almost_equal(self.analyzer.get_fx_energy_density(),
+                            ref_analyzer.get_fx_energy_density())
+
 
 class TestRKSAnalyzer():
 
@@ -122,6 +280,13 @@ class TestUHFAnalyzer():
         # This is tested in the rest of the module
         assert_almost_equal(self.ha_tot_ref + self.fx_tot_ref, self.uhf.energy_elec()[1])
 
+    def test_occ_orbitals(self):
+        for s, nocc in enumerate(self.mol.nelec):
+            assert_equal(self.analyzer.occ_coeff[s].shape,
+                         (self.mol.nao_nr(), nocc))
+            assert_equal(self.analyzer.mo_vals[s].shape,
+                         (self.analyzer.ao_vals.shape[0], nocc))
+
     def test_get_ha_energy_density(self):
         ha_density = self.analyzer.get_ha_energy_density()
         ha_tot = np.dot(ha_density, self.analyzer.grid.weights)
@@ -134,6 +299,34 @@ class TestUHFAnalyzer():
         assert_almost_equal(fx_tot, self.fx_tot_ref, 5)
         assert_almost_equal(self.analyzer.fx_total, self.fx_tot_ref)
 
+    def test_get_ha_energy_density_df(self):
+        ha_density = self.analyzer.get_ha_energy_density_df()
+        error = self.analyzer.ha_df_error
+        ha_tot = np.dot(ha_density, self.analyzer.grid.weights)
+        assert_almost_equal(ha_tot, error['ha_total_df'], 4)
+        assert_almost_equal(error['ha_total'], self.ha_tot_ref)
+        assert_almost_equal(error['ha_total_df'], self.ha_tot_ref, 2)
+        assert error['fit_error'] > -1e-8
+        assert error['fit_error'] < 1e-4 * error['ha_total']
+
+    def test_get_fx_energy_density_ri(self):
+        fx_ref = self.analyzer.get_fx_energy_density()
+        fx_density = self.analyzer.get_fx_energy_density_ri()
+        error = self.analyzer.fx_ri_error
+        assert_almost_equal(error['fx_total'], self.fx_tot_ref)
+        assert_almost_equal(error['fx_total_ri'],
+                            np.dot(fx_density, self.analyzer.grid.weights))
+        assert abs(error['total_error']) < 1e-4 * abs(self.fx_tot_ref)
+        assert_almost_equal(error['int_abs_error'],
+                            np.dot(np.abs(fx_density - fx_ref),
+                                   self.analyzer.grid.weights))
+        assert error['int_abs_error'] < 1e-3 * abs(self.fx_tot_ref)
+        ri_analyzer = UHFAnalyzer(self.uhf, require_converged=False, ri=True)
+        assert ri_analyzer.mo_vele_mat is None
+        assert_almost_equal(ri_analyzer.get_fx_energy_density(), fx_density)
+        assert_almost_equal(ri_analyzer.fx_energy_density_u + ri_analyzer.fx_energy_density_d,
+                            fx_density)
+
     def test_get_ee_energy_density(self):
         ee_density = self.analyzer.get_ee_energy_density()
         ee_tot = np.dot(ee_density, self.analyzer.grid.weights)
@@ -192,6 +385,43 @@ class TestUHFAnalyzerChunks(TestUHFAnalyzer):
         cls.analyzer = UHFAnalyzer(cls.uhf, max_mem=5)
         cls.ha_tot_ref, cls.fx_tot_ref = get_hf_coul_ex_total_unrestricted(cls.mol, cls.uhf)
 
+    def test_fused_ee_energy_density(self):
+        analyzer = UHFAnalyzer(self.uhf, max_mem=5)
+        assert analyzer.num_chunks > 1
+        analyzer.perform_full_analysis()
+        assert_almost_equal(analyzer.ha_energy_density,
+                            get_ha_energy_density2(
+                                analyzer.mol, np.sum(analyzer.rdm1, axis=0),
+                                analyzer.ao_vele_mat, analyzer.ao_vals))
+        for s, fx in enumerate([analyzer.fx_energy_density_u,
+                                analyzer.fx_energy_density_d]):
+            assert_almost_equal(fx, 0.5 * get_fx_energy_density2(
+                analyzer.mol, 2 * analyzer.occ[s],
+                analyzer.mo_vele_mat[s], analyzer.mo_vals[s]))
+
+
+class TestUHFAnalyzerDirect(TestUHFAnalyzer):
+
+    @classmethod
+    def setup_class(cls):
+        cls.mol = gto.Mole(atom='N 0 0 0; O 0 0 1.15', basis = 'sto-3g', spin = 1)
+        cls.mol.build()
+        cls.uhf = run_scf(cls.mol, 'UHF')
+        cls.analyzer = UHFAnalyzer(cls.uhf, max_mem=1, direct=True)
+        cls.ha_tot_ref, cls.fx_tot_ref = get_hf_coul_ex_total_unrestricted(cls.mol, cls.uhf)
+
+    def test_direct_energy_densities(self):
+        assert self.analyzer.ao_vele_mat is None
+        ref_analyzer = UHFAnalyzer(self.uhf)
+        assert_almost_equal(self.analyzer.get_ha_energy_density(),
+                            ref_analyzer.get_ha_energy_density())
+        assert_almost_equal(self.analyzer.get_fx_energy_density(),
+                            ref_analyzer.get_fx_energy_density())
+        assert_almost_equal(self.analyzer.fx_energy_density_u,
+                            ref_analyzer.fx_energy_density_u)
+        assert_almost_equal(self.analyzer.fx_energy_density_d,
+                            ref_analyzer.fx_energy_density_d)
+
 
 class TestUKSAnalyzer(TestUHFAnalyzer):
 
@@ -0,0 +1,49 @@
+from mldftdat.memory_plan import *
+
+import unittest
+from pyscf.dft.gen_grid import BLKSIZE
+from numpy.testing import assert_almost_equal, assert_equal
+
+
+class TestMemoryPlan(unittest.TestCase):
+
+    def test_estimate_array_sizes(self):
+        sizes = estimate_array_sizes(10, 1000, [3, 2], nspin=2)
+        assert_almost_equal(sizes['ao_vals'], 8 * 1000 * 10 / 1e6)
+        assert_almost_equal(sizes['mo_vals'], 8 * 1000 * 5 / 1e6)
+        assert_almost_equal(sizes['vele_mat'], 8 * 1000 * 100 / 1e6)
+        assert_almost_equal(sizes['mo_vele_mat'], 8 * 1000 * 13 / 1e6)
+        assert_almost_equal(sizes['ao_to_aux'], 8 * 10 * 55 / 1e6)
+        assert_almost_equal(sizes['descriptors'], 8 * 2 * 21 * 1000 / 1e6)
+
+    def test_plan_analyzer_memory(self):
+        nao, ngrid, nocc = 100, 100000, [20]
+        # vele_mat is 8 GB
+        plan = plan_analyzer_memory(nao, ngrid, nocc, max_mem=20000)
+        assert_equal(plan.get_strategy('ee'), 'incore')
+        assert_equal(plan.num_chunks, 1)
+        assert_equal(plan.get_strategy('density'), 'incore')
+        assert_equal(plan.get_strategy('descriptors'), 'incore')
+
+        plan = plan_analyzer_memory(nao, ngrid, nocc, max_mem=2000)
+        assert_equal(plan.get_strategy('ee'), 'chunked')
+        avail = plan.get_max_memory('ee')
+        assert_almost_equal(avail, 2000 - plan.resident)
+        chunk_size = -(-ngrid // plan.num_chunks)
+        ee_mem = plan.sizes['vele_mat'] + plan.sizes['mo_vele_mat']
+        assert chunk_size * ee_mem / ngrid <= avail * 1.01
+
+        # each thread holds one chunk
+        plan2 = plan_analyzer_memory(nao, ngrid, nocc, max_mem=2000,
+                                     num_threads=4)
+        assert plan2.num_chunks >= 4 * plan.num_chunks - 3
+
+        # less than BLKSIZE points of vele_mat fit
+        plan = plan_analyzer_memory(nao, 10000, nocc, max_mem=15)
+        assert_equal(plan.get_strategy('ee'), 'direct')
+        assert_equal(plan.get_strategy('density'), 'chunked')
+        assert_equal(plan.get_strategy('descriptors'), 'chunked')
+        assert plan.stages['density']['blksize'] % BLKSIZE == 0
+
+        assert 'stage ee' in str(plan)
+        assert_equal(plan.as_dict()['stages']['ee']['strategy'], 'direct')
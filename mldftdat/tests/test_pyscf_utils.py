@@ -1,6 +1,7 @@
 from mldftdat.pyscf_utils import *
 
 import ase.io
+import numpy
 import unittest
 from scipy.special import erf
 from pyscf.dft.gen_grid import Grids
@@ -172,6 +173,53 @@ class TestPyscfUtils(unittest.TestCase):
         lapl = ddrho[0] + ddrho[3] + ddrho[5]
         assert_almost_equal(rho_data[4], lapl)
 
+    def test_get_rho_tau_data(self):
+        for mol, grid, rdm1 in [(self.FH, self.rhf_grid, self.rhf_rdm1),
+                                (self.NO, self.uhf_grid, self.uhf_rdm1)]:
+            ao_data, rho_ref = get_mgga_data(mol, grid, rdm1)
+            ddrho_ref = get_rho_second_deriv(mol, grid, rdm1, ao_data)
+            tau_ref = get_tau_and_grad(mol, grid, rdm1, ao_data)
+            # small max_memory to use several blocks
+            rho_data, ddrho, tau_data = get_rho_tau_data(mol, grid, rdm1,
+                                                         max_memory=1)
+            assert_almost_equal(numpy.asarray(rho_data), numpy.asarray(rho_ref))
+            assert_almost_equal(numpy.asarray(ddrho), numpy.asarray(ddrho_ref))
+            assert_almost_equal(numpy.asarray(tau_data), numpy.asarray(tau_ref))
+            rho_data, ddrho, tau_data = get_rho_tau_data(mol, grid, rdm1,
+                                                         with_ddrho=False,
+                                                         with_tau=False)
+            assert_almost_equal(numpy.asarray(rho_data), numpy.asarray(rho_ref))
+            assert ddrho is None and tau_data is None
+
+    def test_get_rho_tau_data_sparse(self):
+        # spatially extended, so most shells are screened in most blocks
+        mol = gto.M(atom=';'.join('H 0 0 {}'.format(4.0*i) for i in range(8)),
+                    basis='sto-3g', unit='bohr', spin=0)
+        grid = get_grid(mol, level=1)
+        rdm1 = run_scf(mol, 'RHF').make_rdm1()
+        non0tab = make_mask(mol, grid.coords)
+        assert (non0tab == 0).any()
+        ao_data, rho_ref = get_mgga_data(mol, grid, rdm1)
+        ddrho_ref = get_rho_second_deriv(mol, grid, rdm1, ao_data)
+        tau_ref = get_tau_and_grad(mol, grid, rdm1, ao_data)
+        rho_data, ddrho, tau_data = get_rho_tau_data(mol, grid, rdm1,
+                                                     max_memory=1)
+        assert_almost_equal(numpy.asarray(rho_data), numpy.asarray(rho_ref))
+        assert_almost_equal(numpy.asarray(ddrho), numpy.asarray(ddrho_ref))
+        assert_almost_equal(numpy.asarray(tau_data), numpy.asarray(tau_ref))
+
+    def test_get_occ_orbitals(self):
+        mo_coeff = numpy.random.rand(5, 5)
+        mo_occ = numpy.array([2, 2, 0.5, 0, 0])
+        occ_coeff, occ = get_occ_orbitals(mo_coeff, mo_occ)
+        assert_equal(occ_coeff, mo_coeff[:,:3])
+        assert_equal(occ, mo_occ[:3])
+        occ_coeff, occ = get_occ_orbitals(numpy.stack([mo_coeff, mo_coeff]),
+                                          [[1, 1, 1, 0, 0], [1, 0, 0, 0, 0]])
+        assert_equal(occ_coeff[0], mo_coeff[:,:3])
+        assert_equal(occ_coeff[1], mo_coeff[:,:1])
+        assert_equal(occ[1], [1])
+
     def test_get_vele_mat(self):
         # covered in setup
         pass